@@ -0,0 +1,193 @@
+import os
+import threading
+import time
+
+from collections import OrderedDict
+
+# =========================
+# CONTROLLO ACCESSI AL BACKEND (per sessione e per scope)
+# =========================
+# Chi scorre veloce tra le multiselect fa partire un rerun per ogni click, e ogni
+# rerun una raffica di count/stats. Prima di partire ogni richiesta passa da qui:
+#
+# - token bucket + tetto di richieste in corso per sessione e per scope del profilo
+#   (più utenti dello stesso ente condividono lo scope)
+# - attesa massima ADMIT_WAIT_MAX_S, poi la richiesta viene rifiutata (dati parziali)
+# - richieste di un rerun già superato dal successivo della stessa sessione: scartate
+#   prima di partire (quelle già in volo finiscono e restano in cache)
+# - i retry di urllib3 consumano gettoni: con il bucket vuoto niente retry
+# - la richiesta duplicata dell'hedging ha un suo posto, solo se libero subito
+
+# rate in richieste/s; 0 = nessun limite di frequenza (resta il tetto di concorrenza)
+SESSION_RATE = float(os.getenv("API_SESSION_RATE", "5"))
+SESSION_BURST = 40
+SESSION_CONCURRENCY = 8
+SCOPE_RATE = float(os.getenv("API_SCOPE_RATE", "30"))
+SCOPE_BURST = 150
+SCOPE_CONCURRENCY = 24
+ADMIT_WAIT_MAX_S = 3.0
+# sessioni/scope inattivi da più di così vengono dimenticati
+IDLE_FORGET_S = 900
+
+ADMITTED = "admitted"
+THROTTLED = "throttled"
+SUPERSEDED = "superseded"
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def unlimited(self) -> bool:
+        return self.rate <= 0
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now) -> float:
+        if self.unlimited():
+            return 0.0
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        if not self.unlimited():
+            self.tokens -= 1
+
+
+class _Limit:
+    def __init__(self, rate, burst, concurrency):
+        self.bucket = TokenBucket(rate, burst)
+        self.concurrency = concurrency
+        self.inflight = 0
+        self.last_used = time.monotonic()
+
+
+class AdmissionController:
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._sessions = OrderedDict()
+        self._scopes = OrderedDict()
+        self._generations = {}
+        self._stats = {}
+
+    def _limit(self, table, key, rate, burst, concurrency, now):
+        lim = table.get(key)
+        if lim is None:
+            lim = table[key] = _Limit(rate, burst, concurrency)
+        lim.last_used = now
+        table.move_to_end(key)
+        # le voci in testa sono le meno recenti
+        while table:
+            old_key, old = next(iter(table.items()))
+            if now - old.last_used < IDLE_FORGET_S or old.inflight:
+                break
+            del table[old_key]
+            if table is self._sessions:
+                self._generations.pop(old_key, None)
+        return lim
+
+    def _limits(self, session, scope, now):
+        lims = [self._limit(self._sessions, session, SESSION_RATE, SESSION_BURST, SESSION_CONCURRENCY, now)]
+        if scope:
+            lims.append(self._limit(self._scopes, scope, SCOPE_RATE, SCOPE_BURST, SCOPE_CONCURRENCY, now))
+        return lims
+
+    def _count(self, scope, name, amount=1):
+        row = self._stats.setdefault(scope or "(prima di whoami)", {})
+        row[name] = row.get(name, 0) + amount
+
+    def new_generation(self, session) -> int:
+        # chiamata all'inizio di ogni rerun: le richieste dei rerun precedenti
+        # ancora in coda vengono scartate
+        with self._cond:
+            gen = self._generations.get(session, 0) + 1
+            self._generations[session] = gen
+            self._cond.notify_all()
+            return gen
+
+    def acquire(self, session, scope, generation, max_wait: float) -> str:
+        deadline = time.monotonic() + max_wait
+        waited = False
+        t0 = time.monotonic()
+        with self._cond:
+            while True:
+                if generation is not None and generation < self._generations.get(session, 0):
+                    self._count(scope, "superate")
+                    return SUPERSEDED
+                now = time.monotonic()
+                lims = self._limits(session, scope, now)
+                busy = any(lim.inflight >= lim.concurrency for lim in lims)
+                token_wait = max(lim.bucket.wait_time(now) for lim in lims)
+                if not busy and token_wait == 0:
+                    for lim in lims:
+                        lim.bucket.take()
+                        lim.inflight += 1
+                    self._count(scope, "ammesse")
+                    if waited:
+                        self._count(scope, "in_attesa")
+                        self._count(scope, "attesa_ms", round((now - t0) * 1000))
+                    return ADMITTED
+                left = deadline - now
+                if left <= 0:
+                    self._count(scope, "rifiutate")
+                    return THROTTLED
+                waited = True
+                # con slot pieni si aspetta un release (notify), con bucket vuoto il gettone
+                self._cond.wait(min(left, token_wait) if token_wait else left)
+
+    def release(self, session, scope):
+        with self._cond:
+            for table, key in ((self._sessions, session), (self._scopes, scope)):
+                lim = table.get(key)
+                if lim is not None and lim.inflight:
+                    lim.inflight -= 1
+            self._cond.notify_all()
+
+    def allow_retry(self, session, scope) -> bool:
+        # un retry costa un gettone come una richiesta nuova, ma non aspetta
+        with self._cond:
+            now = time.monotonic()
+            lims = self._limits(session, scope, now)
+            if any(lim.bucket.wait_time(now) > 0 for lim in lims):
+                self._count(scope, "retry_negati")
+                return False
+            for lim in lims:
+                lim.bucket.take()
+            self._count(scope, "retry")
+            return True
+
+    def try_acquire(self, session, scope, generation) -> bool:
+        # come acquire ma senza attesa, per richieste facoltative (hedge)
+        with self._cond:
+            if generation is not None and generation < self._generations.get(session, 0):
+                return False
+            now = time.monotonic()
+            lims = self._limits(session, scope, now)
+            if any(lim.inflight >= lim.concurrency or lim.bucket.wait_time(now) > 0 for lim in lims):
+                self._count(scope, "hedge_negati")
+                return False
+            for lim in lims:
+                lim.bucket.take()
+                lim.inflight += 1
+            self._count(scope, "hedge")
+            return True
+
+    def report(self):
+        with self._cond:
+            rows = []
+            for scope, stats in sorted(self._stats.items()):
+                lim = self._scopes.get(scope)
+                rows.append({
+                    "scope": scope,
+                    "in_corso": lim.inflight if lim else 0,
+                    **{k: stats.get(k, 0) for k in (
+                        "ammesse", "in_attesa", "attesa_ms", "rifiutate", "superate", "retry", "retry_negati",
+                        "hedge", "hedge_negati",
+                    )},
+                })
+            return {"sessioni": len(self._sessions), "scope": rows}
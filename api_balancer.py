@@ -0,0 +1,116 @@
+import random
+import threading
+import time
+
+from collections import OrderedDict
+
+# =========================
+# BILANCIAMENTO LATO CLIENT (più repliche dell'API)
+# =========================
+# API_BASE può contenere più URL separati da virgola: ogni richiesta sceglie una
+# replica con "power of two choices" su latenza EWMA x richieste in corso (una
+# replica lenta o carica riceve meno traffico, senza coordinamento tra i worker).
+#
+# Espulsione passiva: dopo EJECT_AFTER errori consecutivi (rete, timeout, 5xx: gli
+# stessi che api_get trasforma in ApiUnavailableError) la replica esce per
+# EJECT_BASE_S, raddoppiati a ogni ricaduta fino a EJECT_MAX_S. Al rientro basta un
+# errore per uscire di nuovo, un successo la rimette in pari.
+#
+# Sticky: gli import admin vivono sulla replica che ha ricevuto la POST, quindi il
+# polling dello stato va sempre lì (chiave = job_id).
+
+EWMA_ALPHA = 0.3
+EJECT_AFTER = 3
+EJECT_BASE_S = 10.0
+EJECT_MAX_S = 300.0
+STICKY_MAX = 1000
+
+
+class Endpoint:
+    def __init__(self, url: str):
+        self.url = url
+        self.ewma = None
+        self.outstanding = 0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.eject_s = 0.0
+        self.ejected_until = 0.0
+
+    def score(self) -> float:
+        # replica mai misurata (o appena rientrata): 0, così riceve subito traffico
+        return (self.ewma or 0.0) * (self.outstanding + 1)
+
+
+class Balancer:
+    def __init__(self, urls):
+        if not urls:
+            raise ValueError("nessun endpoint API configurato")
+        self.endpoints = [Endpoint(u) for u in urls]
+        self._lock = threading.Lock()
+        self._rnd = random.Random()
+        self._sticky = OrderedDict()
+
+    def pick(self, sticky=None, exclude=()) -> Endpoint:
+        with self._lock:
+            if sticky is not None:
+                ep = self._sticky.get(sticky)
+                if ep is not None:
+                    return ep
+            now = time.monotonic()
+            allowed = [e for e in self.endpoints if e.url not in exclude] or self.endpoints
+            healthy = [e for e in allowed if e.ejected_until <= now]
+            if not healthy:
+                # tutte espulse: meglio tentare quella che rientra prima che fallire subito
+                return min(allowed, key=lambda e: e.ejected_until)
+            if len(healthy) == 1:
+                return healthy[0]
+            a, b = self._rnd.sample(healthy, 2)
+            return a if a.score() <= b.score() else b
+
+    def bind(self, sticky, ep: Endpoint):
+        with self._lock:
+            self._sticky[sticky] = ep
+            self._sticky.move_to_end(sticky)
+            while len(self._sticky) > STICKY_MAX:
+                self._sticky.popitem(last=False)
+
+    def begin(self, ep: Endpoint):
+        with self._lock:
+            ep.outstanding += 1
+
+    def end(self, ep: Endpoint, elapsed: float, ok: bool):
+        with self._lock:
+            ep.outstanding -= 1
+            ep.requests += 1
+            if ok:
+                ep.ewma = elapsed if ep.ewma is None else ep.ewma + EWMA_ALPHA * (elapsed - ep.ewma)
+                ep.consecutive_failures = 0
+                ep.eject_s = 0.0
+                return
+            ep.failures += 1
+            ep.consecutive_failures += 1
+            # appena rientrata (eject_s > 0) basta un errore
+            if ep.consecutive_failures >= EJECT_AFTER or ep.eject_s:
+                ep.eject_s = min(EJECT_MAX_S, ep.eject_s * 2 if ep.eject_s else EJECT_BASE_S)
+                ep.ejected_until = time.monotonic() + ep.eject_s
+                ep.ejections += 1
+                ep.consecutive_failures = 0
+                ep.ewma = None
+
+    def report(self):
+        now = time.monotonic()
+        with self._lock:
+            return [
+                {
+                    "endpoint": e.url,
+                    "ewma_ms": round(e.ewma * 1000, 1) if e.ewma is not None else None,
+                    "in_corso": e.outstanding,
+                    "richieste": e.requests,
+                    "errori": e.failures,
+                    "espulsioni": e.ejections,
+                    "espulso_per_s": round(max(0.0, e.ejected_until - now), 1),
+                }
+                for e in self.endpoints
+            ]
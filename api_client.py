@@ -0,0 +1,500 @@
+import os
+import threading
+import time
+import uuid
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import requests
+import streamlit as st
+
+from requests.adapters import HTTPAdapter
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from urllib3.exceptions import MaxRetryError, ResponseError
+from urllib3.util.retry import Retry
+
+from admission import ADMIT_WAIT_MAX_S, SUPERSEDED, THROTTLED, AdmissionController
+from api_balancer import Balancer
+from api_fixtures import API_RECORD, API_REPLAY, RecordingAdapter, ReplayAdapter
+
+API_BASE = os.getenv("API_BASE", "http://localhost:8000")
+# più repliche: API_BASE=http://api1:8000,http://api2:8000 (vedi api_balancer.py)
+API_BASES = [u.strip().rstrip("/") for u in API_BASE.split(",") if u.strip()]
+# parametro che lega le chiamate successive alla replica che ha creato il job
+STICKY_PARAM = "job_id"
+
+# =========================
+# POLICY: timeout / retry / hedging
+# =========================
+
+# (connect, read) in secondi, per endpoint. Gli aggregati pesanti hanno un budget
+# più ampio, i facet e whoami devono rispondere in fretta.
+DEFAULT_TIMEOUT = (3.05, 20)
+ENDPOINT_TIMEOUTS = {
+    "/health": (3.05, 6),
+    "/auth/whoami": (3.05, 8),
+    "/auth/regioni": (3.05, 10),
+    "/auth/province": (3.05, 10),
+    "/auth/comuni": (3.05, 10),
+    "/auth/province-nascita": (3.05, 10),
+    "/auth/comuni-nascita": (3.05, 10),
+    "/auth/anni-inserimento": (3.05, 10),
+    "/auth/count": (3.05, 15),
+    "/auth/stats-sex": (3.05, 15),
+    "/auth/stats-nat": (3.05, 15),
+    "/auth/gg-fasce": (3.05, 15),
+    "/auth/eta-fasce": (3.05, 15),
+    "/auth/eta-gg-fasce": (3.05, 15),
+    "/auth/trend-annuale": (3.05, 20),
+    "/auth/cube": (3.05, 20),
+    "/auth/geo-counts": (3.05, 20),
+    "/auth/search": (3.05, 15),
+    "/admin/import/status": (3.05, 10),
+    "/admin/import/hashes": (3.05, 60),
+}
+
+# Tempo massimo complessivo per le chiamate API di un singolo rerun: oltre questo
+# le sezioni rimanenti vengono mostrate come "non disponibili" invece di bloccare.
+RERUN_DEADLINE_S = float(os.getenv("API_RERUN_DEADLINE", "25"))
+# Sotto questa soglia non ha senso partire con una nuova richiesta
+MIN_REQUEST_BUDGET_S = 0.5
+
+# Hedging: dopo il p95 osservato per l'endpoint parte una seconda GET identica,
+# vince la prima che risponde. Solo per GET idempotenti sugli aggregati.
+HEDGE_ENABLED = os.getenv("API_HEDGE", "0") == "1"
+HEDGE_ENDPOINTS = {
+    "/auth/count",
+    "/auth/stats-sex",
+    "/auth/stats-nat",
+    "/auth/gg-fasce",
+    "/auth/eta-fasce",
+    "/auth/trend-annuale",
+    "/auth/cube",
+}
+HEDGE_MIN_SAMPLES = 20
+HEDGE_MIN_DELAY_S = 0.25
+LATENCY_WINDOW = 200
+
+# Aggregati aggiunti dopo (un backend più vecchio risponde 404): un 4xx qui vuol
+# dire "sezione non disponibile", non un errore che ferma la pagina. Un 404/405
+# viene ricordato dal processo per NOT_SUPPORTED_TTL_S: nel frattempo nessuna
+# richiesta parte (un backend aggiornato viene riprovato alla scadenza).
+OPTIONAL_ENDPOINTS = {
+    "/auth/cube",
+    "/auth/eta-gg-fasce",
+    "/auth/geo-counts",
+}
+NOT_SUPPORTED_TTL_S = 600
+
+# Retry-After più lunghi di così non li aspettiamo: meglio degradare
+RETRY_AFTER_MAX_S = 5.0
+
+
+class AuthExpiredError(Exception):
+    pass
+
+class ApiUnavailableError(Exception):
+    # timeout, errori di rete, 5xx o budget del rerun esaurito
+    pass
+
+class ApiRequestError(Exception):
+    # 4xx fuori da un rerun (thread di background, CLI): lì st.stop non ferma nulla
+    pass
+
+class ApiNotSupportedError(ApiRequestError):
+    # 4xx su un endpoint opzionale (OPTIONAL_ENDPOINTS): chi chiama salta la sezione
+    pass
+
+class ApiThrottledError(ApiUnavailableError):
+    # troppe richieste dalla sessione o dallo scope (admission.py)
+    pass
+
+class RequestSupersededError(ApiUnavailableError):
+    # la sessione è già passata a un rerun successivo: la richiesta non parte
+    pass
+
+
+class BudgetRetry(Retry):
+    # Retry-After rispettato anche su 502/504, ma con un tetto massimo di attesa
+    RETRY_AFTER_STATUS_CODES = frozenset([413, 429, 502, 503, 504])
+
+    def get_retry_after(self, response):
+        seconds = super().get_retry_after(response)
+        if seconds is None:
+            return None
+        return min(seconds, RETRY_AFTER_MAX_S)
+
+    def increment(self, method=None, url=None, response=None, error=None, _pool=None, _stacktrace=None):
+        new = super().increment(method, url, response, error, _pool, _stacktrace)
+        # sotto raffica i retry moltiplicano il carico: passano dal bucket della sessione
+        if not retry_allowed():
+            raise MaxRetryError(_pool, url, error or ResponseError("retry negato dal controllo accessi"))
+        return new
+
+
+class LatencyTracker:
+    # finestra mobile delle latenze per endpoint (thread-safe, condivisa tra sessioni)
+    def __init__(self, window: int = LATENCY_WINDOW):
+        self._lock = threading.Lock()
+        self._window = window
+        self._samples = {}
+
+    def record(self, path: str, seconds: float):
+        with self._lock:
+            dq = self._samples.get(path)
+            if dq is None:
+                dq = self._samples[path] = deque(maxlen=self._window)
+            dq.append(seconds)
+
+    def p95(self, path: str):
+        with self._lock:
+            dq = self._samples.get(path)
+            if not dq or len(dq) < HEDGE_MIN_SAMPLES:
+                return None
+            ordered = sorted(dq)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+    def hedge_delay(self, path: str):
+        p = self.p95(path)
+        if p is None:
+            return None
+        return max(p, HEDGE_MIN_DELAY_S)
+
+
+# =========================
+# DEADLINE per rerun
+# =========================
+# Ogni rerun Streamlit gira nel proprio thread: il deadline è thread-local.
+_rerun = threading.local()
+
+def start_rerun_deadline(seconds: float = RERUN_DEADLINE_S):
+    _rerun.deadline = time.monotonic() + seconds
+    _rerun.offline = None
+    # identità per il controllo accessi; nuovo rerun = le richieste del precedente sono superate
+    # (id casuale in session_state: sopravvive ai rerun, unico per browser)
+    if get_script_run_ctx() is not None:
+        _rerun.session = st.session_state.setdefault("_api_session_id", uuid.uuid4().hex)
+    else:
+        _rerun.session = None
+    _rerun.scope = None
+    _rerun.generation = get_admission().new_generation(_rerun.session) if _rerun.session else None
+
+def set_rerun_scope(scope: str):
+    # dopo whoami: limiti condivisi da tutte le sessioni con lo stesso profilo
+    _rerun.scope = scope
+
+def set_rerun_offline(reason: str):
+    # healthcheck fallito: per il resto del rerun nessuna chiamata parte,
+    # i fetcher passano subito alla copia last-known-good
+    _rerun.offline = reason
+
+# endpoint opzionale -> scadenza (monotonic) del "non disponibile"
+_not_supported = {}
+
+def endpoint_supported(path: str) -> bool:
+    until = _not_supported.get(path)
+    return until is None or until <= time.monotonic()
+
+_RERUN_FIELDS = ("deadline", "offline", "session", "scope", "generation")
+
+def bind_rerun_deadline(fn):
+    # per i thread di background che lavorano per il rerun corrente: stesso
+    # deadline, stato offline e identità (controllo accessi) del thread dello script
+    values = {name: getattr(_rerun, name, None) for name in _RERUN_FIELDS}
+
+    def run(*args, **kwargs):
+        for name, value in values.items():
+            setattr(_rerun, name, value)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            for name in _RERUN_FIELDS:
+                setattr(_rerun, name, None)
+    return run
+
+def remaining_budget():
+    deadline = getattr(_rerun, "deadline", None)
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+def timeout_for(path: str, apply_deadline: bool = True):
+    connect, read = ENDPOINT_TIMEOUTS.get(path, DEFAULT_TIMEOUT)
+    if apply_deadline:
+        offline = getattr(_rerun, "offline", None)
+        if offline:
+            raise ApiUnavailableError(offline)
+        left = remaining_budget()
+        if left is not None:
+            if left < MIN_REQUEST_BUDGET_S:
+                raise ApiUnavailableError(
+                    f"Tempo massimo della pagina esaurito prima di {path}: dati parziali."
+                )
+            connect = min(connect, left)
+            read = min(read, left)
+    return connect, read
+
+
+# =========================
+# HTTP session + API helpers
+# =========================
+@st.cache_resource
+def get_session():
+    s = requests.Session()
+    retry = BudgetRetry(
+        total=3,
+        connect=2,
+        read=0,  # un read timeout non si ritenta: ci pensano hedging e deadline
+        status=2,
+        backoff_factor=0.3,
+        backoff_max=2,
+        status_forcelist=[429, 502, 503, 504],
+        allowed_methods=["GET", "POST"],
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    if API_REPLAY:
+        # nessuna rete: risposte dal file registrato (api_fixtures.py)
+        adapter = ReplayAdapter(API_REPLAY)
+    elif API_RECORD:
+        adapter = RecordingAdapter(API_RECORD, max_retries=retry, pool_connections=10, pool_maxsize=10)
+    else:
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=10, pool_maxsize=10)
+    s.mount("http://", adapter)
+    s.mount("https://", adapter)
+    return s
+
+@st.cache_resource
+def get_balancer():
+    return Balancer(API_BASES)
+
+@st.cache_resource
+def get_admission():
+    return AdmissionController()
+
+def _admit(path: str):
+    # None = nessun controllo (thread senza sessione: warmer, refresh LKG, CLI)
+    session = getattr(_rerun, "session", None)
+    if session is None:
+        return None
+    scope = getattr(_rerun, "scope", None)
+    left = remaining_budget()
+    max_wait = ADMIT_WAIT_MAX_S if left is None else min(ADMIT_WAIT_MAX_S, max(0.0, left - MIN_REQUEST_BUDGET_S))
+    outcome = get_admission().acquire(session, scope, getattr(_rerun, "generation", None), max_wait)
+    if outcome == SUPERSEDED:
+        raise RequestSupersededError(f"Filtri cambiati: richiesta {path} annullata.")
+    if outcome == THROTTLED:
+        raise ApiThrottledError(f"Troppe richieste ravvicinate: {path} rimandata, dati parziali.")
+    return session, scope
+
+def _try_admit():
+    # come _admit ma senza attesa (richiesta hedge): False = nessun posto libero
+    session = getattr(_rerun, "session", None)
+    if session is None:
+        return None
+    scope = getattr(_rerun, "scope", None)
+    if not get_admission().try_acquire(session, scope, getattr(_rerun, "generation", None)):
+        return False
+    return session, scope
+
+def retry_allowed() -> bool:
+    session = getattr(_rerun, "session", None)
+    if session is None:
+        return True
+    return get_admission().allow_retry(session, getattr(_rerun, "scope", None))
+
+@st.cache_resource
+def get_latency_tracker():
+    return LatencyTracker()
+
+@st.cache_resource
+def get_hedge_executor():
+    return ThreadPoolExecutor(max_workers=8, thread_name_prefix="api-hedge")
+
+def auth_headers(tok: str):
+    return {"Authorization": f"Bearer {tok.strip()}"}
+
+def _send(ep, method: str, path: str, **kwargs):
+    # una richiesta verso la replica ep: latenza ed esito vanno al balancer
+    balancer = get_balancer()
+    balancer.begin(ep)
+    t0 = time.monotonic()
+    ok = False
+    try:
+        r = get_session().request(method, f"{ep.url}{path}", **kwargs)
+        ok = r.status_code < 500
+        return r
+    finally:
+        balancer.end(ep, time.monotonic() - t0, ok)
+
+def _send_get(ep, path: str, headers, params, timeout):
+    return _send(ep, "GET", path, headers=headers, params=params, timeout=timeout)
+
+def _hedged_get(path: str, headers, params, timeout, sticky=None):
+    tracker = get_latency_tracker()
+    balancer = get_balancer()
+    delay = tracker.hedge_delay(path) if (HEDGE_ENABLED and path in HEDGE_ENDPOINTS) else None
+
+    ep = balancer.pick(sticky=sticky)
+    t0 = time.monotonic()
+    if delay is None or delay >= timeout[1]:
+        r = _send_get(ep, path, headers, params, timeout)
+        tracker.record(path, time.monotonic() - t0)
+        return r
+
+    pool = get_hedge_executor()
+    send = bind_rerun_deadline(_send_get)
+    pending = {pool.submit(send, ep, path, headers, params, timeout)}
+    done, pending = wait(pending, timeout=delay)
+
+    if not done:
+        # il primo è oltre il p95: duplica la richiesta con il budget residuo,
+        # su un'altra replica se ce n'è una. La copia occupa un posto in più
+        # nel controllo accessi: se non c'è subito, niente hedge
+        left = timeout[1] - (time.monotonic() - t0)
+        ticket = _try_admit() if left > MIN_REQUEST_BUDGET_S else False
+        if ticket is not False:
+            hedge_ep = balancer.pick(exclude={ep.url})
+            hedge = pool.submit(send, hedge_ep, path, headers, params, (timeout[0], left))
+            if ticket is not None:
+                admission = get_admission()
+                # rilasciato quando la copia finisce, anche se ha vinto il primo
+                hedge.add_done_callback(lambda _: admission.release(*ticket))
+            pending.add(hedge)
+
+    first_error = None
+    while True:
+        for fut in done:
+            try:
+                r = fut.result()
+            except requests.RequestException as e:
+                first_error = first_error or e
+                continue
+            tracker.record(path, time.monotonic() - t0)
+            return r
+        if not pending:
+            raise first_error
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+def api_healthcheck():
+    # ok se almeno una replica risponde (le altre intanto accumulano errori ed escono)
+    balancer = get_balancer()
+    tried = set()
+    for _ in API_BASES:
+        ep = balancer.pick(exclude=tried)
+        tried.add(ep.url)
+        try:
+            r = _send(ep, "GET", "/health", timeout=timeout_for("/health", apply_deadline=False))
+        except Exception:
+            continue
+        if r.status_code == 200:
+            return True
+    return False
+
+def api_get(path: str, tok: str, params=None):
+    # il polling degli import admin non è soggetto al deadline del rerun
+    # né al controllo accessi
+    is_admin_path = path.startswith("/admin/")
+    if not endpoint_supported(path):
+        raise ApiNotSupportedError(f"{path} non disponibile su questo backend")
+    ticket = None if is_admin_path else _admit(path)
+    try:
+        timeout = timeout_for(path, apply_deadline=not is_admin_path)
+        sticky = params.get(STICKY_PARAM) if isinstance(params, dict) else None
+        r = _hedged_get(path, auth_headers(tok), params, timeout, sticky=sticky)
+    except requests.exceptions.ConnectTimeout:
+        raise ApiUnavailableError("API non raggiungibile (connect timeout). Controlla API_BASE / DNS / host.")
+    except requests.exceptions.ReadTimeout:
+        raise ApiUnavailableError(
+            f"API raggiunta ma {path} non ha risposto entro {timeout[1]:.0f}s (read timeout)."
+        )
+    except requests.RequestException as e:
+        raise ApiUnavailableError(f"Errore rete chiamando l’API: {e}")
+    finally:
+        if ticket is not None:
+            get_admission().release(*ticket)
+
+    if r.status_code == 401:
+        raise AuthExpiredError("Token non valido o scaduto")
+    if r.status_code >= 500:
+        raise ApiUnavailableError(f"Errore API {r.status_code} su {path}: {r.text[:300]}")
+    if r.status_code >= 400 and path in OPTIONAL_ENDPOINTS:
+        if r.status_code in (404, 405):
+            _not_supported[path] = time.monotonic() + NOT_SUPPORTED_TTL_S
+        raise ApiNotSupportedError(f"{path} non disponibile (errore API {r.status_code})")
+    if r.status_code >= 400:
+        st.error(f"Errore API {r.status_code}: {r.text[:800]}")
+        st.stop()
+        raise ApiRequestError(f"Errore API {r.status_code} su {path}")
+    return r.json()
+
+def api_get_raw(path: str, tok: str, params=None) -> bytes:
+    try:
+        r = _send(
+            get_balancer().pick(),
+            "GET",
+            path,
+            headers=auth_headers(tok),
+            params=params,
+            timeout=(10, 300),
+        )
+    except requests.exceptions.ConnectTimeout:
+        st.error("API non raggiungibile (connect timeout).")
+        st.stop()
+    except requests.exceptions.ReadTimeout:
+        st.error("Timeout durante il download (read timeout).")
+        st.stop()
+    except requests.RequestException as e:
+        st.error(f"Errore rete durante download: {e}")
+        st.stop()
+
+    if r.status_code == 401:
+        raise AuthExpiredError("Token non valido o scaduto")
+    if r.status_code >= 400:
+        st.error(f"Errore API {r.status_code}: {r.text[:800]}")
+        st.stop()
+
+    return r.content
+
+def api_post(path: str, tok: str, files=None, data=None):
+    # solo eccezioni, niente st.*: usabile dai thread di background (coda import).
+    # ApiUnavailableError = la richiesta non è arrivata, si può ripetere;
+    # ApiRequestError = rifiutata o esito sconosciuto (read timeout), non si ripete
+    ep = get_balancer().pick()
+    try:
+        r = _send(
+            ep,
+            "POST",
+            path,
+            headers=auth_headers(tok),
+            files=files,
+            data=data,
+            timeout=(10, 60),
+        )
+    except requests.exceptions.ConnectTimeout:
+        raise ApiUnavailableError("API non raggiungibile (connect timeout).")
+    except requests.exceptions.ReadTimeout:
+        raise ApiRequestError("Timeout durante la POST (read timeout). Import potrebbe essere partito o backend bloccato.")
+    except requests.RequestException as e:
+        raise ApiUnavailableError(f"Errore rete durante POST: {e}")
+
+    if r.status_code == 401:
+        raise AuthExpiredError("Token non valido o scaduto")
+    if r.status_code in (502, 503, 504):
+        raise ApiUnavailableError(f"Errore API {r.status_code}: {r.text[:800]}")
+    if r.status_code >= 400:
+        raise ApiRequestError(f"Errore API {r.status_code}: {r.text[:800]}")
+    js = r.json()
+    if isinstance(js, dict) and js.get(STICKY_PARAM):
+        # il polling del job torna sulla replica che l'ha creato
+        get_balancer().bind(js[STICKY_PARAM], ep)
+    return js
+
+def api_post_multipart(path: str, tok: str, files=None, data=None):
+    try:
+        return api_post(path, tok, files=files, data=data)
+    except (ApiUnavailableError, ApiRequestError) as e:
+        st.error(str(e))
+        st.stop()
+        raise
@@ -0,0 +1,164 @@
+import argparse
+import base64
+import gzip
+import json
+import os
+import threading
+import time
+
+from collections import deque
+from datetime import datetime, timedelta, UTC
+from urllib.parse import parse_qsl, urlsplit
+
+import requests
+
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+
+# =========================
+# RECORD / REPLAY del traffico verso il backend
+# =========================
+# Adapter di trasporto montati sulla session di api_client: tutte le chiamate
+# (api_get, api_get_raw, healthcheck, POST import) passano da qui.
+#
+#   API_RECORD=sessione.jsonl.gz   registra richieste/risposte (niente header,
+#                                  quindi niente token) con la latenza originale
+#   API_REPLAY=sessione.jsonl.gz   risponde dal file, senza rete
+#   API_REPLAY_SPEED=0.5           latenze scalate (1 = originali, 0 = nessuna attesa)
+#
+#   python -m api_fixtures sessione.jsonl.gz   riepilogo per endpoint
+
+API_RECORD = os.getenv("API_RECORD", "")
+API_REPLAY = os.getenv("API_REPLAY", "")
+API_REPLAY_SPEED = float(os.getenv("API_REPLAY_SPEED", "1"))
+
+# parametri mai scritti su file
+SCRUB_PARAMS = {"token", "access_token", "auth"}
+
+
+def request_key(method: str, url: str) -> str:
+    # metodo + path + query in ordine canonico (il token sta negli header, non qui)
+    u = urlsplit(url)
+    query = sorted((k, v) for k, v in parse_qsl(u.query, keep_blank_values=True) if k not in SCRUB_PARAMS)
+    qs = "&".join(f"{k}={v}" for k, v in query)
+    return f"{method.upper()} {u.path}" + (f"?{qs}" if qs else "")
+
+
+class RecordingAdapter(HTTPAdapter):
+    def __init__(self, path: str, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def send(self, request, **kwargs):
+        t0 = time.monotonic()
+        resp = super().send(request, **kwargs)
+        elapsed = time.monotonic() - t0
+        # il body va letto qui: il chiamante lo ritrova in resp.content
+        body = resp.content
+        try:
+            text, b64 = body.decode("utf-8"), False
+        except UnicodeDecodeError:
+            text, b64 = base64.b64encode(body).decode("ascii"), True
+        rec = {
+            "key": request_key(request.method, request.url),
+            "status": resp.status_code,
+            "ct": resp.headers.get("Content-Type", ""),
+            "body": text,
+            "b64": b64,
+            "elapsed": round(elapsed, 4),
+            "at": datetime.now(UTC).isoformat(),
+        }
+        line = json.dumps(rec, ensure_ascii=False) + "\n"
+        with self._lock:
+            # ogni write è un membro gzip: il file resta leggibile anche se il processo muore
+            with gzip.open(self.path, "at", encoding="utf-8") as f:
+                f.write(line)
+        return resp
+
+
+def load_fixtures(path: str):
+    out = {}
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                rec = json.loads(line)
+                out.setdefault(rec["key"], []).append(rec)
+    return out
+
+
+class ReplayAdapter(BaseAdapter):
+    # stesse risposte nell'ordine registrato per chiave (es. polling dello stato
+    # import: running, running, done); finita la sequenza si ripete l'ultima
+    def __init__(self, path: str, speed: float = API_REPLAY_SPEED):
+        super().__init__()
+        self.speed = speed
+        self._lock = threading.Lock()
+        self._queues = {k: deque(v) for k, v in load_fixtures(path).items()}
+        self.misses = 0
+
+    def _next(self, key: str):
+        with self._lock:
+            q = self._queues.get(key)
+            if not q:
+                self.misses += 1
+                return None
+            return q.popleft() if len(q) > 1 else q[0]
+
+    def send(self, request, timeout=None, **kwargs):
+        key = request_key(request.method, request.url)
+        rec = self._next(key)
+        if rec is None:
+            raise requests.ConnectionError(f"replay: nessuna risposta registrata per {key}", request=request)
+
+        delay = rec["elapsed"] * self.speed
+        read_timeout = timeout[1] if isinstance(timeout, tuple) else timeout
+        if read_timeout is not None and delay > read_timeout:
+            time.sleep(read_timeout)
+            raise requests.exceptions.ReadTimeout(f"replay: {key} oltre il timeout", request=request)
+        if delay > 0:
+            time.sleep(delay)
+
+        resp = requests.Response()
+        resp.status_code = rec["status"]
+        resp._content = base64.b64decode(rec["body"]) if rec["b64"] else rec["body"].encode("utf-8")
+        resp.headers = CaseInsensitiveDict({"Content-Type": rec["ct"]})
+        resp.encoding = "utf-8"
+        resp.url = request.url
+        resp.request = request
+        resp.elapsed = timedelta(seconds=delay)
+        return resp
+
+    def close(self):
+        pass
+
+
+def summary(path: str):
+    rows = {}
+    for key, recs in load_fixtures(path).items():
+        endpoint = key.split("?", 1)[0]
+        acc = rows.setdefault(endpoint, {"n": 0, "s": 0.0, "bytes": 0})
+        for rec in recs:
+            acc["n"] += 1
+            acc["s"] += rec["elapsed"]
+            acc["bytes"] += len(rec["body"])
+    return rows
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Riepilogo di un file di traffico registrato")
+    ap.add_argument("path")
+    args = ap.parse_args()
+
+    rows = summary(args.path)
+    print(f"{'endpoint':<36} {'richieste':>9} {'latenza tot s':>13} {'media ms':>9} {'KB':>8}")
+    for endpoint, acc in sorted(rows.items(), key=lambda kv: -kv[1]["s"]):
+        print(
+            f"{endpoint:<36} {acc['n']:>9} {acc['s']:>13.2f} "
+            f"{acc['s'] / acc['n'] * 1000:>9.1f} {acc['bytes'] / 1024:>8.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,195 @@
+# =========================
+# CONFIGURAZIONE STATICA (importata una volta per processo)
+# =========================
+# Palette, mappe etichette/codici, opzioni trend e CSS: prima venivano
+# ricostruiti ad ogni rerun dentro streamlit_app.py.
+
+# cookie del vecchio CookieManager (token in chiaro): letto solo per migrarlo
+COOKIE_TOKEN_KEY = "union_auth_token"
+# cookie con l'id di sessione firmato (session_store.py)
+SESSION_COOKIE_KEY = "union_session"
+
+NO_DATA_CAPTION = "Dati non disponibili al momento (API lenta o non raggiungibile)."
+
+HIDE_DF_TOOLBAR_CSS = """
+<style>
+/* Toolbar “overlay” (download/search/fullscreen) in varie versioni Streamlit */
+div[data-testid="stElementToolbar"],
+div[data-testid="stToolbar"],
+div[data-testid="stToolbarActions"],
+div[data-testid="stElementToolbarButton"],
+div[data-testid="stElementToolbarButton"] > button {
+  display: none !important;
+  visibility: hidden !important;
+  opacity: 0 !important;
+  height: 0 !important;
+}
+
+/* Variante: alcuni build usano classi diverse */
+.stElementToolbar,
+.stToolbar {
+  display: none !important;
+  visibility: hidden !important;
+}
+</style>
+"""
+
+# =========================
+# FILTRI: etichette UI -> codici API
+# =========================
+ETA_OPTIONS = [
+    "≤ 20",
+    "21–40",
+    "41–60",
+    "> 60",
+]
+
+ETA_MAP = {
+    "≤ 20": "≤20",
+    "21–40": "21-40",
+    "41–60": "41-60",
+    "> 60": ">60",
+}
+
+GG_OPTIONS = [
+    "10 o meno",
+    "11–50",
+    "51–100",
+    "101–150",
+    "151–180",
+    "Più di 180",
+]
+
+GG_MAP = {
+    "10 o meno": "≤10",
+    "11–50": "11-50",
+    "51–100": "51-100",
+    "101–150": "101-150",
+    "151–180": "151-180",
+    "Più di 180": ">180",
+}
+
+# chiavi delle risposte /auth/gg-fasce e /auth/eta-fasce -> etichette grafici
+GG_ORDER = ["10 o meno", "11–50", "51–100", "101–150", "151–180", "Più di 180"]
+
+GG_LABELS = {
+    "LE10": "10 o meno",
+    "11_50": "11–50",
+    "51_100": "51–100",
+    "101_150": "101–150",
+    "151_180": "151–180",
+    "GT180": "Più di 180",
+}
+
+ETA_ORDER = ["≤ 20", "21–40", "41–60", "> 60"]
+
+ETA_LABELS = {
+    "LE20": "≤ 20",
+    "21_40": "21–40",
+    "41_60": "41–60",
+    "GT60": "> 60",
+}
+
+# =========================
+# PALETTE UILA
+# =========================
+UILA_BLUE = "#123B7A"        # blu istituzionale
+UILA_AZURE = "#7DB7E5"       # azzurro chiaro coerente col logo
+UILA_GREEN = "#2F8F46"       # verde UILA
+UILA_GREEN_LIGHT = "#7BCB8C" # verde chiaro
+UILA_RED = "#C62828"         # rosso UILA, da usare come accento
+UILA_RED_LIGHT = "#E57373"   # rosso chiaro
+
+# =========================
+# COLORI FISSI GRAFICI
+# =========================
+SEX_COLOR_MAP = {
+    "Maschi": UILA_AZURE,
+    "Femmine": UILA_BLUE,
+}
+
+NAT_COLOR_MAP = {
+    "Italiani": UILA_GREEN,
+    "Esteri": UILA_BLUE,
+}
+
+GG_COLOR_MAP = {
+    "10 o meno": UILA_AZURE,
+    "11–50": "#5FA6DD",
+    "51–100": UILA_BLUE,
+    "101–150": "#4F8F3A",
+    "151–180": UILA_GREEN,
+    "Più di 180": UILA_RED,
+}
+
+ETA_COLOR_MAP = {
+    "≤ 20": UILA_AZURE,
+    "21–40": UILA_GREEN_LIGHT,
+    "41–60": UILA_GREEN,
+    "> 60": UILA_RED,
+}
+
+TREND_COLOR_MAP = {
+    **SEX_COLOR_MAP,
+    **NAT_COLOR_MAP,
+    **ETA_COLOR_MAP,
+    **GG_COLOR_MAP,
+    "Totale braccianti": UILA_BLUE,
+    "Totale giornate": UILA_GREEN,
+}
+
+# =========================
+# CONFRONTO ANNUALE
+# =========================
+TREND_OPTIONS = {
+    "Totale braccianti negli anni (nazionale)": {
+        "metrica": "tot_braccianti",
+        "apply_geo": False,
+        "title": "Totale braccianti negli anni",
+    },
+    "Totale giornate lavorate negli anni (nazionale)": {
+        "metrica": "tot_gg",
+        "apply_geo": False,
+        "title": "Totale giornate lavorate negli anni",
+    },
+    "Totale braccianti negli anni (con filtri geografici)": {
+        "metrica": "tot_braccianti",
+        "apply_geo": True,
+        "title": "Totale braccianti negli anni — filtri geografici",
+    },
+    "Totale giornate lavorate negli anni (con filtri geografici)": {
+        "metrica": "tot_gg",
+        "apply_geo": True,
+        "title": "Totale giornate lavorate negli anni — filtri geografici",
+    },
+    "Maschi e femmine negli anni": {
+        "metrica": "sex_count",
+        "apply_geo": True,
+        "title": "Lavoratori per sesso negli anni",
+    },
+    "Giornate lavorate per sesso negli anni": {
+        "metrica": "sex_gg",
+        "apply_geo": True,
+        "title": "Giornate lavorate per sesso negli anni",
+    },
+    "Italiani ed esteri negli anni": {
+        "metrica": "nat_count",
+        "apply_geo": True,
+        "title": "Lavoratori italiani vs esteri negli anni",
+    },
+    "Giornate lavorate italiani vs esteri negli anni": {
+        "metrica": "nat_gg",
+        "apply_geo": True,
+        "title": "Giornate lavorate italiani vs esteri negli anni",
+    },
+    "Fasce d'età negli anni": {
+        "metrica": "eta_count",
+        "apply_geo": True,
+        "title": "Distribuzione fasce d'età negli anni",
+    },
+    "Fasce giornate lavorate negli anni": {
+        "metrica": "ggfasce_count",
+        "apply_geo": True,
+        "title": "Distribuzione giornate lavorate negli anni",
+    },
+}
@@ -0,0 +1,230 @@
+import functools
+import inspect
+import pickle
+import threading
+import time
+
+from collections import OrderedDict
+
+import streamlit as st
+
+from streamlit.logger import get_logger
+
+from lkg_store import canonical_key
+
+# =========================
+# CACHE L1 LIMITATA (per processo)
+# =========================
+# st.cache_data non ha limiti in byte e senza max_entries cresce per tutta la
+# giornata (una voce per ogni combinazione di filtri). Qui ogni fetcher ha la sua
+# politica: TTL, numero massimo di voci, budget in byte ed eviction LRU o LFU.
+# Come il FacetStore, i valori sono condivisi tra le sessioni: sola lettura.
+
+MB = 1024 * 1024
+CACHE_REPORT_EVERY_S = 300
+# LFU con invecchiamento: ogni LFU_AGING_PERIOD x max_entries accessi i contatori
+# d'uso si dimezzano, così le voci molto usate in passato non occupano la cache
+# per sempre e quelle nuove possono superarle
+LFU_AGING_PERIOD = 10
+
+# logger di Streamlit: stesso livello/formato del resto dei log del worker
+log = get_logger(__name__)
+
+
+class CachePolicy:
+    __slots__ = ("ttl", "max_entries", "max_bytes", "evict")
+
+    def __init__(self, ttl: float, max_entries: int, max_bytes: int, evict: str = "lru"):
+        if evict not in ("lru", "lfu"):
+            raise ValueError(f"eviction non supportata: {evict}")
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.evict = evict
+
+
+class BoundedCache:
+    def __init__(self, name: str, policy: CachePolicy):
+        self.name = name
+        self.policy = policy
+        self._lock = threading.Lock()
+        # chiave -> [scadenza, valore, byte, uso]
+        self._entries = OrderedDict()
+        self._building = {}
+        self._accesses = 0
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _fresh(self, key, now):
+        hit = self._entries.get(key)
+        if hit is None:
+            return None
+        if hit[0] <= now:
+            self._drop(key)
+            return None
+        hit[3] += 1
+        self._entries.move_to_end(key)
+        self._age()
+        return hit
+
+    def _age(self):
+        if self.policy.evict != "lfu":
+            return
+        self._accesses += 1
+        if self._accesses >= LFU_AGING_PERIOD * self.policy.max_entries:
+            self._accesses = 0
+            for entry in self._entries.values():
+                entry[3] //= 2
+
+    def _drop(self, key):
+        entry = self._entries.pop(key)
+        self.bytes -= entry[2]
+
+    def _victim(self, keep=None):
+        if self.policy.evict == "lfu":
+            # meno usata; a parità, la meno recente (ordine dell'OrderedDict). Mai
+            # la voce appena inserita: con uso 1 uscirebbe sempre lei per prima
+            others = (k for k in self._entries if k != keep)
+            return min(others, key=lambda k: self._entries[k][3], default=keep)
+        return next(iter(self._entries))
+
+    def _evict(self, keep=None):
+        now = time.monotonic()
+        for k in [k for k, e in self._entries.items() if e[0] <= now]:
+            self._drop(k)
+        while self._entries and (
+            len(self._entries) > self.policy.max_entries or self.bytes > self.policy.max_bytes
+        ):
+            self._drop(self._victim(keep))
+            self.evictions += 1
+
+    def get(self, key: str, loader):
+        with self._lock:
+            hit = self._fresh(key, time.monotonic())
+            if hit is not None:
+                self.hits += 1
+                return hit[1]
+            build_lock = self._building.setdefault(key, threading.Lock())
+
+        # una sola chiamata per chiave anche con molte sessioni in parallelo
+        with build_lock:
+            with self._lock:
+                hit = self._fresh(key, time.monotonic())
+                if hit is not None:
+                    self.hits += 1
+                    return hit[1]
+                self.misses += 1
+            try:
+                value = loader()
+            finally:
+                with self._lock:
+                    self._building.pop(key, None)
+            self.put(key, value)
+        return value
+
+    def peek(self, key: str):
+        # valore in cache o None, senza mai chiamare il fetcher
+        with self._lock:
+            hit = self._fresh(key, time.monotonic())
+            return None if hit is None else hit[1]
+
+    def put(self, key: str, value):
+        size = len(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL))
+        with self._lock:
+            if size <= self.policy.max_bytes:
+                if key in self._entries:
+                    self._drop(key)
+                self._entries[key] = [time.monotonic() + self.policy.ttl, value, size, 1]
+                self.bytes += size
+                self._age()
+                self._evict(keep=key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+    def report(self):
+        with self._lock:
+            return {
+                "fetcher": self.name,
+                "voci": len(self._entries),
+                "max_voci": self.policy.max_entries,
+                "kb": round(self.bytes / 1024, 1),
+                "max_kb": round(self.policy.max_bytes / 1024),
+                "eviction": self.policy.evict,
+                "hit": self.hits,
+                "miss": self.misses,
+                "evicted": self.evictions,
+            }
+
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+def _cache_for(name: str, policy: CachePolicy) -> BoundedCache:
+    with _registry_lock:
+        cache = _registry.get(name)
+        if cache is None:
+            cache = _registry[name] = BoundedCache(name, policy)
+        return cache
+
+def bounded_cache(policy: CachePolicy):
+    # al posto di @st.cache_data: i parametri che iniziano con "_" (il token) non
+    # entrano nella chiave; fn(_tok, scope, *args) -> chiave = nome + scope + args
+    def deco(fn):
+        params = list(inspect.signature(fn).parameters)
+        skip = {i for i, p in enumerate(params) if p.startswith("_")}
+        cache = _cache_for(fn.__name__, policy)
+
+        def key_for(args):
+            key_args = [a for i, a in enumerate(args) if i not in skip]
+            return canonical_key(fn.__name__, key_args[0] if key_args else "", tuple(key_args[1:]))
+
+        @functools.wraps(fn)
+        def wrapper(*args):
+            return cache.get(key_for(args), lambda: fn(*args))
+
+        def prime(value, *args):
+            # risultato già noto (vista salvata): stessi argomenti della chiamata, token compreso
+            cache.put(key_for(args), value)
+
+        def cached(*args):
+            # solo se già in cache (export dei dati mostrati): None altrimenti
+            return cache.peek(key_for(args))
+
+        wrapper.cache = cache
+        wrapper.prime = prime
+        wrapper.cached = cached
+        return wrapper
+    return deco
+
+def clear_all():
+    with _registry_lock:
+        caches = list(_registry.values())
+    for cache in caches:
+        cache.clear()
+
+def cache_report():
+    with _registry_lock:
+        caches = list(_registry.values())
+    return [c.report() for c in sorted(caches, key=lambda c: c.name)]
+
+# report periodico nel log del worker, per seguire la memoria nel tempo
+@st.cache_resource
+def start_cache_reporter(every_s: float = CACHE_REPORT_EVERY_S):
+    def _loop():
+        while True:
+            time.sleep(every_s)
+            rows = cache_report()
+            total_kb = sum(r["kb"] for r in rows)
+            log.info(
+                "cache L1: %.0f KB totali — %s",
+                total_kb,
+                ", ".join(f"{r['fetcher']} {r['voci']}/{r['max_voci']} voci {r['kb']:.0f} KB" for r in rows),
+            )
+    t = threading.Thread(target=_loop, name="cache-reporter", daemon=True)
+    t.start()
+    return t
@@ -0,0 +1,279 @@
+import argparse
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, UTC
+
+import streamlit as st
+
+from api_client import api_get
+from app_config import TREND_OPTIONS
+from fetchers import (
+    canonical_params,
+    profile_scope,
+    get_anni_inserimento,
+    get_regioni,
+    get_gg_fasce,
+    get_eta_fasce,
+    get_stats_sex,
+    get_stats_nat,
+    get_trend_annuale,
+    get_cube,
+    cached_count,
+)
+from lkg_store import canonical_key, get_lkg_store
+
+# =========================
+# CACHE WARMER (dopo ogni import)
+# =========================
+# Ripassa nei fetcher in cache le viste più usate (registrate dalla UI in SQLite)
+# più una lista configurata per regione, con concorrenza limitata, così i primi
+# utenti dopo un import non pagano tutte le query a freddo.
+#
+# Solo per lo scope del token usato: ogni profilo vede i dati filtrati dal
+# backend in base al proprio token, quindi un warm con il token admin riempie
+# solo le voci admin (le viste salvate degli altri profili si ricalcolano con
+# il token di un utente dello stesso scope, saved_views.py).
+#
+# Dentro l'app parte da solo quando lo stato dell'import diventa "done".
+# Da riga di comando (processo separato) scalda il backend, la cache L2 condivisa
+# (quindi tutti i worker) e la copia LKG su disco, un profilo per token:
+#
+#   python -m cache_warmer --token <token> --top 50 --concurrency 4
+
+USAGE_DB = os.getenv("USAGE_DB", os.path.join(tempfile.gettempdir(), "gestionale_ui_usage.sqlite"))
+USAGE_WINDOW_DAYS = 14
+WARM_TOP_N = int(os.getenv("WARM_TOP_N", "50"))
+WARM_CONCURRENCY = int(os.getenv("WARM_CONCURRENCY", "4"))
+# JSON {"LAZIO": [{"anno_ins": "latest"}, {"anno_ins": "latest", "sesso": "F"}], "*": [...]}
+# "*" = vista senza filtro regione; "latest" = anno di inserimento più recente
+WARM_VIEWS_FILE = os.getenv("WARM_VIEWS_FILE", "")
+
+LATEST = "latest"
+GEO_KEYS = ("regione", "provincia", "comune")
+
+DEFAULT_TREND = next(iter(TREND_OPTIONS.values()))
+
+
+def make_view(params: dict, metrica: str, apply_geo: bool, latest_anno=None, cube: bool = False) -> str:
+    # l'anno di default (il più recente) viene salvato come "latest": dopo un
+    # import con un anno nuovo la vista si riferisce al nuovo anno. Nessun anno
+    # scelto (= tutti) è una lista vuota esplicita: senza la chiave la vista si
+    # riaprirebbe sull'anno più recente, come quelle salvate prima
+    p = dict(params)
+    if not p.get("anno_ins"):
+        p["anno_ins"] = []
+    elif latest_anno is not None and p["anno_ins"] == [latest_anno]:
+        p["anno_ins"] = LATEST
+    view = {"params": p, "metrica": metrica, "apply_geo": bool(apply_geo), "cube": bool(cube)}
+    return json.dumps(view, sort_keys=True, ensure_ascii=False, default=str)
+
+# =========================
+# USO (SQLite, condiviso tra i processi)
+# =========================
+class UsageLog:
+    def __init__(self, path: str = USAGE_DB):
+        self.path = path
+        with self._connect() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS views ("
+                " scope TEXT NOT NULL, view TEXT NOT NULL,"
+                " hits INTEGER NOT NULL, last_seen REAL NOT NULL,"
+                " PRIMARY KEY (scope, view))"
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=2)
+
+    def record(self, scope: str, view: str):
+        # mai bloccare la pagina per una statistica
+        try:
+            with self._connect() as db:
+                db.execute(
+                    "INSERT INTO views (scope, view, hits, last_seen) VALUES (?, ?, 1, ?) "
+                    "ON CONFLICT (scope, view) DO UPDATE SET hits = hits + 1, last_seen = excluded.last_seen",
+                    (scope, view, time.time()),
+                )
+        except sqlite3.Error:
+            pass
+
+    def top(self, scope: str, n: int, window_days: int = USAGE_WINDOW_DAYS):
+        cutoff = time.time() - window_days * 86400
+        try:
+            with self._connect() as db:
+                db.execute("DELETE FROM views WHERE last_seen < ?", (cutoff,))
+                rows = db.execute(
+                    "SELECT scope, view, hits FROM views WHERE scope = ?"
+                    " ORDER BY hits DESC, last_seen DESC LIMIT ?",
+                    (scope, n),
+                ).fetchall()
+        except sqlite3.Error:
+            return []
+        return [(scope, json.loads(view), hits) for scope, view, hits in rows]
+
+
+@st.cache_resource
+def get_usage_log():
+    return UsageLog()
+
+# =========================
+# PIANO: viste -> chiamate ai fetcher
+# =========================
+def _resolve_params(params: dict, latest_anno) -> dict:
+    p = dict(params)
+    if p.get("anno_ins") == LATEST:
+        if latest_anno is None:
+            p.pop("anno_ins")
+        else:
+            p["anno_ins"] = [latest_anno]
+    elif p.get("anno_ins") == []:
+        # tutti gli anni: la pagina non manda il filtro
+        p.pop("anno_ins")
+    return canonical_params(p)
+
+def view_tasks(scope: str, view: dict, latest_anno) -> list:
+    # stesse chiamate (e stessi argomenti) che fa la UI per questa vista; l'incrocio
+    # età x giornate no: la pagina lo chiede solo a sezione aperta
+    params = _resolve_params(view.get("params") or {}, latest_anno)
+    geo = canonical_params({k: params[k] for k in GEO_KEYS if params.get(k)})
+    apply_geo = bool(view.get("apply_geo"))
+    tasks = [
+        (fn, (scope, params))
+        for fn in (cached_count, get_stats_sex, get_stats_nat, get_gg_fasce, get_eta_fasce)
+    ]
+    tasks.append((get_trend_annuale, (scope, view.get("metrica") or DEFAULT_TREND["metrica"], apply_geo, geo if apply_geo else {})))
+    if view.get("cube"):
+        tasks.append((get_cube, (scope, geo)))
+    return tasks
+
+def _default_view(params: dict) -> dict:
+    return {"params": params, "metrica": DEFAULT_TREND["metrica"], "apply_geo": DEFAULT_TREND["apply_geo"]}
+
+def configured_views(tok: str, scope: str) -> list:
+    # dal file WARM_VIEWS_FILE se c'è, altrimenti: nazionale + ogni regione,
+    # anno più recente e trend di default
+    if WARM_VIEWS_FILE:
+        with open(WARM_VIEWS_FILE, encoding="utf-8") as f:
+            cfg = json.load(f)
+        views = []
+        for reg, entries in cfg.items():
+            for params in entries:
+                p = dict(params)
+                if reg != "*":
+                    p["regione"] = [reg.upper()]
+                views.append(_default_view(p))
+        return views
+
+    views = [_default_view({"anno_ins": LATEST})]
+    for reg, _ in get_regioni(tok, scope):
+        views.append(_default_view({"regione": [reg], "anno_ins": LATEST}))
+    return views
+
+def plan(tok: str, scope: str, top_n: int = WARM_TOP_N) -> list:
+    anni = get_anni_inserimento(tok, scope)
+    latest_anno = anni[0][0] if anni else None
+
+    # solo le viste dello scope del token: gli altri profili si scaldano con il
+    # proprio token (viste salvate) o alla prima visita
+    views = configured_views(tok, scope)
+    views += [v for _, v, _ in get_usage_log().top(scope, top_n)]
+
+    tasks = {}
+    for view in views:
+        for fn, args in view_tasks(scope, view, latest_anno):
+            tasks.setdefault(canonical_key(fn.__name__, scope, args), (fn, args))
+    return list(tasks.values())
+
+# =========================
+# ESECUZIONE
+# =========================
+def warm(tok: str, scope: str, top_n: int = WARM_TOP_N, concurrency: int = WARM_CONCURRENCY):
+    # tok deve appartenere a scope: le voci L1/L2/LKG sono indicizzate per scope,
+    # scriverci risultati ottenuti con un altro token (es. admin sotto lo scope di
+    # un utente regionale) li servirebbe a chi non dovrebbe vederli
+    t0 = time.monotonic()
+    tasks = plan(tok, scope, top_n)
+    store = get_lkg_store()
+
+    def run(fn, args):
+        data = fn(tok, *args)
+        store.save(fn.__name__, args[0], args, data, force=True)
+
+    ok = 0
+    errors = []
+    with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="cache-warm") as pool:
+        futures = [(fn.__name__, pool.submit(run, fn, args)) for fn, args in tasks]
+        for name, fut in futures:
+            try:
+                fut.result()
+                ok += 1
+            except Exception as e:
+                errors.append(f"{name}: {e}")
+
+    return {
+        "finished_at": datetime.now(UTC).isoformat(),
+        "tasks": len(tasks),
+        "ok": ok,
+        "failed": len(errors),
+        "errors": errors[:10],
+        "elapsed_s": round(time.monotonic() - t0, 2),
+    }
+
+
+class CacheWarmer:
+    # un solo warm alla volta per processo, in un thread di background
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+        self.last = None
+
+    def running(self) -> bool:
+        with self._lock:
+            return self._thread is not None and self._thread.is_alive()
+
+    def start(self, tok: str, scope: str, reason: str = "") -> bool:
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return False
+            self._thread = threading.Thread(
+                target=self._run, args=(tok, scope, reason), name="cache-warmer", daemon=True
+            )
+            self._thread.start()
+            return True
+
+    def _run(self, tok, scope, reason):
+        try:
+            report = warm(tok, scope)
+        except Exception as e:
+            report = {"finished_at": datetime.now(UTC).isoformat(), "failed": 1, "errors": [str(e)]}
+        report["reason"] = reason
+        self.last = report
+
+
+@st.cache_resource
+def get_cache_warmer():
+    return CacheWarmer()
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Preriscalda le viste più usate della dashboard")
+    ap.add_argument("--token", default=os.getenv("WARM_TOKEN", ""), help="token del profilo da scaldare (default: $WARM_TOKEN)")
+    ap.add_argument("--top", type=int, default=WARM_TOP_N, help="viste più usate da ripassare")
+    ap.add_argument("--concurrency", type=int, default=WARM_CONCURRENCY, help="richieste in parallelo")
+    args = ap.parse_args()
+
+    if not args.token:
+        ap.error("serve un token (--token o WARM_TOKEN)")
+
+    scope = profile_scope(api_get("/auth/whoami", args.token))
+    report = warm(args.token, scope, top_n=args.top, concurrency=args.concurrency)
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+import pandas as pd
+import plotly.express as px
+
+from app_config import (
+    GG_ORDER,
+    GG_LABELS,
+    ETA_ORDER,
+    ETA_LABELS,
+    SEX_COLOR_MAP,
+    NAT_COLOR_MAP,
+    GG_COLOR_MAP,
+    ETA_COLOR_MAP,
+    TREND_COLOR_MAP,
+    UILA_BLUE,
+)
+
+# =========================
+# GRAFICI (figure plotly, senza Streamlit)
+# =========================
+# Stesse figure delle sezioni "Statistiche" e "Confronto annuale": le usa la
+# pagina (st.plotly_chart) e il render dei report offline (tools/render_reports.py).
+# None = niente da disegnare con questi dati.
+
+def _pie(base, values, color_map: dict, title: str, ordered: bool = False):
+    df = pd.DataFrame({"CategoriaBase": base, "Valore": values})
+
+    df["CategoriaLabel"] = df.apply(
+        lambda r: f"{r['CategoriaBase']} ({int(r['Valore']):,})", axis=1
+    )
+
+    color_map_labels = {
+        row["CategoriaLabel"]: color_map[row["CategoriaBase"]]
+        for _, row in df.iterrows()
+    }
+
+    extra = {"category_orders": {"CategoriaLabel": df["CategoriaLabel"].tolist()}} if ordered else {}
+    fig = px.pie(
+        df,
+        names="CategoriaLabel",
+        values="Valore",
+        color="CategoriaLabel",
+        color_discrete_map=color_map_labels,
+        hole=0.4,
+        title=title,
+        custom_data=["CategoriaBase"],
+        **extra,
+    )
+
+    fig.update_traces(
+        texttemplate="%{customdata[0]}<br>%{percent}",
+        textinfo="none"
+    )
+    return fig
+
+def _distribution(js: dict, labels: dict, order: list, color_map: dict, title: str):
+    total = js.get("total", 0)
+    counts = js.get("counts", {}) or {}
+
+    data_map = {labels[k]: int(v) for k, v in counts.items() if int(v or 0) > 0}
+    ordered_labels = [label for label in order if label in data_map]
+
+    if total == 0 or not ordered_labels:
+        return None
+    return _pie(ordered_labels, [data_map[label] for label in ordered_labels], color_map, title, ordered=True)
+
+# =========================
+# STATISTICHE
+# =========================
+def fig_sex_count(sex_stats: dict):
+    return _pie(
+        ["Maschi", "Femmine"], [sex_stats["count"]["M"], sex_stats["count"]["F"]],
+        SEX_COLOR_MAP, "Lavoratori per sesso",
+    )
+
+def fig_sex_gg(sex_stats: dict):
+    return _pie(
+        ["Maschi", "Femmine"], [sex_stats["gg_tot"]["M"], sex_stats["gg_tot"]["F"]],
+        SEX_COLOR_MAP, "Giornate lavorate per sesso (GG TOT)",
+    )
+
+def fig_nat_count(nat_stats: dict):
+    return _pie(
+        ["Italiani", "Esteri"], [nat_stats["count"]["ITALIANI"], nat_stats["count"]["ESTERI"]],
+        NAT_COLOR_MAP, "Lavoratori italiani vs esteri",
+    )
+
+def fig_nat_gg(nat_stats: dict):
+    return _pie(
+        ["Italiani", "Esteri"], [nat_stats["gg_tot"]["ITALIANI"], nat_stats["gg_tot"]["ESTERI"]],
+        NAT_COLOR_MAP, "Giornate lavorate italiani vs esteri (GG TOT)",
+    )
+
+def fig_gg_fasce(gg_js: dict):
+    return _distribution(gg_js, GG_LABELS, GG_ORDER, GG_COLOR_MAP, "Distribuzione giornate lavorate (GG TOT)")
+
+def fig_eta_fasce(eta_js: dict):
+    return _distribution(eta_js, ETA_LABELS, ETA_ORDER, ETA_COLOR_MAP, "Distribuzione fasce d'età")
+
+def fig_eta_gg(items: list, measure: str, measure_label: str):
+    # heatmap fascia d'età x fascia giornate dalle righe di /auth/eta-gg-fasce
+    df = pd.DataFrame(items, columns=["eta_fascia", "gg_fascia", "count", "gg_tot"])
+    if df.empty or not df[measure].sum():
+        return None
+    df["Età"] = pd.Categorical(df["eta_fascia"].map(ETA_LABELS), categories=ETA_ORDER)
+    df["Giornate"] = pd.Categorical(df["gg_fascia"].map(GG_LABELS), categories=GG_ORDER)
+    # griglia completa 4 x 6 nell'ordine delle fasce, celle senza righe a zero
+    grid = df.pivot_table(
+        index="Età", columns="Giornate", values=measure, aggfunc="sum", observed=False, fill_value=0
+    )
+    fig = px.imshow(
+        grid,
+        text_auto=True,
+        aspect="auto",
+        color_continuous_scale=[[0, "#FFFFFF"], [1, UILA_BLUE]],
+        labels={"x": "Giornate lavorate", "y": "Fascia d'età", "color": measure_label},
+        title=f"Fasce d'età per giornate lavorate — {measure_label}",
+    )
+    fig.update_xaxes(side="bottom")
+    return fig
+
+# (nome, dato di partenza, builder) nell'ordine della pagina: due grafici per riga
+STATS_CHARTS = [
+    ("fig1", "sex", fig_sex_count),
+    ("fig2", "sex", fig_sex_gg),
+    ("fig3", "nat", fig_nat_count),
+    ("fig4", "nat", fig_nat_gg),
+    ("fig_gg", "gg", fig_gg_fasce),
+    ("fig_eta", "eta", fig_eta_fasce),
+]
+
+def small_multiple(fig, title: str):
+    # versione compatta per la griglia del confronto tra regioni
+    fig.update_layout(title=title, height=260, showlegend=False, margin=dict(l=10, r=10, t=40, b=10))
+    return fig
+
+# =========================
+# CONFRONTO ANNUALE
+# =========================
+def fig_trend(trend_js: dict, cfg: dict):
+    df_trend = pd.DataFrame((trend_js or {}).get("items", []))
+    if df_trend.empty:
+        return None
+
+    fig = px.line(
+        df_trend,
+        x="anno",
+        y="valore",
+        color="serie",
+        markers=True,
+        title=cfg["title"],
+        color_discrete_map=TREND_COLOR_MAP,
+    )
+
+    fig.update_layout(
+        xaxis_title="Anno",
+        yaxis_title="Valore",
+        legend_title="Serie",
+        hovermode="x unified",
+    )
+    return fig
+
+def trend_caption(cfg: dict) -> str:
+    if cfg["apply_geo"]:
+        return "Questo grafico considera solo i filtri Regione / Provincia / Comune."
+    return "Questo grafico ignora tutti i filtri e mostra il dato nazionale."
+
+# =========================
+# MAPPA
+# =========================
+# geometrie da geo_shapes.py (niente tile né topojson scaricati dal browser):
+# si inquadrano solo le aree con dati
+MAP_COLOR_SCALE = "YlOrRd"
+
+def _map_layout(fig):
+    fig.update_geos(fitbounds="locations", visible=False)
+    fig.update_layout(height=560, margin=dict(l=0, r=0, t=40, b=0))
+    return fig
+
+def fig_map(fc: dict, ids: list, values: list, metric_label: str, title: str):
+    if not ids:
+        return None
+    df = pd.DataFrame({"Area": ids, metric_label: values})
+    fig = px.choropleth(
+        df,
+        geojson=fc,
+        locations="Area",
+        featureidkey="id",
+        color=metric_label,
+        hover_name="Area",
+        color_continuous_scale=MAP_COLOR_SCALE,
+        title=title,
+    )
+    fig.update_traces(marker_line_width=0.3, marker_line_color="#888888")
+    return _map_layout(fig)
+
+def fig_map_points(base_fc: dict, ids: list, lon: list, lat: list, values: list, metric_label: str, title: str):
+    # un punto per area (centroide), sopra i confini di base in grigio
+    if not ids:
+        return None
+    df = pd.DataFrame({"Area": ids, "lon": lon, "lat": lat, metric_label: values})
+    fig = px.scatter_geo(
+        df,
+        lon="lon",
+        lat="lat",
+        color=metric_label,
+        size=metric_label,
+        size_max=14,
+        hover_name="Area",
+        hover_data={"lon": False, "lat": False},
+        color_continuous_scale=MAP_COLOR_SCALE,
+        title=title,
+    )
+    if base_fc and base_fc["features"]:
+        base_ids = [f["id"] for f in base_fc["features"]]
+        fig.add_choropleth(
+            geojson=base_fc,
+            locations=base_ids,
+            featureidkey="id",
+            z=[0] * len(base_ids),
+            colorscale=[[0, "#f0f0f0"], [1, "#f0f0f0"]],
+            showscale=False,
+            hoverinfo="skip",
+            marker_line_color="#bbbbbb",
+            marker_line_width=0.5,
+        )
+        # i confini sotto i punti
+        fig.data = (fig.data[-1],) + fig.data[:-1]
+    return _map_layout(fig)
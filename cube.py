@@ -0,0 +1,170 @@
+import numpy as np
+import pandas as pd
+
+# =========================
+# CUBO LOCALE (drill-down client-side)
+# =========================
+# Una sola tabella pre-aggregata per lo scope geografico corrente:
+# count e gg_tot per (anno, sesso, nato_estero, eta_fascia, gg_fascia).
+# Tutti i filtri non geografici diventano maschere vettoriali su poche migliaia
+# di righe, e i risultati hanno la stessa forma delle risposte API
+# (/auth/count, /auth/stats-*, /auth/gg-fasce, /auth/eta-fasce).
+
+CUBE_DIMS = ["anno", "sesso", "nato_estero", "eta_fascia", "gg_fascia"]
+CUBE_MEASURES = ["count", "gg_tot"]
+
+# filtri che il cubo non sa rispondere: in quel caso si torna alle query backend
+CUBE_UNSUPPORTED_PARAMS = ("prov_nascita", "com_nascita")
+
+# codici filtro (come in params) -> chiavi delle risposte API
+GG_CODE_TO_KEY = {
+    "≤10": "LE10",
+    "11-50": "11_50",
+    "51-100": "51_100",
+    "101-150": "101_150",
+    "151-180": "151_180",
+    ">180": "GT180",
+}
+ETA_CODE_TO_KEY = {
+    "≤20": "LE20",
+    "21-40": "21_40",
+    "41-60": "41_60",
+    ">60": "GT60",
+}
+
+
+def cube_params(params: dict) -> dict:
+    # "Estero" manda prov_nascita=EE insieme a nato_estero=True: stesso insieme
+    # di righe, quindi prov_nascita si può togliere e il cubo risponde
+    provs = [str(p).upper() for p in params.get("prov_nascita") or []]
+    if provs == ["EE"] and params.get("nato_estero") is True:
+        return {k: v for k, v in params.items() if k != "prov_nascita"}
+    return params
+
+def cube_supports(params: dict) -> bool:
+    p = cube_params(params)
+    return not any(p.get(k) for k in CUBE_UNSUPPORTED_PARAMS)
+
+def build_cube_frame(items: list) -> pd.DataFrame:
+    df = pd.DataFrame(items, columns=CUBE_DIMS + CUBE_MEASURES)
+    df["anno"] = pd.to_numeric(df["anno"], errors="coerce").astype("Int64")
+    df["sesso"] = df["sesso"].astype("category")
+    df["nato_estero"] = df["nato_estero"].astype(bool)
+    df["eta_fascia"] = pd.Categorical(df["eta_fascia"], categories=list(ETA_CODE_TO_KEY))
+    df["gg_fascia"] = pd.Categorical(df["gg_fascia"], categories=list(GG_CODE_TO_KEY))
+    for m in CUBE_MEASURES:
+        df[m] = pd.to_numeric(df[m], errors="coerce").fillna(0).astype(np.int64)
+    return df
+
+def slice_cube(df: pd.DataFrame, params: dict) -> pd.DataFrame:
+    mask = np.ones(len(df), dtype=bool)
+
+    if params.get("sesso"):
+        mask &= (df["sesso"] == params["sesso"]).to_numpy()
+    if "nato_estero" in params:
+        mask &= (df["nato_estero"] == bool(params["nato_estero"])).to_numpy()
+    if params.get("anno_ins"):
+        anni = [int(a) for a in params["anno_ins"]]
+        mask &= df["anno"].isin(anni).to_numpy(dtype=bool, na_value=False)
+    if params.get("eta_fascia"):
+        mask &= df["eta_fascia"].isin(params["eta_fascia"]).to_numpy()
+    if params.get("gg_fascia"):
+        mask &= df["gg_fascia"].isin(params["gg_fascia"]).to_numpy()
+
+    return df[mask]
+
+def _sum_by(df: pd.DataFrame, dim: str) -> pd.DataFrame:
+    return df.groupby(dim, observed=False)[CUBE_MEASURES].sum()
+
+def cube_count(df: pd.DataFrame) -> dict:
+    return {
+        "total": int(df["count"].sum()),
+        "total_gg": int(df["gg_tot"].sum()),
+    }
+
+def cube_stats_sex(df: pd.DataFrame) -> dict:
+    g = _sum_by(df, "sesso")
+    return {
+        m: {s: int(g[m].get(s, 0)) for s in ("M", "F")}
+        for m in CUBE_MEASURES
+    }
+
+def cube_stats_nat(df: pd.DataFrame) -> dict:
+    g = _sum_by(df, "nato_estero")
+    return {
+        m: {
+            "ITALIANI": int(g[m].get(False, 0)),
+            "ESTERI": int(g[m].get(True, 0)),
+        }
+        for m in CUBE_MEASURES
+    }
+
+def cube_gg_fasce(df: pd.DataFrame) -> dict:
+    g = _sum_by(df, "gg_fascia")["count"]
+    return {
+        "total": int(df["count"].sum()),
+        "counts": {key: int(g.get(code, 0)) for code, key in GG_CODE_TO_KEY.items()},
+    }
+
+def cube_eta_fasce(df: pd.DataFrame) -> dict:
+    g = _sum_by(df, "eta_fascia")["count"]
+    return {
+        "total": int(df["count"].sum()),
+        "counts": {key: int(g.get(code, 0)) for code, key in ETA_CODE_TO_KEY.items()},
+    }
+
+def cube_eta_gg_fasce(df: pd.DataFrame) -> list:
+    # stessa forma di /auth/eta-gg-fasce (celle vuote escluse)
+    g = df.groupby(["eta_fascia", "gg_fascia"], observed=True)[CUBE_MEASURES].sum().reset_index()
+    return [
+        {
+            "eta_fascia": ETA_CODE_TO_KEY[eta],
+            "gg_fascia": GG_CODE_TO_KEY[gg],
+            "count": int(count),
+            "gg_tot": int(gg_tot),
+        }
+        for eta, gg, count, gg_tot in g.itertuples(index=False)
+        if count
+    ]
+
+# =========================
+# STIME (risultati progressivi)
+# =========================
+# Con filtri di nascita il cubo non è esatto, ma basta per una stima immediata:
+# slice senza i filtri di nascita, poi i totali vengono scalati per la quota di
+# nati nelle province/comuni scelti (dai count dei facet, assumendo indipendenza).
+
+def estimate_params(params: dict) -> dict:
+    p = {k: v for k, v in params.items() if k not in CUBE_UNSUPPORTED_PARAMS}
+    provs = params.get("prov_nascita") or []
+    if provs and "nato_estero" not in p:
+        # solo EE -> esteri, nessun EE -> italiani
+        is_ee = [str(x).upper() == "EE" for x in provs]
+        if all(is_ee):
+            p["nato_estero"] = True
+        elif not any(is_ee):
+            p["nato_estero"] = False
+    return p
+
+def birth_fraction(params: dict, prov_n_items, com_n_items) -> float:
+    f = 1.0
+    provs = set(params.get("prov_nascita") or [])
+    if provs and prov_n_items:
+        implied = estimate_params(params).get("nato_estero")
+        group = [(p, n) for p, n in prov_n_items if implied is None or (str(p).upper() == "EE") == implied]
+        tot = sum(n for _, n in group)
+        if tot:
+            f *= sum(n for p, n in group if p in provs) / tot
+    comuni = set(params.get("com_nascita") or [])
+    if comuni and com_n_items:
+        tot = sum(n for _, n in com_n_items)
+        if tot:
+            f *= sum(n for c, n in com_n_items if c in comuni) / tot
+    return f
+
+def scale_estimate(js, factor: float):
+    if isinstance(js, dict):
+        return {k: scale_estimate(v, factor) for k, v in js.items()}
+    if isinstance(js, (int, np.integer)) and not isinstance(js, bool):
+        return int(round(int(js) * factor))
+    return js
@@ -0,0 +1,123 @@
+import tempfile
+
+from datetime import datetime
+
+from app_config import GG_LABELS, ETA_LABELS, TREND_OPTIONS
+from fetchers import get_cube, get_geo_counts, get_trend_annuale
+
+# =========================
+# EXPORT DATI GRAFICI (.xlsx)
+# =========================
+# I numeri dietro i grafici della pagina, un foglio per grafico: totali, le quattro
+# statistiche, età x giornate, i confronti annuali. In più, se sono già in cache
+# (mai una chiamata al backend): gli altri confronti annuali, il cubo per anno
+# dell'area e i conteggi per provincia / comune della mappa.
+#
+# Workbook openpyxl in modalità write-only: ogni riga va subito nel file
+# temporaneo del foglio, quindi la memoria non cresce con le righe esportate
+# (anche con migliaia di comuni).
+
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+CUBE_COLUMNS = ("anno", "sesso", "nato_estero", "eta_fascia", "gg_fascia", "count", "gg_tot")
+
+
+def _filters_rows(params: dict):
+    yield ("Generato il", datetime.now().strftime("%d/%m/%Y %H:%M"))
+    if not params:
+        yield ("Filtri", "nessuno")
+    for k, v in params.items():
+        yield (k, ", ".join(str(x) for x in v) if isinstance(v, (list, tuple)) else str(v))
+
+def _pair_rows(js: dict, labels: dict):
+    for key, label in labels.items():
+        yield (label, js["count"].get(key, 0), js["gg_tot"].get(key, 0))
+
+def _fasce_rows(js: dict, labels: dict):
+    counts = js.get("counts") or {}
+    for key, label in labels.items():
+        yield (label, int(counts.get(key) or 0))
+
+def _eta_gg_rows(items: list):
+    for it in items:
+        yield (
+            ETA_LABELS.get(it["eta_fascia"], it["eta_fascia"]),
+            GG_LABELS.get(it["gg_fascia"], it["gg_fascia"]),
+            it["count"],
+            it["gg_tot"],
+        )
+
+def _trend_rows(trends: list):
+    for title, js in trends:
+        for it in js.get("items", []):
+            yield (title, it.get("anno"), it.get("serie"), it.get("valore"))
+
+def _cube_rows(items: list):
+    for it in items:
+        yield tuple(it.get(c) for c in CUBE_COLUMNS)
+
+def chart_sheets(tok: str, scope: str, data: dict):
+    # (titolo, intestazione, righe) nell'ordine della pagina; righe come generatori
+    yield "Filtri", ("Filtro", "Valore"), _filters_rows(data["params"])
+    info = data.get("count")
+    if info is not None:
+        yield "Totali", ("Misura", "Valore"), iter([
+            ("Braccianti", info["total"]),
+            ("Giornate lavorate (GG TOT)", info["total_gg"]),
+        ])
+    if data.get("sex") is not None:
+        yield "Sesso", ("Sesso", "Braccianti", "Giornate (GG TOT)"), _pair_rows(
+            data["sex"], {"M": "Maschi", "F": "Femmine"}
+        )
+    if data.get("nat") is not None:
+        yield "Italiani-Esteri", ("Nascita", "Braccianti", "Giornate (GG TOT)"), _pair_rows(
+            data["nat"], {"ITALIANI": "Italiani", "ESTERI": "Esteri"}
+        )
+    if data.get("gg") is not None:
+        yield "Fasce giornate", ("Giornate lavorate", "Braccianti"), _fasce_rows(data["gg"], GG_LABELS)
+    if data.get("eta") is not None:
+        yield "Fasce età", ("Fascia d'età", "Braccianti"), _fasce_rows(data["eta"], ETA_LABELS)
+    if data.get("eta_gg") is not None:
+        yield "Età x giornate", ("Fascia d'età", "Giornate lavorate", "Braccianti", "Giornate (GG TOT)"), \
+            _eta_gg_rows(data["eta_gg"])
+
+    # confronto scelto per primo, poi gli altri già in cache
+    geo = data["geo_params"]
+    trends = []
+    selected = data.get("trend_cfg")
+    if selected is not None and data.get("trend") is not None:
+        trends.append((selected["title"], data["trend"]))
+    for cfg in TREND_OPTIONS.values():
+        if cfg is selected:
+            continue
+        js = get_trend_annuale.cached(tok, scope, cfg["metrica"], cfg["apply_geo"], geo if cfg["apply_geo"] else {})
+        if js is not None:
+            trends.append((cfg["title"], js))
+    if trends:
+        yield "Confronto annuale", ("Confronto", "Anno", "Serie", "Valore"), _trend_rows(trends)
+
+    cube = get_cube.cached(tok, scope, geo)
+    if cube:
+        yield "Cubo per anno", CUBE_COLUMNS, _cube_rows(cube)
+    for livello, title in (("provincia", "Per provincia"), ("comune", "Per comune")):
+        counts = get_geo_counts.cached(tok, scope, livello, data["params"])
+        if counts:
+            yield title, ("Codice", "Braccianti", "Giornate (GG TOT)"), iter(counts)
+
+def write_xlsx(sheets) -> bytes:
+    from openpyxl import Workbook
+
+    wb = Workbook(write_only=True)
+    for title, header, rows in sheets:
+        ws = wb.create_sheet(title[:31])
+        ws.freeze_panes = "A2"
+        ws.append(list(header))
+        for row in rows:
+            ws.append(list(row))
+    # anche il file finale su disco: in memoria solo lo zip compresso
+    with tempfile.TemporaryFile() as f:
+        wb.save(f)
+        f.seek(0)
+        return f.read()
+
+def chart_data_xlsx(tok: str, scope: str, data: dict) -> bytes:
+    return write_xlsx(chart_sheets(tok, scope, data))
@@ -0,0 +1,213 @@
+import sys
+import threading
+import time
+import unicodedata
+
+from array import array
+from bisect import bisect_left
+from collections.abc import Sequence
+
+import streamlit as st
+
+# =========================
+# INDICE PREFISSI (typeahead facet)
+# =========================
+# Costruito una volta per lista facet (es. comuni di un insieme di province):
+# array ordinati di chiavi normalizzate + bisect. La ricerca restituisce solo i
+# primi N risultati, quindi il payload verso il browser non cresce con la lista.
+
+FACET_TOP_N = 50
+_MAX_KEY = "\uffff"
+
+
+def normalize(s: str) -> str:
+    # maiuscolo, senza accenti, spazi/apostrofi compattati: "Sant'Agata" ~ "SANT AGATA"
+    s = unicodedata.normalize("NFKD", s or "")
+    s = "".join(ch for ch in s if not unicodedata.combining(ch))
+    s = s.upper().replace("'", " ").replace("-", " ")
+    return " ".join(s.split())
+
+
+class PrefixIndex:
+    def __init__(self, items):
+        # items: lista di (valore, count)
+        self.items = list(items)
+        self.size = len(self.items)
+
+        full = []
+        words = []
+        for i, (name, _) in enumerate(self.items):
+            key = normalize(name)
+            full.append((key, i))
+            parts = key.split(" ")
+            # ogni parola interna è un punto di ingresso: "SAN" trova "CASTEL SAN PIETRO"
+            for j in range(1, len(parts)):
+                words.append((" ".join(parts[j:]), i))
+        full.sort()
+        words.sort()
+
+        self._full_keys = [k for k, _ in full]
+        self._full_ids = [i for _, i in full]
+        self._word_keys = [k for k, _ in words]
+        self._word_ids = [i for _, i in words]
+        # senza query: i più numerosi
+        self._by_count = sorted(range(self.size), key=lambda i: (-self.items[i][1], self.items[i][0]))
+
+    @staticmethod
+    def _range(keys, ids, q):
+        lo = bisect_left(keys, q)
+        hi = bisect_left(keys, q + _MAX_KEY, lo)
+        return ids[lo:hi]
+
+    def search(self, query: str, limit: int = FACET_TOP_N):
+        q = normalize(query)
+        if not q:
+            return [self.items[i] for i in self._by_count[:limit]]
+
+        # rank 0: il nome inizia con la query; rank 1: una parola interna inizia con la query
+        ranked = {}
+        for i in self._range(self._full_keys, self._full_ids, q):
+            ranked[i] = 0
+        for i in self._range(self._word_keys, self._word_ids, q):
+            ranked.setdefault(i, 1)
+
+        order = sorted(ranked, key=lambda i: (ranked[i], -self.items[i][1], self.items[i][0]))
+        return [self.items[i] for i in order[:limit]]
+
+
+# =========================
+# FACET STORE condiviso (process-wide)
+# =========================
+# Le liste facet (regioni, province, comuni, ...) vivono una sola volta nel
+# processo: nomi internati in una tupla + count in un array di int64. Le sessioni
+# ricevono lo stesso oggetto (sola lettura), senza il pickle/copia di st.cache_data.
+
+FACET_TTL_S = 600
+FACET_MAX_LISTS = 4096
+
+
+class FacetList(Sequence):
+    __slots__ = ("names", "counts", "fingerprint")
+
+    def __init__(self, names: tuple, counts: array):
+        self.names = names
+        self.counts = counts
+        # usato come chiave dell'indice di ricerca: cambia se la lista cambia
+        self.fingerprint = (len(names), sum(counts))
+
+    @classmethod
+    def from_items(cls, items):
+        names = []
+        counts = array("q")
+        for name, n in items:
+            names.append(sys.intern(name) if isinstance(name, str) else name)
+            counts.append(int(n or 0))
+        return cls(tuple(names), counts)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [(n, c) for n, c in zip(self.names[i], self.counts[i])]
+        return (self.names[i], self.counts[i])
+
+    def __iter__(self):
+        return zip(self.names, self.counts)
+
+
+class FacetStore:
+    def __init__(self, ttl: float = FACET_TTL_S, max_lists: int = FACET_MAX_LISTS):
+        self.ttl = ttl
+        self.max_lists = max_lists
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._building = {}
+
+    def _fresh(self, key, now):
+        hit = self._entries.get(key)
+        if hit is not None and hit[0] > now:
+            return hit[1]
+        return None
+
+    def get(self, key: tuple, loader):
+        with self._lock:
+            hit = self._fresh(key, time.monotonic())
+            if hit is not None:
+                return hit
+            build_lock = self._building.setdefault(key, threading.Lock())
+
+        # una sola costruzione per chiave anche con molte sessioni in parallelo
+        with build_lock:
+            with self._lock:
+                hit = self._fresh(key, time.monotonic())
+                if hit is not None:
+                    return hit
+            try:
+                facet = FacetList.from_items(loader())
+            finally:
+                # anche se il loader fallisce: chi aspetta sul build_lock riprova
+                with self._lock:
+                    self._building.pop(key, None)
+            with self._lock:
+                self._entries[key] = (time.monotonic() + self.ttl, facet)
+                self._evict()
+        return facet
+
+    def _evict(self):
+        now = time.monotonic()
+        for k in [k for k, (exp, _) in self._entries.items() if exp <= now]:
+            del self._entries[k]
+        if len(self._entries) > self.max_lists:
+            oldest = sorted(self._entries, key=lambda k: self._entries[k][0])
+            for k in oldest[: len(self._entries) - self.max_lists]:
+                del self._entries[k]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def lists(self):
+        with self._lock:
+            return [(k, facet) for k, (_, facet) in self._entries.items()]
+
+
+@st.cache_resource
+def get_facet_store():
+    return FacetStore()
+
+def merge_facets(lists):
+    # somma i count per nome su più liste (es. comuni di più province)
+    seen = {}
+    for facet in lists:
+        for name, n in facet:
+            seen[name] = seen.get(name, 0) + int(n)
+    return list(seen.items())
+
+
+# =========================
+# REPORT MEMORIA
+# =========================
+def _deep_size(obj, seen: set) -> int:
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (list, tuple)):
+        size += sum(_deep_size(x, seen) for x in obj)
+    return size
+
+def memory_report(store: FacetStore):
+    # vecchio: ogni sessione riceve da st.cache_data la propria copia di una
+    # lista di tuple (str, int); nuovo: una sola FacetList condivisa
+    rows = []
+    for key, facet in store.lists():
+        old_per_session = _deep_size([(n, int(c)) for n, c in facet], set())
+        new_shared = sys.getsizeof(facet) + _deep_size(facet.names, set()) + sys.getsizeof(facet.counts)
+        rows.append({
+            "facet": " / ".join(str(k) for k in key[1:]),
+            "voci": len(facet),
+            "vecchio_per_sessione_kb": round(old_per_session / 1024, 1),
+            "nuovo_condiviso_kb": round(new_shared / 1024, 1),
+        })
+    return rows
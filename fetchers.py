@@ -0,0 +1,219 @@
+import os
+
+from concurrent.futures import ThreadPoolExecutor
+
+import streamlit as st
+
+from api_client import api_get
+from facets import get_facet_store
+from cache_policy import MB, CachePolicy, bounded_cache
+from l2_cache import l2_cached
+
+# =========================
+# FETCHER (cache condivisa per scope)
+# =========================
+# Tutti i fetcher ricevono (tok, scope, ...): il token serve solo alla chiamata,
+# la chiave di cache è lo scope del profilo (ruolo + livello + valori). Così
+# sessioni diverse con lo stesso profilo, e il cache warmer, condividono le voci.
+# I filtri geografici dello scope sono sempre già dentro params (la UI li forza),
+# quindi la risposta dipende solo da scope + params.
+
+# ordine fisso delle chiavi: due selezioni uguali in ordine diverso devono dare
+# la stessa voce di cache e la stessa query string
+PARAM_ORDER = (
+    "regione",
+    "provincia",
+    "comune",
+    "prov_nascita",
+    "com_nascita",
+    "sesso",
+    "nato_estero",
+    "anno_ins",
+    "eta_fascia",
+    "gg_fascia",
+)
+
+# i dati cambiano solo con un import (che svuota la cache): TTL lunghi, così
+# quello che il warmer precarica dopo l'import è ancora lì quando arrivano gli utenti
+AGG_TTL_S = int(os.getenv("AGG_CACHE_TTL", "600"))
+TREND_TTL_S = int(os.getenv("TREND_CACHE_TTL", "600"))
+
+# budget L1 per processo: aggregati piccoli e numerosi (LFU: le viste di default
+# restano, le esplorazioni una tantum escono per prime), cubi grandi e pochi (LRU)
+AGG_POLICY = CachePolicy(ttl=AGG_TTL_S, max_entries=2000, max_bytes=4 * MB, evict="lfu")
+TREND_POLICY = CachePolicy(ttl=TREND_TTL_S, max_entries=500, max_bytes=8 * MB, evict="lru")
+CUBE_POLICY = CachePolicy(ttl=600, max_entries=32, max_bytes=64 * MB, evict="lru")
+# conteggi per area della mappa: fino a qualche migliaio di comuni per voce
+GEO_POLICY = CachePolicy(ttl=AGG_TTL_S, max_entries=200, max_bytes=16 * MB, evict="lru")
+
+
+def profile_scope(who: dict) -> str:
+    # ruolo + livello + valori dello scope + regione, dalla risposta di /auth/whoami
+    role = (who.get("role") or "").lower()
+    level = (who.get("scope_level") or "").lower().strip()
+    values = [v.strip().upper() for v in (who.get("scope_values") or "").split(",") if v.strip()]
+    return "|".join([role, level, ",".join(sorted(values)), (who.get("regione") or "").upper()])
+
+def canonical_params(params: dict) -> dict:
+    out = {}
+    for k in PARAM_ORDER:
+        if k in params:
+            v = params[k]
+            out[k] = sorted(v, key=str) if isinstance(v, (list, tuple)) else v
+    for k in params:
+        if k not in out:
+            out[k] = params[k]
+    return out
+
+# =========================
+# FACETS (FacetStore condiviso)
+# =========================
+def get_anni_inserimento(tok: str, scope: str):
+    def load():
+        js = api_get("/auth/anni-inserimento", tok)
+        return [(x["anno"], x["count"]) for x in js.get("items", []) if x.get("anno") is not None]
+    return get_facet_store().get((scope, "anni"), load)
+
+def get_regioni(tok: str, scope: str):
+    def load():
+        js = api_get("/auth/regioni", tok)
+        out = []
+        for x in js.get("items", []):
+            r = x.get("regione")
+            c = x.get("count", 0)
+            if r:
+                out.append((r, int(c) if c is not None else 0))
+        return out
+    return get_facet_store().get((scope, "regioni"), load)
+
+def get_province_with_counts(tok: str, scope: str, region_filter: tuple[str, ...]):
+    def load():
+        params = {}
+        if region_filter:
+            params["regione"] = list(region_filter)
+        js = api_get("/auth/province", tok, params=params)
+
+        out = []
+        for x in js.get("items", []):
+            p = x.get("provincia")
+            c = x.get("count", 0)
+            if p:
+                out.append((p, int(c) if c is not None else 0))
+        return out
+    return get_facet_store().get((scope, "province", region_filter), load)
+
+def get_comuni_for_prov_with_counts(tok: str, scope: str, prov: str):
+    def load():
+        js = api_get("/auth/comuni", tok, params={"provincia": prov})
+        out = []
+        for x in js.get("items", []):
+            c = x.get("comune")
+            n = x.get("count", 0)
+            if c:
+                out.append((c, int(n) if n is not None else 0))
+        return out
+    return get_facet_store().get((scope, "comuni", prov), load)
+
+def get_province_nascita_with_counts(tok: str, scope: str):
+    def load():
+        js = api_get("/auth/province-nascita", tok)
+        out = []
+        for x in js.get("items", []):
+            p = x.get("prov_nascita")
+            c = x.get("count", 0)
+            if p:
+                out.append((p, int(c) if c is not None else 0))
+        return out
+    return get_facet_store().get((scope, "province_nascita"), load)
+
+def get_comuni_nascita_for_prov_with_counts(tok: str, scope: str, prov_n: str):
+    def load():
+        js = api_get("/auth/comuni-nascita", tok, params={"prov_nascita": prov_n})
+        out = []
+        for x in js.get("items", []):
+            c = x.get("comune_nascita")
+            n = x.get("count", 0)
+            if c:
+                out.append((c, int(n) if n is not None else 0))
+        return out
+    return get_facet_store().get((scope, "comuni_nascita", prov_n), load)
+
+# =========================
+# AGGREGATI (L1 limitata + L2 condivisa, token fuori dalla chiave)
+# =========================
+@bounded_cache(AGG_POLICY)
+@l2_cached(ttl=AGG_TTL_S)
+def get_gg_fasce(_tok: str, scope: str, params: dict):
+    p = dict(params)
+    return api_get("/auth/gg-fasce", _tok, params=p)
+
+@bounded_cache(AGG_POLICY)
+@l2_cached(ttl=AGG_TTL_S)
+def get_eta_fasce(_tok: str, scope: str, params: dict):
+    p = dict(params)
+    return api_get("/auth/eta-fasce", _tok, params=p)
+
+@bounded_cache(AGG_POLICY)
+@l2_cached(ttl=AGG_TTL_S)
+def get_eta_gg_fasce(_tok: str, scope: str, params: dict):
+    # incrocio fascia d'età x fascia giornate in una sola query raggruppata:
+    # al massimo 4 x 6 righe {eta_fascia, gg_fascia, count, gg_tot} (chiavi come /auth/*-fasce)
+    js = api_get("/auth/eta-gg-fasce", _tok, params=dict(params))
+    return js.get("items", [])
+
+@bounded_cache(AGG_POLICY)
+@l2_cached(ttl=AGG_TTL_S)
+def get_stats_sex(_tok: str, scope: str, params: dict):
+    p = dict(params)
+    return api_get("/auth/stats-sex", _tok, params=p)
+
+@bounded_cache(AGG_POLICY)
+@l2_cached(ttl=AGG_TTL_S)
+def get_stats_nat(_tok: str, scope: str, params: dict):
+    p = dict(params)
+    return api_get("/auth/stats-nat", _tok, params=p)
+
+@bounded_cache(TREND_POLICY)
+@l2_cached(ttl=TREND_TTL_S)
+def get_trend_annuale(_tok: str, scope: str, metrica: str, apply_geo: bool, geo_params: dict):
+    params = {"metrica": metrica, "apply_geo": apply_geo}
+    if apply_geo:
+        if geo_params.get("regione"):
+            params["regione"] = geo_params["regione"]
+        if geo_params.get("provincia"):
+            params["provincia"] = geo_params["provincia"]
+        if geo_params.get("comune"):
+            params["comune"] = geo_params["comune"]
+    return api_get("/auth/trend-annuale", _tok, params=params)
+
+@bounded_cache(CUBE_POLICY)
+@l2_cached(ttl=600)
+def get_cube(_tok: str, scope: str, geo_params: dict):
+    # count e gg_tot per (anno, sesso, nato_estero, eta_fascia, gg_fascia)
+    # nello scope geografico: poche migliaia di righe al massimo
+    js = api_get("/auth/cube", _tok, params=dict(geo_params))
+    return js.get("items", [])
+
+@bounded_cache(GEO_POLICY)
+@l2_cached(ttl=AGG_TTL_S)
+def get_geo_counts(_tok: str, scope: str, livello: str, params: dict):
+    # [(codice area, count, gg_tot)] raggruppato per "provincia" (sigla) o "comune"
+    js = api_get("/auth/geo-counts", _tok, params={**params, "livello": livello})
+    return [
+        (str(it.get("codice") or "").upper(), int(it.get("count", 0)), int(it.get("gg_tot", 0)))
+        for it in js.get("items", [])
+    ]
+
+@bounded_cache(AGG_POLICY)
+@l2_cached(ttl=AGG_TTL_S)
+def cached_count(_tok: str, scope: str, params: dict):
+    js = api_get("/auth/count", _tok, params=dict(params))
+    return {
+        "total": int(js.get("total", 0)),
+        "total_gg": int(js.get("total_gg", 0)),
+    }
+
+# pool condiviso per lanciare in parallelo i fetcher di un rerun (risultati progressivi)
+@st.cache_resource
+def get_fetch_pool():
+    return ThreadPoolExecutor(max_workers=16, thread_name_prefix="fetch")
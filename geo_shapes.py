@@ -0,0 +1,103 @@
+import json
+import mmap
+import os
+import struct
+import threading
+
+from collections import OrderedDict
+
+import numpy as np
+import streamlit as st
+
+# =========================
+# GEOMETRIE (province e comuni, file binario compatto)
+# =========================
+# Confini già semplificati e quantizzati da tools/build_geo.py (dai GeoJSON ISTAT),
+# in un unico file aperto in mmap una volta per processo: le coordinate non
+# vengono mai copiate in memoria, solo quelle dei poligoni da disegnare.
+#
+#   GEO_SHAPES=/var/lib/gestionale/italia.geob   (default: geo/italia.geob accanto all'app)
+#
+# Formato:
+#   MAGIC | u32 lunghezza header | header JSON | punti (uint16 x, uint16 y)
+# Header: bbox di quantizzazione e, per ogni layer, id -> [padre, poligoni], dove un
+# poligono è una lista di anelli [offset, n punti] (il primo è il bordo esterno).
+# Layer: "provincia" (padre = regione), "comune" (dettaglio, padre = provincia),
+# "comune_coarse" (per le viste regionali), più i centroidi dei comuni per la
+# vista nazionale.
+
+MAGIC = b"GEOB1\n"
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+GEO_SHAPES = os.getenv("GEO_SHAPES", os.path.join(APP_DIR, "geo", "italia.geob"))
+QMAX = 65535
+# FeatureCollection già costruite tenute per processo
+FC_CACHE_MAX = 64
+
+
+class GeoShapes:
+    def __init__(self, path: str = GEO_SHAPES):
+        self.path = path
+        self._file = open(path, "rb")
+        self._mm = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path}: non è un file di geometrie ({MAGIC!r})")
+        (hlen,) = struct.unpack_from("<I", self._mm, len(MAGIC))
+        start = len(MAGIC) + 4
+        header = json.loads(self._mm[start:start + hlen].decode("utf-8"))
+        self._body = start + hlen
+        self.bbox = header["bbox"]
+        self.layers = header["layers"]
+        self.centroids = header.get("centroids", {})
+        self._lock = threading.Lock()
+        self._fc = OrderedDict()
+
+    def ids(self, layer: str):
+        return self.layers[layer]["features"].keys()
+
+    def parent(self, layer: str, fid: str):
+        feat = self.layers[layer]["features"].get(fid)
+        return feat[0] if feat else None
+
+    def _ring(self, offset: int, n: int, decimals: int):
+        # vista sul mmap (nessuna copia) -> gradi, arrotondati per il payload del browser
+        q = np.frombuffer(self._mm, dtype="<u2", count=n * 2, offset=self._body + offset * 4).reshape(n, 2)
+        minx, miny, maxx, maxy = self.bbox
+        lon = minx + q[:, 0] * ((maxx - minx) / QMAX)
+        lat = miny + q[:, 1] * ((maxy - miny) / QMAX)
+        return np.round(np.column_stack([lon, lat]), decimals).tolist()
+
+    def feature_collection(self, layer: str, ids, decimals: int = 3):
+        # GeoJSON con le sole feature richieste (id = codice usato dal backend)
+        key = (layer, tuple(sorted(ids)), decimals)
+        with self._lock:
+            fc = self._fc.get(key)
+            if fc is not None:
+                self._fc.move_to_end(key)
+                return fc
+        feats = self.layers[layer]["features"]
+        features = []
+        for fid in key[1]:
+            feat = feats.get(fid)
+            if feat is None:
+                continue
+            polys = [[self._ring(off, n, decimals) for off, n in poly] for poly in feat[1]]
+            features.append({
+                "type": "Feature",
+                "id": fid,
+                "properties": {},
+                "geometry": {"type": "MultiPolygon", "coordinates": polys},
+            })
+        fc = {"type": "FeatureCollection", "features": features}
+        with self._lock:
+            self._fc[key] = fc
+            while len(self._fc) > FC_CACHE_MAX:
+                self._fc.popitem(last=False)
+        return fc
+
+
+@st.cache_resource
+def get_geo_shapes():
+    # None se il file non c'è (mappa non disponibile)
+    if not os.path.exists(GEO_SHAPES):
+        return None
+    return GeoShapes(GEO_SHAPES)
@@ -0,0 +1,140 @@
+import io
+import json
+
+from collections import Counter
+from datetime import date, datetime, time
+from hashlib import blake2b
+
+# =========================
+# IMPORT INCREMENTALE (diff per hash di riga)
+# =========================
+# Il file Excel viene letto qui, riga per riga, e ogni riga normalizzata diventa un
+# hash; il backend restituisce gli hash delle righe già presenti per l'anno
+# (/admin/import/hashes) e riceve solo:
+#
+#   - un .xlsx con le righe nuove o modificate (stessa intestazione dell'originale)
+#   - la lista degli hash da cancellare (righe sparite o modificate)
+#
+# Una riga modificata è quindi "cancella la vecchia + inserisci la nuova". Le righe
+# identiche ripetute contano come multiinsieme: ricaricare lo stesso file non
+# aggiunge niente, due righe uguali nel file restano due righe.
+#
+# Contratto con il backend (HASH_ALGO): intestazioni minuscole senza spazi ai
+# lati, colonne senza intestazione ignorate, colonne in ordine alfabetico;
+# valori normalizzati da norm_value; "nome\x1evalore" uniti da \x1f; blake2b a
+# 16 byte in esadecimale. Righe completamente vuote saltate.
+
+HASH_ALGO = "blake2b-128-v1"
+
+
+def norm_header(h) -> str:
+    return " ".join(str(h).split()).lower() if h is not None else ""
+
+def norm_value(v) -> str:
+    # stessa riga = stesso hash anche se Excel cambia tipo (12 / 12.0 / "12 ")
+    if v is None:
+        return ""
+    if isinstance(v, bool):
+        return "1" if v else "0"
+    if isinstance(v, datetime):
+        return v.date().isoformat() if v.time() == time(0) else v.isoformat()
+    if isinstance(v, date):
+        return v.isoformat()
+    if isinstance(v, float) and v.is_integer():
+        return str(int(v))
+    if isinstance(v, (int, float)):
+        return str(v)
+    return " ".join(str(v).split()).upper()
+
+
+class RowHasher:
+    def __init__(self, header):
+        names = [norm_header(h) for h in header]
+        # (posizione, nome) delle colonne con intestazione, in ordine alfabetico
+        self.columns = sorted(((i, n) for i, n in enumerate(names) if n), key=lambda c: c[1])
+
+    def __call__(self, row):
+        values = [(n, norm_value(row[i]) if i < len(row) else "") for i, n in self.columns]
+        if not any(v for _, v in values):
+            return None
+        text = "\x1f".join(f"{n}\x1e{v}" for n, v in values)
+        return blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def iter_rows(data: bytes):
+    # (intestazione originale, iteratore delle righe) del primo foglio, in streaming
+    from openpyxl import load_workbook
+
+    wb = load_workbook(io.BytesIO(data), read_only=True, data_only=True)
+    rows = wb.worksheets[0].iter_rows(values_only=True)
+    header = next(rows, None)
+    if header is None:
+        wb.close()
+        raise ValueError("il file Excel è vuoto")
+    return list(header), rows, wb
+
+def iter_hashed(data: bytes):
+    # (hash, riga) per ogni riga non vuota
+    header, rows, wb = iter_rows(data)
+    hasher = RowHasher(header)
+    try:
+        for row in rows:
+            h = hasher(row)
+            if h is not None:
+                yield h, row
+    finally:
+        wb.close()
+
+def workbook_hashes(data: bytes) -> list:
+    return [h for h, _ in iter_hashed(data)]
+
+
+class ImportDiff:
+    def __init__(self):
+        self.delta = b""
+        self.delete_hashes = []
+        self.total = 0
+        self.unchanged = 0
+        self.new = 0
+
+    def empty(self) -> bool:
+        return not self.new and not self.delete_hashes
+
+    def form_data(self) -> dict:
+        return {"delete_hashes": json.dumps(self.delete_hashes), "hash_algo": HASH_ALGO}
+
+
+def diff_workbook(data: bytes, stored_hashes) -> ImportDiff:
+    # un solo passaggio sul file: le righe nuove vanno subito nel workbook di
+    # uscita (write-only), in memoria restano solo i contatori degli hash
+    from openpyxl import Workbook
+
+    remaining = Counter(stored_hashes)
+    header, rows, wb_in = iter_rows(data)
+    hasher = RowHasher(header)
+    wb_out = Workbook(write_only=True)
+    ws = wb_out.create_sheet()
+    ws.append(header)
+
+    diff = ImportDiff()
+    try:
+        for row in rows:
+            h = hasher(row)
+            if h is None:
+                continue
+            diff.total += 1
+            if remaining[h] > 0:
+                remaining[h] -= 1
+                diff.unchanged += 1
+            else:
+                ws.append(list(row))
+                diff.new += 1
+    finally:
+        wb_in.close()
+
+    diff.delete_hashes = sorted(remaining.elements())
+    # anche senza righe nuove (solo cancellazioni) il backend riceve l'intestazione
+    buf = io.BytesIO()
+    wb_out.save(buf)
+    diff.delta = buf.getvalue()
+    return diff
@@ -0,0 +1,245 @@
+import os
+import threading
+import time
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from datetime import datetime, UTC
+
+import streamlit as st
+
+from api_client import AuthExpiredError, ApiRequestError, ApiUnavailableError, api_get, api_post
+from import_diff import HASH_ALGO, diff_workbook
+
+# =========================
+# CODA IMPORT (più file Excel, un anno di inserimento ciascuno)
+# =========================
+# Un batch per processo, in un thread di background (come il cache warmer):
+#
+#   - al massimo IMPORT_CONCURRENCY file in lavorazione insieme (invio + job backend)
+#   - file dello stesso anno uno dopo l'altro, nell'ordine del batch
+#   - errori temporanei (rete, 5xx, job in errore) ritentati fino a IMPORT_RETRIES
+#     volte con attesa crescente; file rifiutati (4xx) o con esito sconosciuto no
+#   - a fine batch una sola invalidazione delle cache (callback on_finished)
+#
+#   IMPORT_CONCURRENCY=2 IMPORT_RETRIES=2 IMPORT_JOB_TIMEOUT_S=1800
+
+IMPORT_CONCURRENCY = int(os.getenv("IMPORT_CONCURRENCY", "2"))
+IMPORT_MAX_CONCURRENCY = 8
+IMPORT_RETRIES = int(os.getenv("IMPORT_RETRIES", "2"))
+IMPORT_RETRY_BACKOFF_S = 5
+IMPORT_POLL_S = 2
+IMPORT_JOB_TIMEOUT_S = int(os.getenv("IMPORT_JOB_TIMEOUT_S", "1800"))
+# "replace" (tutto il database) non ha senso in un batch
+IMPORT_BATCH_MODES = ("replace_year", "incremental", "append")
+
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+# stati di un file
+QUEUED = "in coda"
+SENDING = "invio"
+RUNNING = "job in corso"
+WAITING = "in attesa di riprovare"
+DONE = "completato"
+UNCHANGED = "nessuna modifica"
+FAILED = "errore"
+
+
+class RetryableError(Exception):
+    pass
+
+
+def incremental_diff(tok: str, data: bytes, anno: int):
+    # ImportDiff del file rispetto alle righe già importate per l'anno
+    stored = api_get("/admin/import/hashes", tok, {"anno_inserimento": anno})
+    if stored.get("algo") != HASH_ALGO:
+        raise ApiRequestError(
+            f"Il backend usa hash di riga '{stored.get('algo')}' invece di '{HASH_ALGO}': "
+            "import incrementale non possibile, usare 'Sostituisci solo questo anno'."
+        )
+    return diff_workbook(data, stored.get("hashes") or [])
+
+
+class ImportTask:
+    def __init__(self, name: str, data: bytes, anno: int, mode: str):
+        self.name = name
+        self.data = data
+        self.anno = int(anno)
+        self.mode = mode
+        self.status = QUEUED
+        self.attempts = 0
+        self.job_id = None
+        self.inserted = None
+        self.detail = ""
+        self.error = None
+        self.elapsed_s = 0.0
+
+    def row(self) -> dict:
+        return {
+            "file": self.name,
+            "anno": self.anno,
+            "modalità": self.mode,
+            "stato": self.status,
+            "tentativi": self.attempts,
+            "job_id": self.job_id,
+            "righe inserite": self.inserted,
+            "dettaglio": self.error or self.detail,
+            "secondi": round(self.elapsed_s, 1),
+        }
+
+
+class ImportQueue:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+        self.tasks = []
+        self.last = None
+
+    def running(self) -> bool:
+        with self._lock:
+            return self._thread is not None and self._thread.is_alive()
+
+    def start(self, tok: str, tasks: list, concurrency: int = IMPORT_CONCURRENCY, on_finished=None) -> bool:
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return False
+            self.tasks = tasks
+            self.last = None
+            self._thread = threading.Thread(
+                target=self._run, args=(tok, tasks, max(1, concurrency), on_finished),
+                name="import-queue", daemon=True,
+            )
+            self._thread.start()
+            return True
+
+    def failed(self) -> list:
+        return [t for t in self.tasks if t.status == FAILED and t.data is not None]
+
+    def retry_failed(self, tok: str, concurrency: int = IMPORT_CONCURRENCY, on_finished=None) -> bool:
+        # nuovo batch con i soli file falliti (eventualmente con un token nuovo)
+        tasks = self.failed()
+        for t in tasks:
+            t.status, t.attempts, t.error, t.job_id = QUEUED, 0, None, None
+        return bool(tasks) and self.start(tok, tasks, concurrency, on_finished)
+
+    # =========================
+    # SCHEDULER
+    # =========================
+    def _run(self, tok, tasks, concurrency, on_finished):
+        t0 = time.monotonic()
+        queue = list(tasks)
+        busy_years = set()
+        inflight = {}
+        auth_error = None
+        with ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="import") as pool:
+            while queue or inflight:
+                # il primo file in coda di un anno non occupato
+                while len(inflight) < concurrency and auth_error is None:
+                    task = next((t for t in queue if t.anno not in busy_years), None)
+                    if task is None:
+                        break
+                    queue.remove(task)
+                    busy_years.add(task.anno)
+                    inflight[pool.submit(self._process, tok, task)] = task
+                if not inflight:
+                    break
+                done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    task = inflight.pop(fut)
+                    busy_years.discard(task.anno)
+                    if isinstance(fut.exception(), AuthExpiredError):
+                        auth_error = "token scaduto"
+            for task in queue:
+                # token scaduto: gli altri restano da riprovare con un nuovo login
+                task.status, task.error = FAILED, auth_error
+
+        ok = [t for t in tasks if t.status in (DONE, UNCHANGED)]
+        self.last = {
+            "finished_at": datetime.now(UTC).isoformat(),
+            "files": len(tasks),
+            "ok": len(ok),
+            "failed": sum(t.status == FAILED for t in tasks),
+            "inserted": sum(t.inserted or 0 for t in ok),
+            "elapsed_s": round(time.monotonic() - t0, 2),
+        }
+        if on_finished is not None and any(t.status == DONE for t in tasks):
+            try:
+                on_finished()
+            except Exception as e:
+                self.last["error"] = f"invalidazione cache: {e}"
+
+    def _process(self, tok, task):
+        t0 = time.monotonic()
+        try:
+            while True:
+                task.attempts += 1
+                try:
+                    self._attempt(tok, task)
+                    # importato: il file non serve più
+                    task.data = None
+                    return
+                except AuthExpiredError:
+                    task.status, task.error = FAILED, "token scaduto"
+                    raise
+                except ApiRequestError as e:
+                    task.status, task.error = FAILED, str(e)
+                    return
+                except (ApiUnavailableError, RetryableError) as e:
+                    if task.attempts > IMPORT_RETRIES:
+                        task.status, task.error = FAILED, str(e)
+                        return
+                    task.status, task.error = WAITING, str(e)
+                    time.sleep(IMPORT_RETRY_BACKOFF_S * task.attempts)
+                    task.error = None
+                except Exception as e:
+                    # file non leggibile e simili: ripetere non serve
+                    task.status, task.error = FAILED, str(e)
+                    return
+        finally:
+            task.elapsed_s = time.monotonic() - t0
+
+    def _attempt(self, tok, task):
+        task.status, task.job_id = SENDING, None
+        name, data, form = task.name, task.data, None
+        if task.mode == "incremental":
+            # diff ricalcolato a ogni tentativo: un tentativo precedente può essere arrivato a metà
+            diff = incremental_diff(tok, task.data, task.anno)
+            task.detail = f"{diff.new:,} nuove o modificate, {len(diff.delete_hashes):,} da cancellare"
+            if diff.empty():
+                task.status, task.inserted = UNCHANGED, 0
+                return
+            name, data, form = f"incrementale_{task.anno}.xlsx", diff.delta, diff.form_data()
+
+        res = api_post(
+            f"/admin/import?mode={task.mode}&anno_inserimento={task.anno}",
+            tok,
+            files={"file": (name, data, XLSX_MIME)},
+            data=form,
+        )
+        task.job_id = res.get("job_id")
+        if not task.job_id:
+            task.status = DONE
+            return
+
+        task.status = RUNNING
+        deadline = time.monotonic() + IMPORT_JOB_TIMEOUT_S
+        while time.monotonic() < deadline:
+            try:
+                js = api_get("/admin/import/status", tok, {"job_id": task.job_id})
+            except ApiUnavailableError:
+                # il job è partito: un errore di polling non è un errore dell'import
+                time.sleep(IMPORT_POLL_S)
+                continue
+            status = js.get("status")
+            if status == "done":
+                task.status, task.inserted = DONE, js.get("inserted_rows")
+                return
+            if status == "error":
+                raise RetryableError(f"job {task.job_id}: {js.get('error')}")
+            time.sleep(IMPORT_POLL_S)
+        # esito sconosciuto: ripartire potrebbe importare due volte
+        raise ApiRequestError(f"job {task.job_id} ancora in corso dopo {IMPORT_JOB_TIMEOUT_S}s: controllare il backend")
+
+
+@st.cache_resource
+def get_import_queue():
+    return ImportQueue()
@@ -0,0 +1,266 @@
+import functools
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+import zlib
+
+import streamlit as st
+
+from lkg_store import canonical_key, decode_value, encode_value
+
+# =========================
+# CACHE L2 (condivisa tra i worker)
+# =========================
+# la cache L1 (cache_policy) è per processo: con più worker dietro il load balancer la stessa
+# query gira una volta per worker. La L2 sta sotto i fetcher in cache:
+# L1 (bounded_cache) -> L2 (SQLite locale o server Redis) -> API.
+#
+#   L2_CACHE_URL=sqlite:////var/tmp/gestionale_l2.sqlite   (default: file in tempdir)
+#   L2_CACHE_URL=redis://localhost:6379/0                  (richiede il pacchetto redis)
+#   L2_CACHE_URL=off
+#
+# Un import incrementa la "generazione": le chiavi L2 la contengono, e ogni worker
+# che la vede cambiata svuota la propria L1 (sync_generation).
+
+L2_CACHE_URL = os.getenv(
+    "L2_CACHE_URL",
+    "sqlite:///" + os.path.join(tempfile.gettempdir(), "gestionale_ui_l2.sqlite"),
+)
+L2_MAX_BYTES = int(os.getenv("L2_MAX_BYTES", str(256 * 1024 * 1024)))
+# risposte più grandi non vanno in L2 (restano solo in L1)
+L2_MAX_VALUE_BYTES = int(os.getenv("L2_MAX_VALUE_BYTES", str(4 * 1024 * 1024)))
+# ogni quanto un worker rilegge la generazione
+L2_GENERATION_CHECK_S = 5
+
+
+def dumps(value) -> bytes:
+    return zlib.compress(json.dumps(encode_value(value), ensure_ascii=False, default=str).encode("utf-8"))
+
+def loads(blob: bytes):
+    return decode_value(json.loads(zlib.decompress(blob).decode("utf-8")))
+
+
+class SqliteBackend:
+    # un file condiviso dai worker dello stesso host (WAL: letture concorrenti)
+    def __init__(self, path: str, max_bytes: int = L2_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        self._puts = 0
+        db = self._db()
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS l2 ("
+            " key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL NOT NULL, size INTEGER NOT NULL)"
+        )
+        db.execute("CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v INTEGER NOT NULL)")
+        db.commit()
+
+    def _db(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = sqlite3.connect(self.path, timeout=1)
+            self._local.db = db
+        return db
+
+    def get(self, key: str):
+        row = self._db().execute("SELECT value, expires FROM l2 WHERE key = ?", (key,)).fetchone()
+        if row is None or row[1] <= time.time():
+            return None
+        return row[0]
+
+    def set(self, key: str, blob: bytes, ttl: float):
+        db = self._db()
+        with db:
+            db.execute(
+                "INSERT OR REPLACE INTO l2 (key, value, expires, size) VALUES (?, ?, ?, ?)",
+                (key, blob, time.time() + ttl, len(blob)),
+            )
+        self._puts += 1
+        if self._puts % 50 == 0:
+            self.prune()
+
+    def prune(self):
+        db = self._db()
+        with db:
+            db.execute("DELETE FROM l2 WHERE expires <= ?", (time.time(),))
+            total = db.execute("SELECT COALESCE(SUM(size), 0) FROM l2").fetchone()[0]
+            if total > self.max_bytes:
+                # via le voci che scadono prima fino a tornare al 90% del budget
+                excess = total - int(self.max_bytes * 0.9)
+                freed = 0
+                doomed = []
+                for key, size in db.execute("SELECT key, size FROM l2 ORDER BY expires"):
+                    doomed.append((key,))
+                    freed += size
+                    if freed >= excess:
+                        break
+                db.executemany("DELETE FROM l2 WHERE key = ?", doomed)
+
+    def generation(self) -> int:
+        row = self._db().execute("SELECT v FROM meta WHERE k = 'generation'").fetchone()
+        return row[0] if row else 0
+
+    def bump_generation(self) -> int:
+        db = self._db()
+        with db:
+            db.execute(
+                "INSERT INTO meta (k, v) VALUES ('generation', 1) "
+                "ON CONFLICT (k) DO UPDATE SET v = v + 1"
+            )
+            # le voci delle generazioni precedenti non servono più
+            db.execute("DELETE FROM l2")
+        return self.generation()
+
+    def stats(self):
+        n, size = self._db().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM l2").fetchone()
+        return {"entries": n, "bytes": size}
+
+
+class RedisBackend:
+    # qualsiasi server che parla il protocollo Redis (Redis, Valkey, KeyDB, ...)
+    PREFIX = "gestionale_ui:l2:"
+
+    def __init__(self, url: str):
+        try:
+            import redis
+        except ImportError as e:
+            raise RuntimeError("L2_CACHE_URL=redis://... richiede il pacchetto 'redis'") from e
+        self._r = redis.Redis.from_url(url, socket_timeout=0.25, socket_connect_timeout=0.25)
+
+    def get(self, key: str):
+        return self._r.get(self.PREFIX + key)
+
+    def set(self, key: str, blob: bytes, ttl: float):
+        # il limite di memoria totale è quello del server (maxmemory + allkeys-lru)
+        self._r.set(self.PREFIX + key, blob, ex=max(1, int(ttl)))
+
+    def prune(self):
+        pass
+
+    def generation(self) -> int:
+        return int(self._r.get(self.PREFIX + "generation") or 0)
+
+    def bump_generation(self) -> int:
+        return int(self._r.incr(self.PREFIX + "generation"))
+
+    def stats(self):
+        info = self._r.info("memory")
+        return {"entries": self._r.dbsize(), "bytes": info.get("used_memory", 0)}
+
+
+def make_backend(url: str):
+    if not url or url == "off":
+        return None
+    if url.startswith("sqlite:///"):
+        return SqliteBackend(url[len("sqlite:///"):])
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisBackend(url)
+    raise ValueError(f"L2_CACHE_URL non supportato: {url}")
+
+
+class L2Cache:
+    # mai bloccante per la pagina: qualsiasi errore del backend è un miss
+    def __init__(self, backend):
+        self.backend = backend
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._checked = 0.0
+        self.hits = {}
+        self.misses = {}
+        self.errors = 0
+
+    def _count(self, counter: dict, name: str):
+        with self._lock:
+            counter[name] = counter.get(name, 0) + 1
+
+    def get(self, name: str, key: str):
+        try:
+            blob = self.backend.get(f"{self._generation}:{key}")
+        except Exception:
+            self.errors += 1
+            blob = None
+        if blob is None:
+            self._count(self.misses, name)
+            return None
+        self._count(self.hits, name)
+        return loads(blob)
+
+    def set(self, key: str, value, ttl: float):
+        blob = dumps(value)
+        if len(blob) > L2_MAX_VALUE_BYTES:
+            return
+        try:
+            self.backend.set(f"{self._generation}:{key}", blob, ttl)
+        except Exception:
+            self.errors += 1
+
+    def sync_generation(self) -> bool:
+        # True se un altro worker (o la CLI) ha invalidato la cache dopo un import
+        now = time.monotonic()
+        if now - self._checked < L2_GENERATION_CHECK_S:
+            return False
+        self._checked = now
+        try:
+            gen = self.backend.generation()
+        except Exception:
+            self.errors += 1
+            return False
+        changed = gen != self._generation
+        self._generation = gen
+        return changed
+
+    def invalidate(self):
+        try:
+            self._generation = self.backend.bump_generation()
+        except Exception:
+            self.errors += 1
+        self._checked = time.monotonic()
+
+    def report(self):
+        try:
+            stats = self.backend.stats()
+        except Exception:
+            stats = {}
+        return {
+            "backend": type(self.backend).__name__,
+            "generation": self._generation,
+            "hits": dict(self.hits),
+            "misses": dict(self.misses),
+            "errors": self.errors,
+            **stats,
+        }
+
+
+@st.cache_resource
+def get_l2_cache():
+    try:
+        backend = make_backend(L2_CACHE_URL)
+    except Exception:
+        backend = None
+    if backend is None:
+        return None
+    cache = L2Cache(backend)
+    cache.sync_generation()
+    return cache
+
+def l2_cached(ttl: float):
+    # da mettere sotto @bounded_cache: fn(_tok, scope, *args), chiave = nome + scope + args
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(_tok, scope, *args):
+            cache = get_l2_cache()
+            if cache is None:
+                return fn(_tok, scope, *args)
+            key = canonical_key(fn.__name__, scope, args)
+            hit = cache.get(fn.__name__, key)
+            if hit is not None:
+                return hit
+            data = fn(_tok, scope, *args)
+            cache.set(key, data, ttl)
+            return data
+        return wrapper
+    return deco
@@ -0,0 +1,205 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+
+from collections import OrderedDict, namedtuple
+from collections.abc import Sequence
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, UTC
+
+import streamlit as st
+
+# =========================
+# LAST-KNOWN-GOOD STORE (su disco)
+# =========================
+# Ogni fetcher salva qui l'ultima risposta buona, indicizzata per scope utente +
+# filtri canonici. Se il backend è lento o giù la UI mostra questi dati con un
+# banner "dati al ...", invece di fermarsi.
+
+LKG_DIR = os.getenv("LKG_DIR", os.path.join(tempfile.gettempdir(), "gestionale_ui_lkg"))
+# non riscrivere lo stesso file ad ogni rerun (i fetcher hanno già la loro cache L1/L2)
+LKG_MIN_WRITE_INTERVAL_S = 120
+LKG_MAX_AGE_DAYS = 30
+LKG_MAX_FILES = 20000
+# ogni quanto la UI controlla se i refresh in background sono riusciti
+LKG_RETRY_EVERY_S = 15
+
+StaleEntry = namedtuple("StaleEntry", ["key", "data", "saved_at"])
+
+
+def _canon(v):
+    # liste/tuple di filtri: l'ordine di selezione non conta
+    if isinstance(v, dict):
+        return {str(k): _canon(x) for k, x in v.items()}
+    if isinstance(v, (list, tuple, set)):
+        return sorted((_canon(x) for x in v), key=lambda x: json.dumps(x, sort_keys=True, default=str))
+    return v
+
+def encode_value(v):
+    # JSON non distingue tuple e liste: i facet sono liste di tuple (valore, count)
+    if isinstance(v, tuple):
+        return {"__tuple__": [encode_value(x) for x in v]}
+    if isinstance(v, list):
+        return [encode_value(x) for x in v]
+    if isinstance(v, dict):
+        return {k: encode_value(x) for k, x in v.items()}
+    if isinstance(v, Sequence) and not isinstance(v, (str, bytes)):
+        # FacetList e simili: salvati come lista di tuple
+        return [encode_value(x) for x in v]
+    return v
+
+def decode_value(v):
+    if isinstance(v, dict):
+        if set(v) == {"__tuple__"}:
+            return tuple(decode_value(x) for x in v["__tuple__"])
+        return {k: decode_value(x) for k, x in v.items()}
+    if isinstance(v, list):
+        return [decode_value(x) for x in v]
+    return v
+
+def canonical_key(name: str, scope: str, args: tuple) -> str:
+    payload = {
+        "fn": name,
+        "scope": scope,
+        # gli argomenti posizionali mantengono l'ordine, solo il contenuto è canonico
+        "args": [_canon(a) for a in args],
+    }
+    raw = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def token_scope(tok: str) -> str:
+    # il token non finisce mai su disco, solo il suo hash
+    return "token:" + hashlib.sha256(tok.strip().encode("utf-8")).hexdigest()[:24]
+
+
+class LastKnownGoodStore:
+    def __init__(self, root: str = LKG_DIR):
+        self.root = root
+        os.makedirs(self.root, exist_ok=True)
+        self._lock = threading.Lock()
+        # chiave -> ultima scrittura, in ordine di tempo: solo quelle ancora
+        # dentro LKG_MIN_WRITE_INTERVAL_S (una voce per combinazione di filtri)
+        self._last_write = OrderedDict()
+        self.prune()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], f"{key}.json")
+
+    def save(self, name: str, scope: str, args: tuple, data, force: bool = False):
+        key = canonical_key(name, scope, args)
+        now = time.monotonic()
+        with self._lock:
+            while self._last_write and now - next(iter(self._last_write.values())) >= LKG_MIN_WRITE_INTERVAL_S:
+                self._last_write.popitem(last=False)
+            # force: dopo un import la copia va riscritta subito (cache warmer)
+            if not force and key in self._last_write:
+                return key
+            self._last_write[key] = now
+            self._last_write.move_to_end(key)
+
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        doc = {
+            "fn": name,
+            "scope": scope,
+            "saved_at": datetime.now(UTC).isoformat(),
+            "data": encode_value(data),
+        }
+        # scrittura atomica: un lettore concorrente vede il file vecchio o quello nuovo
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(doc, f, ensure_ascii=False, default=str)
+            os.replace(tmp, path)
+        except OSError:
+            try:
+                os.unlink(tmp)
+            except OSError:
+                pass
+        return key
+
+    def load(self, name: str, scope: str, args: tuple):
+        key = canonical_key(name, scope, args)
+        try:
+            with open(self._path(key), encoding="utf-8") as f:
+                doc = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return StaleEntry(key, decode_value(doc.get("data")), datetime.fromisoformat(doc["saved_at"]))
+
+    def prune(self):
+        cutoff = time.time() - LKG_MAX_AGE_DAYS * 86400
+        files = []
+        for dirpath, _, names in os.walk(self.root):
+            for n in names:
+                p = os.path.join(dirpath, n)
+                try:
+                    mtime = os.path.getmtime(p)
+                except OSError:
+                    continue
+                if mtime < cutoff or n.endswith(".tmp"):
+                    try:
+                        os.unlink(p)
+                    except OSError:
+                        pass
+                else:
+                    files.append((mtime, p))
+        if len(files) > LKG_MAX_FILES:
+            files.sort()
+            for _, p in files[: len(files) - LKG_MAX_FILES]:
+                try:
+                    os.unlink(p)
+                except OSError:
+                    pass
+
+
+class BackgroundRefresher:
+    # Riprova in background i fetch serviti dalla copia LKG; al successo il
+    # risultato finisce nella cache dei fetcher e nel LKG, e il prossimo rerun è fresco.
+    def __init__(self, max_workers: int = 2):
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="lkg-refresh")
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._ok = {}
+
+    def submit(self, key: str, fn, *args, on_success=None):
+        with self._lock:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+            self._ok.pop(key, None)
+        self._pool.submit(self._run, key, fn, args, on_success)
+
+    def _run(self, key, fn, args, on_success):
+        try:
+            data = fn(*args)
+            if on_success is not None:
+                on_success(data)
+        except Exception:
+            ok = False
+        else:
+            ok = True
+        with self._lock:
+            self._pending.discard(key)
+            if ok:
+                self._ok[key] = time.monotonic()
+
+    def is_pending(self, key: str) -> bool:
+        with self._lock:
+            return key in self._pending
+
+    def succeeded(self, key: str) -> bool:
+        with self._lock:
+            return key in self._ok
+
+
+@st.cache_resource
+def get_lkg_store():
+    return LastKnownGoodStore()
+
+@st.cache_resource
+def get_refresher():
+    return BackgroundRefresher()
@@ -0,0 +1,301 @@
+import argparse
+import glob
+import json
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+
+from datetime import datetime, UTC
+
+# =========================
+# PROFILER DEL RERUN (campionamento, solo admin)
+# =========================
+# Un thread campiona lo stack del thread dello script (e dei pool che lavorano per
+# lui: fetch, prefetch tabella, hedging) ogni PROFILE_INTERVAL_MS, dall'inizio del
+# rerun fino a quando il frame di streamlit_app.py esce dallo stack (fine script o
+# st.stop()). Nessuna dipendenza esterna. Per ogni rerun profilato in PROFILE_DIR:
+#
+#   <nome>.speedscope.json   da aprire su https://www.speedscope.app
+#   <nome>.folded            stack "collassati" per flamegraph.pl / inferno
+#   <nome>.summary.json      funzioni più costose, tempo per area, filtri e scope
+#
+#   python -m rerun_profiler                      elenco dei profili salvati
+#   python -m rerun_profiler <nome>.summary.json  top-N di un profilo
+
+PROFILE_DIR = os.getenv("PROFILE_DIR", os.path.join(tempfile.gettempdir(), "gestionale_ui_profiles"))
+PROFILE_INTERVAL_S = float(os.getenv("PROFILE_INTERVAL_MS", "5")) / 1000
+# profili tenuti su disco (i più vecchi vengono cancellati)
+PROFILE_KEEP = 50
+# un rerun più lungo di così viene comunque chiuso
+PROFILE_MAX_S = 300
+PROFILE_TOP_N = 25
+
+# thread dei pool che eseguono lavoro per il rerun (thread_name_prefix dei pool)
+POOL_THREAD_PREFIXES = ("fetch", "search-prefetch", "api-hedge")
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# area di un campione = la libreria più esterna nello stack: st.plotly_chart(fig)
+# conta come serializzazione Streamlit, px.line (con il pandas che usa) come Plotly
+AREAS = [
+    ("import", ("<frozen importlib",)),
+    ("http", ("/requests/", "/urllib3/", "/http/client.py", "/socket.py", "/ssl.py")),
+    ("pandas", ("/pandas/", "/numpy/", "/pyarrow/")),
+    ("plotly", ("/plotly/", "/_plotly_utils/")),
+    ("streamlit", ("/streamlit/", "/google/protobuf/")),
+]
+WAIT_FILES = ("/threading.py", "/concurrent/futures/_base.py", "/queue.py")
+
+
+def _frame_key(code):
+    return (code.co_filename, code.co_qualname, code.co_firstlineno)
+
+def _area(stack) -> str:
+    for filename, _, _ in stack:
+        for area, parts in AREAS:
+            if any(p in filename for p in parts):
+                return area
+    if stack and stack[-1][0].endswith(WAIT_FILES):
+        return "attesa pool"
+    return "app"
+
+def _short(filename: str) -> str:
+    if filename.startswith(APP_DIR):
+        return os.path.relpath(filename, APP_DIR)
+    m = re.search(r"(?:site|dist)-packages/(.+)$", filename)
+    return m.group(1) if m else os.path.basename(filename)
+
+def _frame_name(key) -> str:
+    filename, qualname, line = key
+    return f"{qualname} ({_short(filename)}:{line})"
+
+
+class RerunProfile:
+    # da creare dentro lo script: il frame del chiamante delimita il rerun
+    def __init__(self, root_frame, interval: float = PROFILE_INTERVAL_S):
+        self.thread_id = threading.get_ident()
+        self.interval = interval
+        self.started_at = datetime.now(UTC)
+        self.tags = {}
+        self.result = None
+        self.cancelled = False
+        self._root = root_frame
+        # nome thread -> [(stack, secondi)]
+        self._samples = {}
+        self._thread = threading.Thread(target=self._run, name="rerun-profiler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def tag(self, **tags):
+        self.tags.update(tags)
+
+    def cancel(self):
+        self.cancelled = True
+
+    def done(self) -> bool:
+        return not self._thread.is_alive()
+
+    def _stack(self, frame, stop_at=None):
+        # dalla radice alla foglia; con stop_at, None se il frame non è (più) nello stack
+        out = []
+        while frame is not None:
+            out.append(_frame_key(frame.f_code))
+            if frame is stop_at:
+                break
+            frame = frame.f_back
+        else:
+            if stop_at is not None:
+                return None
+        out.reverse()
+        return out
+
+    def _pool_stack(self, frame):
+        # stack di un thread del pool dal primo frame dell'app: se non c'è, il thread è fermo
+        stack = self._stack(frame)
+        for i, (filename, _, _) in enumerate(stack):
+            if filename.startswith(APP_DIR):
+                return stack[i:]
+        return None
+
+    def _add(self, thread_name, stack, weight):
+        self._samples.setdefault(thread_name, []).append((tuple(stack), weight))
+
+    def _run(self):
+        t0 = prev = time.perf_counter()
+        while not self.cancelled:
+            time.sleep(self.interval)
+            now = time.perf_counter()
+            frames = sys._current_frames()
+            stack = self._stack(frames.get(self.thread_id), stop_at=self._root)
+            if stack is None or now - t0 > PROFILE_MAX_S:
+                break
+            weight = now - prev
+            prev = now
+            self._add("script", stack, weight)
+            for th in threading.enumerate():
+                if th.name.startswith(POOL_THREAD_PREFIXES):
+                    pool_stack = self._pool_stack(frames.get(th.ident))
+                    if pool_stack:
+                        self._add(th.name, pool_stack, weight)
+            del frames
+        self.duration_s = time.perf_counter() - t0
+        self._root = None
+        if not self.cancelled and self._samples.get("script"):
+            try:
+                self.result = save(self)
+            except OSError as e:
+                self.result = {"error": str(e)}
+
+    def summary(self, top_n: int = PROFILE_TOP_N):
+        script = self._samples.get("script", [])
+        self_s = {}
+        total_s = {}
+        areas = {}
+        for stack, w in script:
+            self_s[stack[-1]] = self_s.get(stack[-1], 0.0) + w
+            # una funzione ricorsiva conta una volta per campione
+            for key in set(stack):
+                total_s[key] = total_s.get(key, 0.0) + w
+            area = _area(stack)
+            areas[area] = areas.get(area, 0.0) + w
+        sampled = sum(w for _, w in script) or 1.0
+
+        def _rows(counter):
+            return [
+                {
+                    "funzione": _frame_name(k),
+                    "self_ms": round(self_s.get(k, 0.0) * 1000, 1),
+                    "totale_ms": round(total_s.get(k, 0.0) * 1000, 1),
+                    "self_pct": round(self_s.get(k, 0.0) / sampled * 100, 1),
+                }
+                for k, _ in sorted(counter.items(), key=lambda kv: -kv[1])[:top_n]
+            ]
+
+        # solo funzioni dell'app per il "totale": il resto è sempre in cima (runner, exec)
+        app_total = {k: v for k, v in total_s.items() if k[0].startswith(APP_DIR)}
+        return {
+            "started_at": self.started_at.isoformat(),
+            "duration_s": round(self.duration_s, 3),
+            "interval_ms": round(self.interval * 1000, 1),
+            "samples": len(script),
+            "pool_samples": {t: len(v) for t, v in sorted(self._samples.items()) if t != "script"},
+            "tags": self.tags,
+            "aree_ms": {a: round(s * 1000, 1) for a, s in sorted(areas.items(), key=lambda kv: -kv[1])},
+            "top_self": _rows(self_s),
+            "top_app_totale": _rows(app_total),
+        }
+
+    def speedscope(self):
+        frames = []
+        index = {}
+
+        def _idx(key):
+            i = index.get(key)
+            if i is None:
+                i = index[key] = len(frames)
+                frames.append({"name": key[1], "file": _short(key[0]), "line": key[2]})
+            return i
+
+        profiles = []
+        for thread_name, samples in sorted(self._samples.items(), key=lambda kv: kv[0] != "script"):
+            weights = [w for _, w in samples]
+            profiles.append({
+                "type": "sampled",
+                "name": thread_name,
+                "unit": "seconds",
+                "startValue": 0,
+                "endValue": sum(weights),
+                "samples": [[_idx(k) for k in stack] for stack, _ in samples],
+                "weights": weights,
+            })
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "name": f"rerun {self.started_at:%Y-%m-%d %H:%M:%S} {self.tags.get('scope', '')}".strip(),
+            "exporter": "gestionale-ui rerun_profiler",
+            "activeProfileIndex": 0,
+            "shared": {"frames": frames},
+            "profiles": profiles,
+        }
+
+    def folded(self) -> str:
+        counts = {}
+        for thread_name, samples in self._samples.items():
+            for stack, _ in samples:
+                line = ";".join([thread_name] + [_frame_name(k).replace(";", ",") for k in stack])
+                counts[line] = counts.get(line, 0) + 1
+        return "".join(f"{line} {n}\n" for line, n in sorted(counts.items()))
+
+
+def start_rerun_profile(interval: float = PROFILE_INTERVAL_S) -> RerunProfile:
+    # chiamata dal livello modulo di streamlit_app.py
+    return RerunProfile(sys._getframe(1), interval).start()
+
+# =========================
+# FILE
+# =========================
+def _slug(text: str) -> str:
+    return re.sub(r"[^A-Za-z0-9]+", "-", text).strip("-")[:40] or "scope"
+
+def save(profile: RerunProfile, directory: str = PROFILE_DIR):
+    os.makedirs(directory, exist_ok=True)
+    base = os.path.join(
+        directory,
+        f"{profile.started_at:%Y%m%d-%H%M%S}-{profile.thread_id % 100000:05d}_{_slug(str(profile.tags.get('scope', '')))}",
+    )
+    summary = profile.summary()
+    paths = {
+        "speedscope": base + ".speedscope.json",
+        "folded": base + ".folded",
+        "summary": base + ".summary.json",
+    }
+    with open(paths["speedscope"], "w", encoding="utf-8") as f:
+        json.dump(profile.speedscope(), f)
+    with open(paths["folded"], "w", encoding="utf-8") as f:
+        f.write(profile.folded())
+    summary["files"] = paths
+    with open(paths["summary"], "w", encoding="utf-8") as f:
+        json.dump(summary, f, ensure_ascii=False, indent=2, default=str)
+    prune(directory)
+    return summary
+
+def prune(directory: str = PROFILE_DIR, keep: int = PROFILE_KEEP):
+    summaries = sorted(glob.glob(os.path.join(directory, "*.summary.json")))
+    for path in summaries[:-keep] if keep else summaries:
+        base = path[: -len(".summary.json")]
+        for ext in (".summary.json", ".speedscope.json", ".folded"):
+            try:
+                os.remove(base + ext)
+            except OSError:
+                pass
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Profili dei rerun salvati")
+    ap.add_argument("summary", nargs="?", help="file .summary.json da mostrare")
+    ap.add_argument("--top", type=int, default=15)
+    args = ap.parse_args()
+
+    if not args.summary:
+        for path in sorted(glob.glob(os.path.join(PROFILE_DIR, "*.summary.json"))):
+            with open(path, encoding="utf-8") as f:
+                s = json.load(f)
+            print(f"{os.path.basename(path):<64} {s['duration_s']:>7.2f}s  {json.dumps(s['tags'].get('filtri', {}), ensure_ascii=False)}")
+        return
+
+    with open(args.summary, encoding="utf-8") as f:
+        s = json.load(f)
+    print(f"rerun {s['started_at']} — {s['duration_s']}s, {s['samples']} campioni ogni {s['interval_ms']} ms")
+    print(f"tag: {json.dumps(s['tags'], ensure_ascii=False, default=str)}")
+    print("tempo per area (ms): " + ", ".join(f"{a} {ms:,.0f}" for a, ms in s["aree_ms"].items()))
+    print(f"{'self ms':>9} {'tot ms':>9} {'self %':>7}  funzione")
+    for row in s["top_self"][: args.top]:
+        print(f"{row['self_ms']:>9.1f} {row['totale_ms']:>9.1f} {row['self_pct']:>7.1f}  {row['funzione']}")
+
+
+if __name__ == "__main__":
+    main()
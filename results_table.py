@@ -0,0 +1,139 @@
+import threading
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import streamlit as st
+
+from api_client import api_get
+
+# =========================
+# TABELLA RISULTATI (paginazione a cursore)
+# =========================
+# /auth/search con limit + cursor (keyset): ogni pagina costa come la prima,
+# anche in fondo a una regione da 500k righe. Al browser va solo la pagina
+# corrente (Arrow), la successiva viene scaricata in background mentre si legge.
+#
+# Contratto con il backend:
+#   richiesta  limit=N, cursor=<stringa opaca> (assente per la prima pagina)
+#   risposta   {"items": [...al più N righe...], "next_cursor": <stringa> | null}
+# next_cursor null = ultima pagina. Il cursore si rimanda così com'è, insieme
+# agli stessi filtri. Un backend che non conosce i cursori non mette la chiave
+# next_cursor nella risposta: in quel caso si pagina con limit + offset (più
+# lento in fondo, ma la tabella funziona).
+
+PAGE_SIZES = [50, 100, 200, 500]
+# pagine tenute in memoria per sessione (avanti/indietro senza rifare la query)
+PAGE_CACHE_MAX = 6
+
+
+def fetch_page(tok: str, params: dict, cursor, limit: int):
+    # cursor: None (prima pagina), stringa del backend o ("offset", n) in fallback
+    p = dict(params)
+    p["limit"] = int(limit)
+    offset = None
+    if isinstance(cursor, tuple):
+        offset = p["offset"] = cursor[1]
+    elif cursor:
+        p["cursor"] = cursor
+    js = api_get("/auth/search", tok, params=p)
+    items = js.get("items", [])
+    if "next_cursor" in js:
+        return items, js["next_cursor"]
+    # niente keyset: pagina piena = forse ce n'è un'altra
+    offset = (offset or 0) + len(items)
+    return items, (("offset", offset) if len(items) >= int(limit) else None)
+
+
+@st.cache_resource
+def get_prefetch_pool():
+    return ThreadPoolExecutor(max_workers=4, thread_name_prefix="search-prefetch")
+
+
+class SearchPager:
+    # stato di paginazione di una sessione per un certo insieme di filtri:
+    # cursori delle pagine già viste (per tornare indietro) + piccola LRU di pagine
+    def __init__(self, params: dict, page_size: int):
+        self.params = dict(params)
+        self.page_size = page_size
+        self.cursors = [None]
+        self.page = 0
+        self.next_cursor = None
+        self._lock = threading.Lock()
+        self._pages = OrderedDict()
+        self._prefetch = {}
+
+    def _store(self, cursor, result):
+        with self._lock:
+            self._pages[cursor] = result
+            self._pages.move_to_end(cursor)
+            while len(self._pages) > PAGE_CACHE_MAX:
+                self._pages.popitem(last=False)
+
+    def _load(self, tok: str, cursor):
+        with self._lock:
+            hit = self._pages.get(cursor)
+            if hit is not None:
+                self._pages.move_to_end(cursor)
+                return hit
+            fut = self._prefetch.pop(cursor, None)
+
+        result = None
+        if fut is not None:
+            # prefetch ancora in volo: si aspetta quello invece di rifare la query
+            try:
+                result = fut.result()
+            except Exception:
+                result = None
+        if result is None:
+            result = fetch_page(tok, self.params, cursor, self.page_size)
+        self._store(cursor, result)
+        return result
+
+    def current(self, tok: str):
+        items, self.next_cursor = self._load(tok, self.cursors[self.page])
+        return items
+
+    def prefetch_next(self, tok: str):
+        cursor = self.next_cursor
+        if not cursor:
+            return
+        with self._lock:
+            if cursor in self._pages or cursor in self._prefetch:
+                return
+            self._prefetch[cursor] = get_prefetch_pool().submit(
+                fetch_page, tok, self.params, cursor, self.page_size
+            )
+
+    def has_next(self) -> bool:
+        return bool(self.next_cursor)
+
+    def go_next(self):
+        if not self.next_cursor:
+            return
+        del self.cursors[self.page + 1:]
+        self.cursors.append(self.next_cursor)
+        self.page += 1
+
+    def go_prev(self):
+        self.page = max(0, self.page - 1)
+
+    def go_first(self):
+        self.page = 0
+
+
+def get_pager(state_key: str, params: dict, page_size: int) -> SearchPager:
+    # nuovo pager quando cambiano filtri o righe per pagina
+    pager = st.session_state.get(state_key)
+    if pager is None or pager.params != params or pager.page_size != page_size:
+        pager = SearchPager(params, page_size)
+        st.session_state[state_key] = pager
+    return pager
+
+def to_arrow(items: list, drop=()):
+    # righe -> tabella Arrow senza passare da pandas
+    import pyarrow as pa
+
+    table = pa.Table.from_pylist(items)
+    cols = [c for c in drop if c in table.column_names]
+    return table.drop_columns(cols) if cols else table
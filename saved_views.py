@@ -0,0 +1,295 @@
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from datetime import datetime
+
+import streamlit as st
+
+from streamlit.logger import get_logger
+
+from api_client import AuthExpiredError
+from cache_warmer import view_tasks
+from fetchers import (
+    get_anni_inserimento,
+    get_gg_fasce,
+    get_eta_fasce,
+    get_eta_gg_fasce,
+    get_stats_sex,
+    get_stats_nat,
+    get_trend_annuale,
+    get_cube,
+    cached_count,
+)
+from cache_policy import clear_all
+from facets import get_facet_store
+from l2_cache import dumps, get_l2_cache, loads
+
+# =========================
+# VISTE SALVATE (materializzate)
+# =========================
+# Una vista salvata è un filtro canonico con nome (stesso JSON di make_view, con
+# l'anno più recente come "latest"), dell'utente o condivisa con tutto lo scope.
+# Un thread di background ne calcola i risultati (conteggio, le quattro statistiche,
+# trend e cubo dell'area geografica) e li salva compressi in SQLite:
+#
+#   - dopo SAVED_VIEWS_REFRESH_S dall'ultimo calcolo
+#   - dopo un import (tutte le viste diventano "stale", su tutti i worker)
+#   - subito dopo il salvataggio
+#
+# Aprire una vista mette quei risultati nella cache L1 dei fetcher: il rerun che
+# segue li trova lì e non interroga il backend (la tabella resta una query live).
+# Il calcolo usa il token di un utente dello stesso scope visto di recente da
+# questo worker: tenuto solo in memoria, mai su disco.
+#
+#   SAVED_VIEWS_DB=/var/lib/gestionale/views.sqlite   (default: file in tempdir)
+
+SAVED_VIEWS_DB = os.getenv("SAVED_VIEWS_DB", os.path.join(tempfile.gettempdir(), "gestionale_ui_views.sqlite"))
+SAVED_VIEWS_REFRESH_S = int(os.getenv("SAVED_VIEWS_REFRESH_S", str(6 * 3600)))
+SAVED_VIEWS_TICK_S = 60
+SAVED_VIEWS_MAX_PER_USER = 20
+# una vista in calcolo su un worker non viene ripresa dagli altri per così tanto
+CLAIM_S = 120
+
+# nome -> fetcher (i risultati salvati indicano la funzione per nome)
+FETCHERS = {
+    fn.__name__: fn
+    for fn in (
+        cached_count, get_stats_sex, get_stats_nat, get_gg_fasce, get_eta_fasce, get_eta_gg_fasce,
+        get_trend_annuale, get_cube,
+    )
+}
+
+log = get_logger(__name__)
+
+
+class SavedViewStore:
+    def __init__(self, path: str = SAVED_VIEWS_DB):
+        self.path = path
+        with self._connect() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS saved_views ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " scope TEXT NOT NULL, owner TEXT NOT NULL, name TEXT NOT NULL,"
+                " shared INTEGER NOT NULL DEFAULT 0, view TEXT NOT NULL,"
+                " data BLOB, bytes INTEGER NOT NULL DEFAULT 0,"
+                " refreshed_at REAL NOT NULL DEFAULT 0, stale INTEGER NOT NULL DEFAULT 1,"
+                " claimed_until REAL NOT NULL DEFAULT 0, error TEXT,"
+                " epoch INTEGER NOT NULL DEFAULT 0,"
+                " UNIQUE (scope, owner, name))"
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=2)
+
+    def list(self, scope: str, owner: str):
+        # le viste dell'utente più quelle condivise nello scope (senza i dati)
+        try:
+            with self._connect() as db:
+                rows = db.execute(
+                    "SELECT id, owner, name, shared, view, bytes, refreshed_at, stale, error FROM saved_views"
+                    " WHERE scope = ? AND (owner = ? OR shared = 1) ORDER BY name, owner",
+                    (scope, owner),
+                ).fetchall()
+        except sqlite3.Error:
+            return []
+        keys = ("id", "owner", "name", "shared", "view", "bytes", "refreshed_at", "stale", "error")
+        return [dict(zip(keys, r)) for r in rows]
+
+    def save(self, scope: str, owner: str, name: str, view: str, shared: bool) -> bool:
+        # False se l'utente ha già troppe viste (sovrascrivere una esistente è sempre possibile)
+        with self._connect() as db:
+            exists = db.execute(
+                "SELECT 1 FROM saved_views WHERE scope = ? AND owner = ? AND name = ?", (scope, owner, name)
+            ).fetchone()
+            n = db.execute(
+                "SELECT COUNT(*) FROM saved_views WHERE scope = ? AND owner = ?", (scope, owner)
+            ).fetchone()[0]
+            if not exists and n >= SAVED_VIEWS_MAX_PER_USER:
+                return False
+            db.execute(
+                "INSERT INTO saved_views (scope, owner, name, shared, view) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (scope, owner, name) DO UPDATE SET"
+                " shared = excluded.shared, view = excluded.view,"
+                " data = NULL, bytes = 0, stale = 1, claimed_until = 0, error = NULL",
+                (scope, owner, name, int(bool(shared)), view),
+            )
+        return True
+
+    def delete(self, view_id: int, owner: str):
+        # solo il proprietario
+        with self._connect() as db:
+            db.execute("DELETE FROM saved_views WHERE id = ? AND owner = ?", (view_id, owner))
+
+    def load(self, view_id: int):
+        # (view, risultati); risultati None se mai calcolati o da ricalcolare dopo un import
+        try:
+            with self._connect() as db:
+                row = db.execute("SELECT view, data, stale FROM saved_views WHERE id = ?", (view_id,)).fetchone()
+        except sqlite3.Error:
+            return None
+        if row is None:
+            return None
+        view, data, stale = row
+        return json.loads(view), (loads(data) if data is not None and not stale else None)
+
+    def report(self):
+        try:
+            with self._connect() as db:
+                rows = db.execute(
+                    "SELECT scope, COUNT(*), SUM(shared), SUM(stale), SUM(bytes), MIN(refreshed_at),"
+                    " SUM(error IS NOT NULL) FROM saved_views GROUP BY scope ORDER BY scope"
+                ).fetchall()
+        except sqlite3.Error:
+            return []
+        return [
+            {
+                "scope": scope,
+                "viste": n,
+                "condivise": shared,
+                "da_ricalcolare": stale,
+                "kb": round((size or 0) / 1024, 1),
+                "piu_vecchia": datetime.fromtimestamp(oldest).strftime("%d/%m %H:%M") if oldest else None,
+                "errori": errors,
+            }
+            for scope, n, shared, stale, size, oldest, errors in rows
+        ]
+
+    def mark_all_stale(self):
+        try:
+            with self._connect() as db:
+                # epoch: un calcolo partito prima dell'import non può segnarla come fresca
+                db.execute("UPDATE saved_views SET stale = 1, epoch = epoch + 1")
+        except sqlite3.Error:
+            pass
+
+    def claim_due(self, scope: str, max_age: float):
+        # prende (id, view, epoch) delle viste da ricalcolare e le riserva per CLAIM_S
+        now = time.time()
+        with self._connect() as db:
+            rows = db.execute(
+                "SELECT id, view, epoch FROM saved_views WHERE scope = ? AND claimed_until < ?"
+                " AND (stale = 1 OR refreshed_at < ?)",
+                (scope, now, now - max_age),
+            ).fetchall()
+            claimed = []
+            for view_id, view, epoch in rows:
+                cur = db.execute(
+                    "UPDATE saved_views SET claimed_until = ? WHERE id = ? AND claimed_until < ?",
+                    (now + CLAIM_S, view_id, now),
+                )
+                if cur.rowcount:
+                    claimed.append((view_id, view, epoch))
+        return claimed
+
+    def store(self, view_id: int, epoch: int, blob: bytes):
+        with self._connect() as db:
+            db.execute(
+                "UPDATE saved_views SET data = ?, bytes = ?, refreshed_at = ?, stale = 0,"
+                " claimed_until = 0, error = NULL WHERE id = ? AND epoch = ?",
+                (blob, len(blob), time.time(), view_id, epoch),
+            )
+
+    def failed(self, view_id: int, error: str):
+        # si riprova al giro successivo del refresher
+        with self._connect() as db:
+            db.execute(
+                "UPDATE saved_views SET claimed_until = 0, error = ? WHERE id = ?", (error[:500], view_id)
+            )
+
+# =========================
+# MATERIALIZZAZIONE
+# =========================
+def materialize(tok: str, scope: str, view: dict) -> list:
+    # stesse chiamate della UI (piano del cache warmer): [[nome fetcher, args, risultato]]
+    # import fatto da un altro worker: la L1 di questo processo è vecchia (come nello script)
+    l2 = get_l2_cache()
+    if l2 is not None and l2.sync_generation():
+        clear_all()
+        get_facet_store().clear()
+    anni = get_anni_inserimento(tok, scope)
+    latest_anno = anni[0][0] if anni else None
+    # il cubo sempre: con i risultati progressivi la pagina lo chiede anche senza cubo locale
+    tasks = view_tasks(scope, {**view, "cube": True}, latest_anno)
+    return [[fn.__name__, list(args), fn(tok, *args)] for fn, args in tasks]
+
+def prime_caches(results: list, tok: str) -> int:
+    # risultati di una vista -> cache L1 dei fetcher (stesse chiavi delle chiamate della pagina)
+    n = 0
+    for name, args, data in results:
+        fn = FETCHERS.get(name)
+        if fn is not None:
+            fn.prime(data, tok, *args)
+            n += 1
+    return n
+
+
+class ViewRefresher:
+    # un thread per processo; i token restano in memoria (scope -> ultimo token visto)
+    def __init__(self, store: SavedViewStore):
+        self.store = store
+        self._lock = threading.Lock()
+        self._tokens = {}
+        self._wake = threading.Event()
+        self._thread = None
+        self.refreshed = 0
+        self.errors = 0
+
+    def remember(self, scope: str, tok: str):
+        with self._lock:
+            self._tokens[scope] = tok
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="saved-views", daemon=True)
+                self._thread.start()
+
+    def wake(self):
+        self._wake.set()
+
+    def _forget(self, scope, tok):
+        with self._lock:
+            if self._tokens.get(scope) == tok:
+                del self._tokens[scope]
+
+    def _run(self):
+        while True:
+            with self._lock:
+                tokens = list(self._tokens.items())
+            for scope, tok in tokens:
+                self._refresh_scope(scope, tok)
+            self._wake.wait(SAVED_VIEWS_TICK_S)
+            self._wake.clear()
+
+    def _refresh_scope(self, scope, tok):
+        try:
+            due = self.store.claim_due(scope, SAVED_VIEWS_REFRESH_S)
+        except sqlite3.Error:
+            return
+        for view_id, view, epoch in due:
+            try:
+                blob = dumps(materialize(tok, scope, json.loads(view)))
+                self.store.store(view_id, epoch, blob)
+                self.refreshed += 1
+            except AuthExpiredError:
+                # token scaduto: lo scope aspetta il prossimo utente
+                self.store.failed(view_id, "token scaduto")
+                self._forget(scope, tok)
+                return
+            except Exception as e:
+                self.errors += 1
+                log.warning("vista salvata %s non aggiornata: %s", view_id, e)
+                try:
+                    self.store.failed(view_id, str(e))
+                except sqlite3.Error:
+                    pass
+
+
+@st.cache_resource
+def get_saved_views():
+    return SavedViewStore()
+
+@st.cache_resource
+def get_view_refresher():
+    return ViewRefresher(get_saved_views())
@@ -0,0 +1,180 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import sqlite3
+import tempfile
+import time
+
+import streamlit as st
+
+from streamlit.logger import get_logger
+
+# =========================
+# SESSIONI LATO SERVER (niente CookieManager)
+# =========================
+# Il CookieManager è un componente custom: al primo run i cookie non ci sono, li
+# manda il browser dopo il montaggio e lo script riparte una seconda volta.
+# Qui il cookie si legge da st.context.cookies (header della richiesta, già
+# disponibili al primo run) e contiene solo un id di sessione firmato:
+#
+#   cookie  = <id>.<pad>.<firma HMAC>
+#   SQLite  = id -> token XOR pad, scadenza
+#
+# Il token non sta né solo nel cookie né solo su disco: servono entrambi.
+# Il cookie viene scritto una volta (dopo ?token= o la migrazione dal vecchio
+# cookie) con un frammento JS che non restituisce valori, quindi senza rerun.
+#
+# Limite: scritto da JavaScript, il cookie non può essere HttpOnly. Uno script
+# iniettato nella pagina (XSS) può leggere id e pad e, finché la sessione è
+# valida, usarla. Un cookie HttpOnly deve arrivare da un header Set-Cookie del
+# server, che uno script Streamlit non può mandare (vedi README).
+#
+#   SESSION_DB=/var/lib/gestionale/sessions.sqlite   (default: file in tempdir)
+#   SESSION_SECRET=...   chiave di firma condivisa dai worker, da impostare in
+#                        produzione; se manca viene generata in <SESSION_DB>.secret
+#                        (solo questo host: con più repliche le sessioni non
+#                        vengono riconosciute dalle altre) e il log lo segnala
+
+SESSION_DB = os.getenv("SESSION_DB", os.path.join(tempfile.gettempdir(), "gestionale_ui_sessions.sqlite"))
+SESSION_SECRET = os.getenv("SESSION_SECRET", "")
+# come il vecchio cookie del token
+SESSION_TTL_S = 12 * 3600
+
+log = get_logger(__name__)
+
+_COOKIE_JS = """
+<script>
+const secure = window.parent.location.protocol === "https:" ? "; Secure" : "";
+window.parent.document.cookie = {name} + "=" + {value} + "; path=/; max-age={max_age}; SameSite=Lax" + secure;
+</script>
+"""
+
+
+def _b64(raw: bytes) -> str:
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode("ascii")
+
+def _unb64(text: str) -> bytes:
+    return base64.urlsafe_b64decode(text + "=" * (-len(text) % 4))
+
+def _xor(a: bytes, b: bytes) -> bytes:
+    return bytes(x ^ y for x, y in zip(a, b))
+
+def _load_secret(path: str) -> bytes:
+    if SESSION_SECRET:
+        return SESSION_SECRET.encode("utf-8")
+    log.warning(
+        "SESSION_SECRET non impostata: chiave di firma delle sessioni in %s, valida solo "
+        "su questo host. Con più repliche impostare SESSION_SECRET uguale per tutte.",
+        path,
+    )
+    try:
+        with open(path, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        pass
+    secret = secrets.token_bytes(32)
+    try:
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except FileExistsError:
+        # creato da un altro worker nel frattempo
+        with open(path, "rb") as f:
+            return f.read()
+    with os.fdopen(fd, "wb") as f:
+        f.write(secret)
+    return secret
+
+
+class SessionStore:
+    def __init__(self, path: str = SESSION_DB, ttl: float = SESSION_TTL_S):
+        self.path = path
+        self.ttl = ttl
+        self._secret = _load_secret(path + ".secret")
+        with self._connect() as db:
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                " id TEXT PRIMARY KEY, blob BLOB NOT NULL, expires REAL NOT NULL)"
+            )
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=2)
+
+    def _sign(self, sid: str, pad: str) -> str:
+        return _b64(hmac.new(self._secret, f"{sid}.{pad}".encode("ascii"), hashlib.sha256).digest()[:16])
+
+    def _parse(self, cookie: str):
+        # None se il cookie è malformato o la firma non torna (niente query su disco)
+        parts = (cookie or "").split(".")
+        if len(parts) != 3:
+            return None
+        sid, pad, sig = parts
+        if not hmac.compare_digest(sig, self._sign(sid, pad)):
+            return None
+        return sid, pad
+
+    def create(self, token: str) -> str:
+        raw = token.strip().encode("utf-8")
+        pad = secrets.token_bytes(len(raw))
+        sid = _b64(secrets.token_bytes(18))
+        now = time.time()
+        with self._connect() as db:
+            db.execute("DELETE FROM sessions WHERE expires <= ?", (now,))
+            db.execute(
+                "INSERT INTO sessions (id, blob, expires) VALUES (?, ?, ?)",
+                (sid, _xor(raw, pad), now + self.ttl),
+            )
+        pad_s = _b64(pad)
+        return f"{sid}.{pad_s}.{self._sign(sid, pad_s)}"
+
+    def resolve(self, cookie: str):
+        parsed = self._parse(cookie)
+        if parsed is None:
+            return None
+        sid, pad_s = parsed
+        try:
+            with self._connect() as db:
+                row = db.execute(
+                    "SELECT blob FROM sessions WHERE id = ? AND expires > ?", (sid, time.time())
+                ).fetchone()
+        except sqlite3.Error:
+            return None
+        if row is None:
+            return None
+        pad = _unb64(pad_s)
+        if len(pad) != len(row[0]):
+            return None
+        try:
+            return _xor(row[0], pad).decode("utf-8")
+        except UnicodeDecodeError:
+            return None
+
+    def delete(self, cookie: str):
+        parsed = self._parse(cookie)
+        if parsed is None:
+            return
+        try:
+            with self._connect() as db:
+                db.execute("DELETE FROM sessions WHERE id = ?", (parsed[0],))
+        except sqlite3.Error:
+            pass
+
+
+@st.cache_resource
+def get_session_store():
+    return SessionStore()
+
+# =========================
+# COOKIE NEL BROWSER (solo scrittura)
+# =========================
+def set_browser_cookie(name: str, value: str, max_age: int = SESSION_TTL_S):
+    # iframe same-origin senza contenuto visibile: scrive sul documento della pagina
+    # (nome e valore sono generati qui, mai presi dall'utente)
+    st.iframe(
+        _COOKIE_JS.format(name=json.dumps(name), value=json.dumps(value), max_age=int(max_age)),
+        height="content",
+    )
+
+def clear_browser_cookie(name: str):
+    set_browser_cookie(name, "", max_age=0)
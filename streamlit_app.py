@@ -1,70 +1,159 @@
+import functools
+import os
 import time
-import requests
-import pandas as pd
+import threading
 import streamlit as st
-import plotly.express as px
-import os
-import extra_streamlit_components as stx
 import tempfile
 
-from requests.adapters import HTTPAdapter
-from urllib3.util.retry import Retry
-from datetime import datetime, UTC, timedelta
+from concurrent.futures import FIRST_COMPLETED, wait
+from datetime import datetime, UTC
+
+from api_client import (
+    AuthExpiredError,
+    ApiUnavailableError,
+    ApiRequestError,
+    ApiNotSupportedError,
+    bind_rerun_deadline,
+    endpoint_supported,
+    get_admission,
+    get_balancer,
+    start_rerun_deadline,
+    api_healthcheck,
+    api_get,
+    api_get_raw,
+    api_post_multipart,
+    set_rerun_offline,
+    set_rerun_scope,
+)
+from app_config import (
+    COOKIE_TOKEN_KEY,
+    SESSION_COOKIE_KEY,
+    HIDE_DF_TOOLBAR_CSS,
+    NO_DATA_CAPTION,
+    ETA_OPTIONS,
+    ETA_MAP,
+    GG_OPTIONS,
+    GG_MAP,
+    TREND_OPTIONS,
+)
+from facets import (
+    FACET_TOP_N,
+    PrefixIndex,
+    get_facet_store,
+    merge_facets,
+    memory_report,
+)
+from lkg_store import LKG_RETRY_EVERY_S, token_scope, get_lkg_store, get_refresher
+from cache_warmer import GEO_KEYS, LATEST, get_cache_warmer, get_usage_log, make_view
+from results_table import PAGE_SIZES, get_pager, to_arrow
+from l2_cache import get_l2_cache
+from cache_policy import cache_report, clear_all, start_cache_reporter
+from rerun_profiler import start_rerun_profile
+from session_store import clear_browser_cookie, get_session_store, set_browser_cookie
+from saved_views import get_saved_views, get_view_refresher, prime_caches
+from geo_shapes import get_geo_shapes
+from import_queue import (
+    IMPORT_BATCH_MODES,
+    IMPORT_CONCURRENCY,
+    IMPORT_MAX_CONCURRENCY,
+    IMPORT_POLL_S,
+    IMPORT_RETRIES,
+    ImportTask,
+    get_import_queue,
+    incremental_diff,
+)
+from fetchers import (
+    canonical_params,
+    profile_scope,
+    get_anni_inserimento,
+    get_regioni,
+    get_province_with_counts,
+    get_comuni_for_prov_with_counts,
+    get_province_nascita_with_counts,
+    get_comuni_nascita_for_prov_with_counts,
+    get_gg_fasce,
+    get_eta_fasce,
+    get_eta_gg_fasce,
+    get_stats_sex,
+    get_stats_nat,
+    get_trend_annuale,
+    get_cube,
+    get_geo_counts,
+    cached_count,
+    get_fetch_pool,
+)
 
 st.set_page_config(page_title="Gestionale Elenchi", layout="wide")
-cookie_manager = stx.CookieManager()
-COOKIE_TOKEN_KEY = "union_auth_token"
-
-HIDE_DF_TOOLBAR_CSS = """
-<style>
-/* Toolbar “overlay” (download/search/fullscreen) in varie versioni Streamlit */
-div[data-testid="stElementToolbar"],
-div[data-testid="stToolbar"],
-div[data-testid="stToolbarActions"],
-div[data-testid="stElementToolbarButton"],
-div[data-testid="stElementToolbarButton"] > button {
-  display: none !important;
-  visibility: hidden !important;
-  opacity: 0 !important;
-  height: 0 !important;
-}
-
-/* Variante: alcuni build usano classi diverse */
-.stElementToolbar,
-.stToolbar {
-  display: none !important;
-  visibility: hidden !important;
-}
-</style>
-"""
-
-
-API_BASE = os.getenv("API_BASE", "http://localhost:8000")
+start_rerun_deadline()
 
+# pandas/plotly servono solo alle sezioni grafici: su un worker appena avviato
+# li importiamo in background mentre sidebar e facet vengono disegnati
+@st.cache_resource
+def prewarm_chart_libs():
+    def _load():
+        import pandas  # noqa: F401
+        import plotly.express  # noqa: F401
+    t = threading.Thread(target=_load, name="prewarm-chart-libs", daemon=True)
+    t.start()
+    return t
+
+prewarm_chart_libs()
+start_cache_reporter()
+
+# profilo a campionamento di questo rerun (solo admin, vedi sotto):
+# ?profile=1 nell'URL oppure toggle "Profila ogni rerun" nella sezione admin
+rerun_profile = None
+if st.query_params.get("profile") == "1" or st.session_state.get("profile_reruns"):
+    rerun_profile = start_rerun_profile()
+
+LOCAL_CUBE_DEFAULT = os.getenv("LOCAL_CUBE", "0") == "1"
+PROGRESSIVE_DEFAULT = os.getenv("PROGRESSIVE_STATS", "1") == "1"
+# se le query esatte non arrivano entro questo tempo si mostra prima la stima
+ESTIMATE_AFTER_S = 0.3
+ESTIMATE_CUBE_WAIT_S = 0.3
+# confronto tra regioni: regioni al massimo e richieste in volo insieme
+COMPARE_MAX_REGIONS = 20
+COMPARE_CONCURRENCY = int(os.getenv("COMPARE_CONCURRENCY", "6"))
+COMPARE_COLUMNS = 4
+# valori della heatmap età x giornate -> misura nelle righe di /auth/eta-gg-fasce
+ETA_GG_MEASURES = {"Braccianti": "count", "Giornate lavorate (GG TOT)": "gg_tot"}
+# metrica della mappa -> posizione nella tupla (codice, count, gg_tot)
+MAP_METRICS = {"Braccianti": 1, "Giornate lavorate (GG TOT)": 2}
 # =========================
 # TOKEN HANDLING ROBUSTO
 # =========================
 
-# 1) Se arriva da URL, salvalo sia in session_state che in cookie
+def start_browser_session(tok: str):
+    # sessione lato server + cookie con l'id firmato (session_store.py)
+    cookie = get_session_store().create(tok)
+    st.session_state["_session_cookie"] = cookie
+    set_browser_cookie(SESSION_COOKIE_KEY, cookie)
+
+# 1) Se arriva da URL, salvalo in session_state e apri una sessione lato server
 if "token" in st.query_params:
     incoming = (st.query_params.get("token", "") or "").strip()
     if incoming:
         st.session_state["auth_token"] = incoming
-        cookie_manager.set(
-            COOKIE_TOKEN_KEY,
-            incoming,
-            expires_at=datetime.now(UTC) + timedelta(hours=12),
-            key="set_auth_token_cookie",
-        )
+        start_browser_session(incoming)
 
     # 2) Rimuovi subito il token dalla URL
     st.query_params.clear()
 
-# 3) Se manca dalla sessione, prova a recuperarlo dal cookie
+# 3) Se manca dalla sessione, prova a recuperarlo dal cookie: st.context.cookies
+#    arriva con la richiesta, quindi il token è risolto già al primo run
 if "auth_token" not in st.session_state or not st.session_state.get("auth_token"):
-    cookie_token = cookie_manager.get(COOKIE_TOKEN_KEY)
+    session_cookie = st.context.cookies.get(SESSION_COOKIE_KEY, "")
+    cookie_token = get_session_store().resolve(session_cookie)
     if cookie_token:
         st.session_state["auth_token"] = cookie_token
+        st.session_state["_session_cookie"] = session_cookie
+    else:
+        # cookie del vecchio CookieManager con il token in chiaro: migrato una volta
+        legacy_token = (st.context.cookies.get(COOKIE_TOKEN_KEY, "") or "").strip()
+        if legacy_token:
+            st.session_state["auth_token"] = legacy_token
+            start_browser_session(legacy_token)
+            clear_browser_cookie(COOKIE_TOKEN_KEY)
 
 # 4) Usa sempre il token dalla sessione
 token = st.session_state.get("auth_token", "")
@@ -73,148 +162,115 @@ if not token:
     st.error("Sessione non valida. Accedi dal portale.")
     st.stop()
 
-class AuthExpiredError(Exception):
-    pass
-# =========================
-# HTTP session + API helpers
-# =========================
-@st.cache_resource
-def get_session():
-    s = requests.Session()
-    retry = Retry(
-        total=3,
-        backoff_factor=0.6,
-        status_forcelist=[429, 502, 503, 504],
-        allowed_methods=["GET", "POST"],
-        raise_on_status=False,
-    )
-    adapter = HTTPAdapter(max_retries=retry, pool_connections=10, pool_maxsize=10)
-    s.mount("http://", adapter)
-    s.mount("https://", adapter)
-    return s
+def force_logout(message: str):
+    st.session_state.pop("auth_token", None)
 
-def auth_headers(tok: str):
-    return {"Authorization": f"Bearer {tok.strip()}"}
+    existing = st.session_state.pop("_session_cookie", None) or st.context.cookies.get(SESSION_COOKIE_KEY)
+    if existing:
+        get_session_store().delete(existing)
+        clear_browser_cookie(SESSION_COOKIE_KEY)
+    if st.context.cookies.get(COOKIE_TOKEN_KEY):
+        clear_browser_cookie(COOKIE_TOKEN_KEY)
 
-def api_healthcheck():
-    s = get_session()
-    try:
-        r = s.get(f"{API_BASE}/health", timeout=(3, 6))
-        return r.status_code == 200
-    except Exception:
-        return False
+    st.error(message)
+    st.stop()
 
-def api_get(path: str, tok: str, params=None):
-    s = get_session()
+def run_or_logout(fn, *args, **kwargs):
     try:
-        r = s.get(
-            f"{API_BASE}{path}",
-            headers=auth_headers(tok),
-            params=params,
-            timeout=(5, 30),
-        )
-    except requests.exceptions.ConnectTimeout:
-        st.error("API non raggiungibile (connect timeout). Controlla API_BASE / DNS / host.")
-        st.stop()
-    except requests.exceptions.ReadTimeout:
-        st.error("API raggiunta ma non risponde in tempo (read timeout). Probabile cold-start o backend bloccato.")
-        st.stop()
-    except requests.RequestException as e:
-        st.error(f"Errore rete chiamando l’API: {e}")
-        st.stop()
-
-    if r.status_code == 401:
-        raise AuthExpiredError("Token non valido o scaduto")
-    if r.status_code >= 400:
-        st.error(f"Errore API {r.status_code}: {r.text[:800]}")
+        return fn(*args, **kwargs)
+    except AuthExpiredError:
+        force_logout("Token non valido o scaduto. Accedi nuovamente dal portale.")
+    except ApiUnavailableError as e:
+        st.error(str(e))
         st.stop()
-    return r.json()
 
-def api_get_raw(path: str, tok: str, params=None) -> bytes:
-    s = get_session()
-    try:
-        r = s.get(
-            f"{API_BASE}{path}",
-            headers=auth_headers(tok),
-            params=params,
-            timeout=(10, 300),
-        )
-    except requests.exceptions.ConnectTimeout:
-        st.error("API non raggiungibile (connect timeout).")
-        st.stop()
-    except requests.exceptions.ReadTimeout:
-        st.error("Timeout durante il download (read timeout).")
-        st.stop()
-    except requests.RequestException as e:
-        st.error(f"Errore rete durante download: {e}")
-        st.stop()
+# =========================
+# LAST-KNOWN-GOOD (fallback se il backend è lento o giù)
+# =========================
+# scope con cui vengono salvate le risposte: prima di whoami è l'hash del token,
+# dopo diventa lo scope del profilo (ruolo + livello + valori)
+lkg_scope = token_scope(token)
+stale_banner = st.empty()
+stale_watch = st.container()
+
+def _submit_refresh(key, fn, tok, args, scope):
+    store = get_lkg_store()
+    get_refresher().submit(
+        key,
+        fn, tok, *args,
+        on_success=lambda data: store.save(fn.__name__, scope, args, data),
+    )
 
-    if r.status_code == 401:
-        raise AuthExpiredError("Token non valido o scaduto")
-    if r.status_code >= 400:
-        st.error(f"Errore API {r.status_code}: {r.text[:800]}")
-        st.stop()
+def _note_stale(fn, tok, args, entry):
+    stale = st.session_state.setdefault("_lkg_stale", {})
+    first = not stale
+    stale[entry.key] = (fn, tok, args, lkg_scope, entry.saved_at)
+    _submit_refresh(entry.key, fn, tok, args, lkg_scope)
 
-    return r.content
+    oldest = min(v[-1] for v in stale.values())
+    stale_banner.warning(
+        "Backend lento o non raggiungibile: alcuni dati provengono dall'ultima copia valida. "
+        f"Dati al {oldest.astimezone():%d/%m/%Y %H:%M}."
+    )
+    if first:
+        with stale_watch:
+            stale_retry_watch()
 
-def api_post_multipart(path: str, tok: str, files=None, data=None):
-    s = get_session()
+def _fetch_with_lkg(fn, tok, args, pending=None):
+    store = get_lkg_store()
     try:
-        r = s.post(
-            f"{API_BASE}{path}",
-            headers=auth_headers(tok),
-            files=files,
-            data=data,
-            timeout=(10, 60),
-        )
-    except requests.exceptions.ConnectTimeout:
-        st.error("API non raggiungibile (connect timeout).")
-        st.stop()
-    except requests.exceptions.ReadTimeout:
-        st.error("Timeout durante la POST (read timeout). Import potrebbe essere partito o backend bloccato.")
-        st.stop()
-    except requests.RequestException as e:
-        st.error(f"Errore rete durante POST: {e}")
-        st.stop()
-
-    if r.status_code == 401:
-        raise AuthExpiredError("Token non valido o scaduto")
-    if r.status_code >= 400:
-        st.error(f"Errore API {r.status_code}: {r.text[:800]}")
+        # pending: stessa chiamata già lanciata in background (risultati progressivi)
+        data = pending.result() if pending is not None else fn(tok, *args)
+    except ApiUnavailableError:
+        entry = store.load(fn.__name__, lkg_scope, args)
+        if entry is None:
+            raise
+        _note_stale(fn, tok, args, entry)
+        return entry.data
+    store.save(fn.__name__, lkg_scope, args, data)
+    return data
+
+def run_or_stale(fn, tok, *args):
+    # fetcher indispensabili (whoami, facet): copia LKG se l'API non risponde,
+    # altrimenti la pagina si ferma come prima
+    try:
+        return _fetch_with_lkg(fn, tok, args)
+    except AuthExpiredError:
+        force_logout("Token non valido o scaduto. Accedi nuovamente dal portale.")
+    except ApiUnavailableError as e:
+        st.error(str(e))
         st.stop()
-    return r.json()
 
-def force_logout(message: str):
-    st.session_state.pop("auth_token", None)
-
-    existing = cookie_manager.get(COOKIE_TOKEN_KEY)
-    if existing:
-        cookie_manager.delete(COOKIE_TOKEN_KEY, key="delete_auth_cookie_safe")
-
-    st.error(message)
-    st.stop()
-
-def run_or_logout(fn, *args, **kwargs):
+def run_or_degrade(fn, tok, *args, pending=None):
+    # come run_or_stale, ma senza copia LKG la sezione viene saltata
+    # (ritorna None) invece di fermare tutta la pagina
     try:
-        return fn(*args, **kwargs)
+        return _fetch_with_lkg(fn, tok, args, pending)
     except AuthExpiredError:
         force_logout("Token non valido o scaduto. Accedi nuovamente dal portale.")
+    except ApiUnavailableError as e:
+        st.warning(f"Dati parziali: {e}")
+        return None
+    except ApiNotSupportedError:
+        # endpoint opzionale assente sul backend: decide chi chiama cosa mostrare
+        raise
+    except ApiRequestError as e:
+        # 4xx arrivato da un thread di background: qui si ferma la pagina come prima
+        st.error(str(e))
+        st.stop()
 
-@st.cache_data(ttl=600, show_spinner=False)
-def get_anni_inserimento(tok: str):
-    js = api_get("/auth/anni-inserimento", tok)
-    return [(x["anno"], x["count"]) for x in js.get("items", []) if x.get("anno") is not None]
-
-@st.cache_data(ttl=600, show_spinner=False)
-def get_regioni(tok: str):
-    js = api_get("/auth/regioni", tok)
-    out = []
-    for x in js.get("items", []):
-        r = x.get("regione")
-        c = x.get("count", 0)
-        if r:
-            out.append((r, int(c) if c is not None else 0))
-    return out
+@st.fragment(run_every=LKG_RETRY_EVERY_S)
+def stale_retry_watch():
+    # riprova i refresh falliti; quando sono tutti riusciti, rerun completo
+    stale = st.session_state.get("_lkg_stale", {})
+    refresher = get_refresher()
+    for key, (fn, tok, args, scope, _) in list(stale.items()):
+        if not refresher.succeeded(key) and not refresher.is_pending(key):
+            _submit_refresh(key, fn, tok, args, scope)
+    if stale and all(refresher.succeeded(k) for k in stale):
+        st.session_state["_lkg_stale"] = {}
+        st.rerun(scope="app")
+    st.caption("Nuovo tentativo di aggiornamento in background…")
 
 # =========================
 # SIDEBAR (auth)
@@ -236,9 +292,26 @@ if not token:
     st.warning("Inserisci un token valido per iniziare.")
     st.stop()
 
+# ogni rerun riparte pulito: il banner riflette solo i dati stale di questo rerun
+st.session_state["_lkg_stale"] = {}
+
 if not api_healthcheck():
-    st.error("Backend API non raggiungibile o non pronto. (health fallita)")
-    st.stop()
+    # niente stop: i fetcher servono l'ultima copia valida, se c'è
+    set_rerun_offline("Backend API non raggiungibile o non pronto. (health fallita)")
+
+def invalidate_caches():
+    # L1 di questo processo + generazione L2: gli altri worker svuotano la loro L1
+    clear_all()
+    get_facet_store().clear()
+    l2 = get_l2_cache()
+    if l2 is not None:
+        l2.invalidate()
+
+# import fatto da un altro worker (o dalla CLI): la L1 di questo processo è vecchia
+l2 = get_l2_cache()
+if l2 is not None and l2.sync_generation():
+    clear_all()
+    get_facet_store().clear()
 
 # =========================
 # WHOAMI (cached)
@@ -246,7 +319,7 @@ if not api_healthcheck():
 def load_whoami(tok: str):
     return api_get("/auth/whoami", tok)
 
-who = run_or_logout(load_whoami, token)
+who = run_or_stale(load_whoami, token)
 role = (who.get("role") or "").lower()
 regione = who.get("regione")
 
@@ -254,117 +327,59 @@ scope_level = (who.get("scope_level") or "").lower().strip()
 scope_values_csv = (who.get("scope_values") or "").strip()
 scope_values = [v.strip().upper() for v in scope_values_csv.split(",") if v.strip()]
 
+# scope del profilo: chiave per LKG, FacetStore e cache dei fetcher
+lkg_scope = profile_scope(who)
+# da qui i limiti di richieste valgono anche per lo scope (admission.py)
+set_rerun_scope(lkg_scope)
+
 # =========================
 # RUOLO / REGIONE (per UI e regole)
 # =========================
 is_admin = (role == "administrator")
 user_region = (regione or "").upper()
 
-st.info(f"Utente: {who.get('username')} — Ruolo: {role or 'n/a'} — Regione: {regione or 'n/a'}")
+if rerun_profile is not None:
+    if is_admin:
+        rerun_profile.tag(scope=lkg_scope, utente=who.get("username"))
+        profiles = st.session_state.setdefault("_rerun_profiles", [])
+        profiles.append(rerun_profile)
+        del profiles[:-5]
+    else:
+        rerun_profile.cancel()
+        rerun_profile = None
 
-# =========================
-# FACETS (cached) - con conteggi
-# =========================
-@st.cache_data(ttl=600, show_spinner=False)
-def get_province_with_counts(tok: str, region_filter: tuple[str, ...]):
-    params = {}
-    if region_filter:
-        params["regione"] = list(region_filter)
-    js = api_get("/auth/province", tok, params=params)
-
-    out = []
-    for x in js.get("items", []):
-        p = x.get("provincia")
-        c = x.get("count", 0)
-        if p:
-            out.append((p, int(c) if c is not None else 0))
-    return out
-
-@st.cache_data(ttl=600, show_spinner=False)
-def get_comuni_for_prov_with_counts(tok: str, prov: str):
-    js = api_get("/auth/comuni", tok, params={"provincia": prov})
-    out = []
-    for x in js.get("items", []):
-        c = x.get("comune")
-        n = x.get("count", 0)
-        if c:
-            out.append((c, int(n) if n is not None else 0))
-    return out
-
-@st.cache_data(ttl=600, show_spinner=False)
-def get_province_nascita_with_counts(tok: str):
-    js = api_get("/auth/province-nascita", tok)
-    out = []
-    for x in js.get("items", []):
-        p = x.get("prov_nascita")
-        c = x.get("count", 0)
-        if p:
-            out.append((p, int(c) if c is not None else 0))
-    return out
-
-@st.cache_data(ttl=600, show_spinner=False)
-def get_comuni_nascita_for_prov_with_counts(tok: str, prov_n: str):
-    js = api_get("/auth/comuni-nascita", tok, params={"prov_nascita": prov_n})
-    out = []
-    for x in js.get("items", []):
-        c = x.get("comune_nascita")
-        n = x.get("count", 0)
-        if c:
-            out.append((c, int(n) if n is not None else 0))
-    return out
-    
-@st.cache_data(ttl=30, show_spinner=False)
-def get_gg_fasce(tok: str, params: dict):
-    p = dict(params)
-    # p.pop("limit", None)
-    # p.pop("offset", None)
-    return api_get("/auth/gg-fasce", tok, params=p)
-
-@st.cache_data(ttl=30, show_spinner=False)
-def get_eta_fasce(tok: str, params: dict):
-    p = dict(params)
-    return api_get("/auth/eta-fasce", tok, params=p)
-
-@st.cache_data(ttl=30, show_spinner=False)
-def get_stats_sex(tok: str, params: dict):
-    p = dict(params)
-    # p.pop("limit", None)
-    # p.pop("offset", None)
-    return api_get("/auth/stats-sex", tok, params=p)
-
-@st.cache_data(ttl=30, show_spinner=False)
-def get_stats_nat(tok: str, params: dict):
-    p = dict(params)
-    # p.pop("limit", None)
-    # p.pop("offset", None)
-    return api_get("/auth/stats-nat", tok, params=p)
-
-@st.cache_data(ttl=60, show_spinner=False)
-def get_trend_annuale(tok: str, metrica: str, apply_geo: bool, geo_params: dict):
-    params = {"metrica": metrica, "apply_geo": apply_geo}
-    if apply_geo:
-        if geo_params.get("regione"):
-            params["regione"] = geo_params["regione"]
-        if geo_params.get("provincia"):
-            params["provincia"] = geo_params["provincia"]
-        if geo_params.get("comune"):
-            params["comune"] = geo_params["comune"]
-    return api_get("/auth/trend-annuale", tok, params=params)
+st.info(f"Utente: {who.get('username')} — Ruolo: {role or 'n/a'} — Regione: {regione or 'n/a'}")
 
-# =========================
-# COUNT totale (cached)
-# =========================
-@st.cache_data(ttl=30, show_spinner=False)
-def cached_count(tok: str, params: dict):
-    safe = {}
-    for k, v in params.items():
-        safe[k] = tuple(v) if isinstance(v, list) else v
-    real = {k: (list(v) if isinstance(v, tuple) else v) for k, v in safe.items()}
-    js = api_get("/auth/count", tok, params=real)
-    return {
-        "total": int(js.get("total", 0)),
-        "total_gg": int(js.get("total_gg", 0)),
-    }
+# indice di ricerca per le liste facet grandi (comuni): costruito una volta per
+# lista e condiviso tra le sessioni con lo stesso scope
+@st.cache_resource(ttl=600, max_entries=512, show_spinner=False)
+def get_facet_index(scope: str, index_key: tuple, fingerprint: tuple, _items):
+    return PrefixIndex(_items)
+
+def facet_multiselect(label: str, items, key: str, index_key: tuple):
+    # liste piccole: multiselect classica; liste grandi: ricerca + solo i primi N
+    # risultati (più quelli già selezionati) vanno al browser
+    selected = st.session_state.get(key, [])
+    if len(items) <= FACET_TOP_N:
+        options = sorted(items, key=lambda x: x[0])
+    else:
+        fingerprint = getattr(items, "fingerprint", None) or (len(items), sum(n for _, n in items))
+        index = get_facet_index(lkg_scope, index_key, fingerprint, items)
+        query = st.text_input(
+            f"Cerca {label.lower()}",
+            key=f"{key}_q",
+            placeholder="Digita le prime lettere…",
+        )
+        matches = index.search(query, FACET_TOP_N)
+        options = list(selected) + [t for t in matches if t not in selected]
+        st.caption(f"{len(matches)} di {index.size:,} mostrati: digita per restringere.")
+
+    return st.multiselect(
+        label,
+        options=options,
+        key=key,
+        format_func=lambda t: f"{t[0]} ({t[1]:,})",
+    )
 
 # =========================
 # FILTRI (sidebar)
@@ -399,18 +414,122 @@ def on_province_change():
             prov_list.append(str(item).upper())
 
     st.session_state["_last_province_key"] = tuple(sorted(prov_list))
-    
+
+# =========================
+# VISTE SALVATE
+# =========================
+# aprire una vista = i suoi risultati (calcolati in background) vanno nella cache
+# dei fetcher e i filtri ripartono dai suoi valori: nessuna query per i grafici
+view_owner = who.get("username") or lkg_scope
+get_view_refresher().remember(lkg_scope, token)
+
+def on_saved_view_change(tok: str):
+    view_id = st.session_state.get("saved_view_sel")
+    st.session_state["saved_view_sel"] = None
+    if view_id is None:
+        return
+    loaded = get_saved_views().load(view_id)
+    if loaded is None:
+        return
+    view, results = loaded
+    # senza risultati (mai calcolata o dopo un import) i filtri si applicano lo stesso
+    if results:
+        prime_caches(results, tok)
+    st.session_state["_opened_view"] = view
+    st.session_state["_opened_view_primed"] = bool(results)
+
+def on_save_view(scope: str, shared: bool):
+    name = (st.session_state.get("saved_view_name") or "").strip()
+    view = st.session_state.get("_last_view")
+    if not name or not view:
+        return
+    if get_saved_views().save(scope, view_owner, name, view, shared):
+        get_view_refresher().wake()
+        st.session_state["_saved_view_msg"] = f"Vista «{name}» salvata: risultati in calcolo."
+    else:
+        st.session_state["_saved_view_msg"] = "Troppe viste salvate: eliminane una prima di salvarne altre."
+
+def on_delete_view():
+    view_id = st.session_state.get("saved_view_del")
+    if view_id is not None:
+        get_saved_views().delete(view_id, view_owner)
+
+def _view_label(row) -> str:
+    label = row["name"]
+    if row["owner"] != view_owner:
+        label += f" ({row['owner']})"
+    if row["stale"] or not row["bytes"]:
+        return label + " — in aggiornamento"
+    return label + f" — {datetime.fromtimestamp(row['refreshed_at']):%d/%m %H:%M}"
+
+saved_rows = get_saved_views().list(lkg_scope, view_owner)
+saved_by_id = {r["id"]: r for r in saved_rows}
+
+with st.sidebar:
+    st.header("Viste salvate")
+    st.selectbox(
+        "Apri vista",
+        options=list(saved_by_id),
+        index=None,
+        key="saved_view_sel",
+        placeholder="Nessuna vista salvata" if not saved_rows else "Scegli una vista…",
+        disabled=not saved_rows,
+        format_func=lambda i: _view_label(saved_by_id[i]),
+        on_change=on_saved_view_change,
+        args=(token,),
+    )
+    if st.session_state.get("_opened_view") is not None and not st.session_state.get("_opened_view_primed"):
+        st.caption("Risultati della vista in aggiornamento: questa volta arrivano dal backend.")
+
+    with st.expander("Salva filtri correnti"):
+        st.text_input("Nome della vista", key="saved_view_name", max_chars=60)
+        share_view = st.checkbox("Condividi con gli utenti del mio ente", value=False)
+        st.button(
+            "Salva vista",
+            on_click=on_save_view,
+            args=(lkg_scope, share_view),
+            disabled="_last_view" not in st.session_state,
+        )
+        msg = st.session_state.pop("_saved_view_msg", None)
+        if msg:
+            st.caption(msg)
+        own = [r["id"] for r in saved_rows if r["owner"] == view_owner]
+        if own:
+            st.selectbox("Elimina vista", options=own, key="saved_view_del",
+                         format_func=lambda i: saved_by_id[i]["name"])
+            st.button("Elimina", on_click=on_delete_view)
+
+    st.divider()
+
+# vista appena aperta: tutti i widget dei filtri hanno una key e prendono i suoi
+# valori in questo rerun (anche se l'utente li aveva cambiati dopo l'ultima apertura)
+opened_view = st.session_state.pop("_opened_view", None)
+view_params = (opened_view or {}).get("params") or {}
+
+def open_view_state(key: str, value):
+    if opened_view is not None:
+        st.session_state[key] = value
+
+def open_view_value(key: str, items, field: str):
+    wanted = {str(v).upper() for v in view_params.get(field) or []}
+    open_view_state(key, [t for t in items if str(t[0]).upper() in wanted])
+
+ETA_CODE_LABELS = {code: label for label, code in ETA_MAP.items()}
+GG_CODE_LABELS = {code: label for label, code in GG_MAP.items()}
+SEX_CHOICES = ["Tutti", "Maschi", "Femmine"]
+NAT_CHOICES = ["Tutti", "Italiano", "Estero"]
+
 with st.sidebar:
     st.header("Filtri")
 
     # 6) Regione: filtro regione
-    reg_items = run_or_logout(get_regioni, token)
+    reg_items = run_or_stale(get_regioni, token, lkg_scope)
 
     if is_admin:
+        open_view_value("regione_sel_items", reg_items, "regione")
         selected_region_items = st.multiselect(
             "Regione",
-            options=reg_items,
-            default=[],
+            options=list(reg_items),
             key="regione_sel_items",
             on_change=on_region_change,
             format_func=lambda t: f"{t[0]} ({t[1]:,})" if t[1] else f"{t[0]}",
@@ -419,10 +538,10 @@ with st.sidebar:
 
     else:
         if scope_level == "all":
+            open_view_value("regione_sel_items", reg_items, "regione")
             selected_region_items = st.multiselect(
                 "Regione",
-                options=reg_items,
-                default=[],
+                options=list(reg_items),
                 key="regione_sel_items",
                 on_change=on_region_change,
                 format_func=lambda t: f"{t[0]} ({t[1]:,})" if t[1] else f"{t[0]}",
@@ -449,7 +568,7 @@ with st.sidebar:
 
     # 1) Residenza: Province (con count) - DIPENDE dalla Regione selezionata
     region_key = tuple(sorted([r.upper() for r in (selected_region or [])]))
-    prov_items = run_or_logout(get_province_with_counts, token, region_key)
+    prov_items = run_or_stale(get_province_with_counts, token, lkg_scope, region_key)
 
     if (not is_admin) and scope_level == "comune":
         # Provincia derivata dai comuni consentiti -> mostrala fissa, niente filtro
@@ -474,9 +593,10 @@ with st.sidebar:
         selected_province = scope_values
 
     else:
+        open_view_value("provincia_sel", prov_items, "provincia")
         selected_province_items = st.multiselect(
             "Provincia",
-            options=prov_items,
+            options=list(prov_items),
             key="provincia_sel",
             on_change=on_province_change,
             format_func=lambda t: f"{t[0]} ({t[1]:,})",
@@ -493,72 +613,40 @@ with st.sidebar:
                        format_func=lambda t: f"{t[0]}")
     else:
         # logica attuale (dipende da selected_province)
-        if selected_province:
-            seen = {}
-            for p in selected_province:
-                for c, n in run_or_logout(get_comuni_for_prov_with_counts, token, p):
-                    seen[c] = seen.get(c, 0) + int(n)
-            comuni_items = sorted(seen.items(), key=lambda x: x[0])
-
-        selected_comuni_items = st.multiselect(
+        if len(selected_province) == 1:
+            comuni_items = run_or_stale(get_comuni_for_prov_with_counts, token, lkg_scope, selected_province[0])
+        elif selected_province:
+            comuni_items = merge_facets(
+                run_or_stale(get_comuni_for_prov_with_counts, token, lkg_scope, p) for p in selected_province
+            )
+
+        open_view_value("comune_sel", comuni_items, "comune")
+        selected_comuni_items = facet_multiselect(
             "Comune",
-            options=comuni_items,
-            default=[],
-            format_func=lambda t: f"{t[0]} ({t[1]:,})",
+            comuni_items,
+            key="comune_sel",
+            index_key=("comune", tuple(sorted(selected_province))),
         )
         selected_comuni = [c for (c, _) in selected_comuni_items]
 
     st.divider()
 
     # 3) Prima definisco sesso/nazionalità (così posso usarli subito dopo senza NameError)
-    sex_choice = st.selectbox("Sesso", ["Tutti", "Maschi", "Femmine"], index=0)
-    nat_choice = st.selectbox("Italiano / Estero (Prov. nascita = EE)", ["Tutti", "Italiano", "Estero"], index=0)
+    view_nat = view_params.get("nato_estero")
+    open_view_state("sesso_sel", {"M": "Maschi", "F": "Femmine"}.get(view_params.get("sesso"), "Tutti"))
+    sex_choice = st.selectbox("Sesso", SEX_CHOICES, key="sesso_sel")
+    open_view_state("nat_sel", "Tutti" if view_nat is None else ("Estero" if view_nat else "Italiano"))
+    nat_choice = st.selectbox("Italiano / Estero (Prov. nascita = EE)", NAT_CHOICES, key="nat_sel")
     
     st.divider()
 
-    eta_options = [
-        "≤ 20",
-        "21–40",
-        "41–60",
-        "> 60",
-    ]
-    selected_eta_labels = st.multiselect(
-        "Fascia di età",
-        options=eta_options,
-        default=[],
-    )
-
-    eta_map = {
-        "≤ 20": "≤20",
-        "21–40": "21-40",
-        "41–60": "41-60",
-        "> 60": ">60",
-    }
-    selected_eta_codes = [eta_map[x] for x in selected_eta_labels]
+    open_view_state("eta_sel", [ETA_CODE_LABELS[c] for c in view_params.get("eta_fascia") or [] if c in ETA_CODE_LABELS])
+    selected_eta_labels = st.multiselect("Fascia di età", options=ETA_OPTIONS, key="eta_sel")
+    selected_eta_codes = [ETA_MAP[x] for x in selected_eta_labels]
     
-    gg_options = [
-        "10 o meno",
-        "11–50",
-        "51–100",
-        "101–150",
-        "151–180",
-        "Più di 180",
-    ]
-    selected_gg_labels = st.multiselect(
-        "Giornate lavorate (GG TOT)",
-        options=gg_options,
-        default=[],
-    )
-
-    gg_map = {
-        "10 o meno": "≤10",
-        "11–50": "11-50",
-        "51–100": "51-100",
-        "101–150": "101-150",
-        "151–180": "151-180",
-        "Più di 180": ">180",
-    }
-    selected_gg_codes = [gg_map[x] for x in selected_gg_labels]
+    open_view_state("gg_sel", [GG_CODE_LABELS[c] for c in view_params.get("gg_fascia") or [] if c in GG_CODE_LABELS])
+    selected_gg_labels = st.multiselect("Giornate lavorate (GG TOT)", options=GG_OPTIONS, key="gg_sel")
+    selected_gg_codes = [GG_MAP[x] for x in selected_gg_labels]
 
     st.divider()
 
@@ -575,83 +663,157 @@ with st.sidebar:
         selected_prov_nasc = ["EE"]
 
         # carico i comuni per EE
-        seen = {}
-        for c, n in run_or_logout(get_comuni_nascita_for_prov_with_counts, token, "EE"):
-            seen[c] = seen.get(c, 0) + int(n)
-        com_n_items = sorted(seen.items(), key=lambda x: x[0])
+        com_n_items = run_or_stale(get_comuni_nascita_for_prov_with_counts, token, lkg_scope, "EE")
 
-        selected_com_nasc_items = st.multiselect(
+        open_view_value("com_nasc_ee_sel", com_n_items, "com_nascita")
+        selected_com_nasc_items = facet_multiselect(
             "Comune di nascita",
-            options=com_n_items,
-            default=[],
-            format_func=lambda t: f"{t[0]} ({t[1]:,})",
+            com_n_items,
+            key="com_nasc_ee_sel",
+            index_key=("comune_nascita", ("EE",)),
         )
         selected_com_nasc = [c for (c, _) in selected_com_nasc_items]
 
     else:
         # Tutti o Italiano: filtri nascita normali (provincia -> comuni)
-        prov_n_items = run_or_logout(get_province_nascita_with_counts, token)
+        prov_n_items = run_or_stale(get_province_nascita_with_counts, token, lkg_scope)
         # Se Italiano, rimuovi EE dalle opzioni selezionabili
         if nat_choice == "Italiano":
             prov_n_items = [t for t in prov_n_items if (t[0] or "").upper() != "EE"]
             selected_prov_nasc = [p for p in selected_prov_nasc if p.upper() != "EE"]
 
+        open_view_value("prov_nasc_sel", prov_n_items, "prov_nascita")
         selected_prov_nasc_items = st.multiselect(
             "Provincia di nascita",
-            options=prov_n_items,
-            default=[],
+            options=list(prov_n_items),
+            key="prov_nasc_sel",
             format_func=lambda t: f"{t[0]} ({t[1]:,})",
         )
         selected_prov_nasc = [p for (p, _) in selected_prov_nasc_items]
 
-        if selected_prov_nasc:
-            seen = {}
-            for p in selected_prov_nasc:
-                for c, n in run_or_logout(get_comuni_nascita_for_prov_with_counts, token, p):
-                    seen[c] = seen.get(c, 0) + int(n)
-            com_n_items = sorted(seen.items(), key=lambda x: x[0])
+        if len(selected_prov_nasc) == 1:
+            com_n_items = run_or_stale(get_comuni_nascita_for_prov_with_counts, token, lkg_scope, selected_prov_nasc[0])
+        elif selected_prov_nasc:
+            com_n_items = merge_facets(
+                run_or_stale(get_comuni_nascita_for_prov_with_counts, token, lkg_scope, p) for p in selected_prov_nasc
+            )
 
-        selected_com_nasc_items = st.multiselect(
+        open_view_value("com_nasc_sel", com_n_items, "com_nascita")
+        selected_com_nasc_items = facet_multiselect(
             "Comune di nascita",
-            options=com_n_items,
-            default=[],
-            format_func=lambda t: f"{t[0]} ({t[1]:,})",
+            com_n_items,
+            key="com_nasc_sel",
+            index_key=("comune_nascita", tuple(sorted(selected_prov_nasc))),
         )
         selected_com_nasc = [c for (c, _) in selected_com_nasc_items]
 
     st.divider()
     
     # 5) Anno inserimento: filtro per anno inserimento
-    anni_items = run_or_logout(get_anni_inserimento, token)
+    anni_items = run_or_stale(get_anni_inserimento, token, lkg_scope)
     latest_year_item = [anni_items[0]] if anni_items else []
+    # viste salvate prima della lista vuota per "tutti gli anni": senza chiave = più recente
+    if view_params.get("anno_ins", LATEST) == LATEST:
+        open_view_state("anni_sel", latest_year_item)
+    else:
+        open_view_value("anni_sel", anni_items, "anno_ins")
+    st.session_state.setdefault("anni_sel", latest_year_item)
 
     selected_anni_items = st.multiselect(
         "Anno inserimento",
-        options=anni_items,
-        default=latest_year_item,
+        options=list(anni_items),
+        key="anni_sel",
         format_func=lambda t: f"{t[0]} ({t[1]:,})",
     )
 
     selected_anni = [a for (a, _) in selected_anni_items]
+
+    st.divider()
+
+    open_view_state("local_cube", (opened_view or {}).get("cube", LOCAL_CUBE_DEFAULT))
+    st.session_state.setdefault("local_cube", LOCAL_CUBE_DEFAULT)
+    local_cube = st.toggle(
+        "Cubo locale (filtri istantanei)",
+        key="local_cube",
+        help="Scarica un aggregato per l'area geografica selezionata e calcola in locale "
+             "conteggi e grafici quando cambiano sesso, nazionalità, età, giornate o anno.",
+    )
+
+    progressive = st.toggle(
+        "Risultati progressivi (stima subito)",
+        value=PROGRESSIVE_DEFAULT,
+        help="Con query lente mostra subito totali e grafici stimati dal cubo pre-aggregato, "
+             "poi li sostituisce con i valori esatti.",
+    )
     
 # =========================
 # PAGINAZIONE
 # =========================
 
-    # st.divider()
-    #
-    # st.header("Paginazione")
-    #
-    # page_size = st.selectbox(
-    #    "Righe per pagina",
-    #    options=[50, 100, 200, 500, 1000],
-    #    index=1,
-    # )
-    # page_number = st.number_input("Pagina", min_value=0, value=0, step=1)
+    st.divider()
+
+    st.header("Paginazione")
+
+    # niente numero pagina: con il cursore si va avanti/indietro dalla tabella
+    page_size = st.selectbox(
+       "Righe per pagina",
+       options=PAGE_SIZES,
+       index=1,
+    )
 
 # =========================
 # ADMIN: Upload Excel -> Import
 # =========================
+def prepare_incremental(data: bytes, anno: int):
+    # (nome, dati, form) da inviare per l'import incrementale; None = niente da inviare
+    with st.spinner("Confronto con le righe già importate"):
+        try:
+            diff = run_or_logout(incremental_diff, token, data, anno)
+        except (ApiUnavailableError, ApiRequestError) as e:
+            st.error(str(e))
+            return None
+        except Exception as e:
+            st.error(f"File Excel non leggibile: {e}")
+            return None
+
+    st.write(
+        f"Righe nel file: {diff.total:,} — invariate: {diff.unchanged:,} — "
+        f"nuove o modificate: {diff.new:,} — da cancellare: {len(diff.delete_hashes):,}"
+    )
+    if diff.empty():
+        st.success("Nessuna differenza con i dati già importati: niente da inviare.")
+        return None
+    st.caption(f"Dati inviati: {len(diff.delta) / 1024:,.0f} KB invece di {len(data) / 1024:,.0f} KB.")
+    return f"incrementale_{anno}.xlsx", diff.delta, diff.form_data()
+
+def after_imports(reason: str = "import"):
+    # una volta per import singolo o per batch: via i dati letti durante l'import,
+    # poi le viste più usate vengono ricaricate in background prima che arrivino gli utenti
+    invalidate_caches()
+    get_saved_views().mark_all_stale()
+    get_view_refresher().wake()
+    return get_cache_warmer().start(token, lkg_scope, reason=reason)
+
+def guess_year(name: str, default: int) -> int:
+    # "braccianti_2023.xlsx" -> 2023
+    digits = "".join(c if c.isdigit() else " " for c in name).split()
+    years = [int(d) for d in digits if len(d) == 4 and 2000 <= int(d) <= 2100]
+    return years[-1] if years else default
+
+def show_import_tasks(queue):
+    import pandas as pd
+
+    st.dataframe(pd.DataFrame([t.row() for t in queue.tasks]), width="stretch", hide_index=True)
+
+@st.fragment(run_every=IMPORT_POLL_S)
+def import_queue_watch():
+    # avanzamento del batch; alla fine un rerun completo (dati nuovi nella pagina)
+    queue = get_import_queue()
+    show_import_tasks(queue)
+    if not queue.running():
+        st.rerun(scope="app")
+    st.caption("Import in corso…")
+
 if role == "administrator":
     st.divider()
     st.subheader("Upload Excel (solo Admin)")
@@ -669,10 +831,11 @@ if role == "administrator":
 
     mode = st.selectbox(
         "Modalità import",
-        ["replace_year", "append", "replace"],
+        ["replace_year", "incremental", "append", "replace"],
         index=0,
         format_func=lambda x: {
             "replace_year": "Sostituisci solo questo anno",
+            "incremental": "Aggiorna solo le righe cambiate (incrementale)",
             "append": "Aggiungi senza cancellare",
             "replace": "Sostituisci tutto il database",
         }[x]
@@ -681,58 +844,239 @@ if role == "administrator":
     if mode == "append":
         st.warning(
             "Attenzione: 'append' aggiunge righe senza rimuovere eventuali duplicati dello stesso anno. "
-            "Per un aggiornamento correttivo annuale è più sicuro usare 'Sostituisci solo questo anno'."
+            "Per un aggiornamento correttivo annuale usare 'Aggiorna solo le righe cambiate'."
+        )
+    elif mode == "incremental":
+        st.caption(
+            "Il file viene confrontato qui con le righe già importate per l'anno: si inviano solo "
+            "le righe nuove o modificate e si cancellano quelle che non ci sono più."
         )
 
     if up is not None and st.button("Importa nel database"):
-        with st.spinner("Invio file Excel al backend (job async)"):
-            files = {
-                "file": (
-                    up.name,
-                    up.getvalue(),
-                    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        upload = (up.name, up.getvalue(), None)
+        if mode == "incremental":
+            upload = prepare_incremental(up.getvalue(), int(anno_import))
+        if upload is not None:
+            file_name, file_data, form = upload
+            with st.spinner("Invio file Excel al backend (job async)"):
+                files = {
+                    "file": (
+                        file_name,
+                        file_data,
+                        "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+                    )
+                }
+                res = run_or_logout(
+                    api_post_multipart,
+                    f"/admin/import?mode={mode}&anno_inserimento={int(anno_import)}",
+                    token,
+                    files=files,
+                    data=form,
                 )
-            }
-            res = run_or_logout(
-                api_post_multipart,
-                f"/admin/import?mode={mode}&anno_inserimento={int(anno_import)}",
-                token,
-                files=files,
-                data=None,
+
+            invalidate_caches()
+
+            job_id = res.get("job_id")
+            st.success(f"Import avviato. job_id = {job_id}")
+
+            if job_id:
+                st.write("Stato import (polling):")
+                status_box = st.empty()
+
+                for _ in range(120):
+                    js = run_or_logout(api_get, "/admin/import/status", token, {"job_id": job_id})
+                    status = js.get("status")
+                    inserted = js.get("inserted_rows")
+                    err = js.get("error")
+
+                    status_box.info(f"status={status} — inserted_rows={inserted} — error={err}")
+
+                    if status in ("done", "error"):
+                        if status == "done" and after_imports(f"import {job_id}"):
+                            st.info("Import completato: preriscaldamento cache avviato in background.")
+                        break
+                    time.sleep(1)
+
+    with st.expander("Import multiplo (coda)"):
+        import_queue = get_import_queue()
+        batch_files = st.file_uploader(
+            "File Excel (.xlsx), uno per anno di inserimento",
+            type=["xlsx"],
+            accept_multiple_files=True,
+            key="import_batch_files",
+        )
+        if batch_files:
+            import pandas as pd
+
+            plan = st.data_editor(
+                pd.DataFrame({
+                    "file": [f.name for f in batch_files],
+                    "anno": [guess_year(f.name, current_year) for f in batch_files],
+                    "modalità": ["replace_year"] * len(batch_files),
+                }),
+                column_config={
+                    "file": st.column_config.TextColumn("File", disabled=True),
+                    "anno": st.column_config.NumberColumn("Anno", min_value=2000, max_value=2100, step=1),
+                    "modalità": st.column_config.SelectboxColumn("Modalità", options=list(IMPORT_BATCH_MODES)),
+                },
+                hide_index=True,
+                width="stretch",
+                key="import_batch_plan",
+            )
+            concurrency = st.number_input(
+                "File in parallelo", min_value=1, max_value=IMPORT_MAX_CONCURRENCY, value=IMPORT_CONCURRENCY, step=1
+            )
+            st.caption(
+                "I file dello stesso anno vengono importati uno dopo l'altro, nell'ordine della tabella. "
+                f"Errori temporanei ritentati fino a {IMPORT_RETRIES} volte; cache svuotate una volta sola a fine coda."
+            )
+            if st.button("Avvia coda import", disabled=import_queue.running()):
+                tasks = [
+                    ImportTask(f.name, f.getvalue(), int(row["anno"]), row["modalità"] or "replace_year")
+                    for f, (_, row) in zip(batch_files, plan.iterrows())
+                ]
+                import_queue.start(token, tasks, int(concurrency), on_finished=lambda: after_imports("coda import"))
+
+        if import_queue.running():
+            import_queue_watch()
+        elif import_queue.tasks:
+            show_import_tasks(import_queue)
+            last = import_queue.last or {}
+            st.caption(
+                f"Ultima coda: {last.get('ok', 0)}/{last.get('files', 0)} file importati, "
+                f"{last.get('inserted', 0):,} righe, {last.get('elapsed_s', 0)}s — errori: {last.get('failed', 0)}"
+                + (f" — {last['error']}" if last.get("error") else "")
+            )
+            if import_queue.failed() and st.button("Riprova i file falliti"):
+                import_queue.retry_failed(token, on_finished=lambda: after_imports("coda import"))
+                st.rerun()
+
+    with st.expander("Preriscaldamento cache"):
+        warmer = get_cache_warmer()
+        if warmer.running():
+            st.caption("Preriscaldamento in corso…")
+        elif warmer.last:
+            last = warmer.last
+            st.caption(
+                f"Ultimo: {last.get('reason') or 'manuale'} — {last.get('ok', 0)}/{last.get('tasks', 0)} "
+                f"chiamate in {last.get('elapsed_s', 0)}s, errori: {last.get('failed', 0)}"
+            )
+            for err in last.get("errors", []):
+                st.caption(err)
+        if st.button("Preriscalda ora", disabled=warmer.running()):
+            warmer.start(token, lkg_scope, reason="manuale")
+            st.caption("Preriscaldamento avviato in background.")
+
+    with st.expander("Cache fetcher L1 (report)"):
+        import pandas as pd
+
+        df_cache = pd.DataFrame(cache_report())
+        st.dataframe(df_cache, width="stretch", hide_index=True)
+        if not df_cache.empty:
+            st.caption(
+                f"Totale: {df_cache['kb'].sum():,.0f} KB su un budget di {df_cache['max_kb'].sum():,.0f} KB "
+                "(per processo, condivisi da tutte le sessioni)."
             )
 
-        st.cache_data.clear()
+    with st.expander("Cache condivisa L2 (report)"):
+        if l2 is None:
+            st.caption("Cache L2 disattivata (L2_CACHE_URL=off o backend non disponibile).")
+        else:
+            rep = l2.report()
+            st.caption(
+                f"{rep['backend']} — generazione {rep['generation']} — "
+                f"{rep.get('entries', 0):,} voci, {rep.get('bytes', 0) / 1024:,.0f} KB — errori: {rep['errors']}"
+            )
+            st.caption(
+                "Hit/miss in questo worker: "
+                + ", ".join(f"{k} {rep['hits'].get(k, 0)}/{rep['misses'].get(k, 0)}"
+                            for k in sorted(set(rep["hits"]) | set(rep["misses"])))
+            )
 
-        job_id = res.get("job_id")
-        st.success(f"Import avviato. job_id = {job_id}")
+    with st.expander("Memoria facet condivisi (report)"):
+        rows = memory_report(get_facet_store())
+        if not rows:
+            st.caption("Nessun facet in memoria.")
+        else:
+            import pandas as pd
 
-        if job_id:
-            st.write("Stato import (polling):")
-            status_box = st.empty()
+            df_mem = pd.DataFrame(rows)
+            st.dataframe(df_mem, width="stretch", hide_index=True)
+            st.caption(
+                f"Prima: ~{df_mem['vecchio_per_sessione_kb'].sum():,.0f} KB copiati in ogni sessione. "
+                f"Ora: {df_mem['nuovo_condiviso_kb'].sum():,.0f} KB condivisi da tutte le sessioni del processo."
+            )
 
-            for _ in range(120):
-                js = run_or_logout(api_get, "/admin/import/status", token, {"job_id": job_id})
-                status = js.get("status")
-                inserted = js.get("inserted_rows")
-                err = js.get("error")
+    with st.expander("Viste salvate (materializzate)"):
+        import pandas as pd
 
-                status_box.info(f"status={status} — inserted_rows={inserted} — error={err}")
+        view_rows = get_saved_views().report()
+        if view_rows:
+            st.dataframe(pd.DataFrame(view_rows), width="stretch", hide_index=True)
+        refresher = get_view_refresher()
+        st.caption(
+            f"Ricalcolate da questo worker: {refresher.refreshed}, errori: {refresher.errors}. "
+            "Le viste di uno scope si aggiornano solo se un suo utente è passato di recente da questo worker."
+        )
+
+    with st.expander("Backend API (repliche)"):
+        import pandas as pd
+
+        st.dataframe(pd.DataFrame(get_balancer().report()), width="stretch", hide_index=True)
+        st.caption(
+            "Routing per latenza (EWMA x richieste in corso); una replica con errori ripetuti "
+            "viene esclusa per un po'. Repliche da API_BASE, separate da virgola."
+        )
 
-                if status in ("done", "error"):
-                    break
-                time.sleep(1)
+    with st.expander("Controllo richieste API (per scope)"):
+        import pandas as pd
+
+        adm = get_admission().report()
+        st.caption(f"Sessioni attive in questo worker: {adm['sessioni']}")
+        if adm["scope"]:
+            st.dataframe(pd.DataFrame(adm["scope"]), width="stretch", hide_index=True)
+        st.caption(
+            "in_attesa: richieste rallentate dal rate limit; rifiutate: oltre l'attesa massima (dati parziali); "
+            "superate: scartate perché la sessione era già passata ai filtri successivi."
+        )
+
+    with st.expander("Profilo rerun (campionamento)"):
+        st.toggle(
+            "Profila ogni rerun",
+            key="profile_reruns",
+            help="Campiona lo stack durante ogni rerun di questa sessione (anche con ?profile=1 nell'URL). "
+                 "Il profilo di un rerun compare qui al rerun successivo.",
+        )
+        done = [p for p in st.session_state.get("_rerun_profiles", []) if p.done() and p.result]
+        if not done:
+            st.caption("Nessun profilo completato in questa sessione.")
+        for prof in reversed(done[-3:]):
+            res = prof.result
+            if "error" in res:
+                st.caption(f"Profilo non salvato: {res['error']}")
+                continue
+            import pandas as pd
+
+            st.caption(
+                f"{prof.started_at.astimezone():%H:%M:%S} — {res['duration_s']}s, {res['samples']} campioni — "
+                f"filtri: {res['tags'].get('filtri', {})}"
+            )
+            st.caption("Per area (ms): " + ", ".join(f"{a} {ms:,.0f}" for a, ms in res["aree_ms"].items()))
+            st.dataframe(pd.DataFrame(res["top_self"][:10]), width="stretch", hide_index=True)
+            path = res["files"]["speedscope"]
+            with open(path, "rb") as f:
+                st.download_button(
+                    "Scarica speedscope (.json)",
+                    f.read(),
+                    file_name=os.path.basename(path),
+                    mime="application/json",
+                    key=f"dl_{os.path.basename(path)}",
+                )
 
 # =========================
 # QUERY /auth/search
 # =========================
-# offset = int(page_number) * int(page_size)
-# 
-# params = {
-#     "limit": int(page_size),
-#     "offset": int(offset),
-# }
-
-# Parametri base (solo filtri, niente paginazione)
+# Parametri base (solo filtri): limit/cursor li aggiunge la tabella (results_table.py)
 params = {}
 
 #regione
@@ -782,501 +1126,494 @@ if selected_province:
 if selected_comuni:
     geo_params["comune"] = selected_comuni
 
+# stesso filtro -> stessa chiave di cache, qualunque sia l'ordine di selezione
+params = canonical_params(params)
+geo_params = canonical_params(geo_params)
+
+if rerun_profile is not None:
+    rerun_profile.tag(filtri=params, righe_per_pagina=int(page_size), cubo_locale=local_cube, progressivi=progressive)
+
+# Cubo locale: un solo fetch per scope geografico, il resto è slicing in pandas.
+# Con filtri di nascita attivi il cubo non basta e si torna alle query backend
+# (tranne "Estero": provincia di nascita EE = nato_estero, che il cubo ha).
+cube_df = None
+if local_cube:
+    # cube.py porta con sé pandas/numpy: import solo se la modalità è attiva
+    from cube import build_cube_frame, cube_params, cube_supports, slice_cube
+
+    if cube_supports(params):
+        try:
+            cube_items = run_or_degrade(get_cube, token, lkg_scope, geo_params)
+        except ApiNotSupportedError:
+            # backend senza /auth/cube: query esatte come con il cubo spento
+            cube_items = None
+            st.info("Cubo locale non disponibile su questo backend: statistiche calcolate dal backend.")
+        if cube_items is not None:
+            cube_df = slice_cube(build_cube_frame(cube_items), cube_params(params))
+
 # Totale righe aggiornato (senza limit/offset)
 # count_params = {k: v for k, v in params.items() if k not in ("limit", "offset")}
 count_params = dict(params)
-count_info = run_or_logout(cached_count, token, count_params)
-total_rows = count_info["total"]
-total_gg = count_info["total_gg"]
-
-st.write(
-    f"Totale braccianti (con questi filtri attivi): {total_rows:,} "
-    f"— Totale giornate lavorate: {total_gg:,}"
-)
 
-if total_rows == 0:
-    st.warning("Nessun bracciante trovato con i filtri correnti.")
-    st.stop()
-
-# =========================
-# PALETTE UILA
-# =========================
-UILA_BLUE = "#123B7A"        # blu istituzionale
-UILA_AZURE = "#7DB7E5"       # azzurro chiaro coerente col logo
-UILA_GREEN = "#2F8F46"       # verde UILA
-UILA_GREEN_LIGHT = "#7BCB8C" # verde chiaro
-UILA_RED = "#C62828"         # rosso UILA, da usare come accento
-UILA_RED_LIGHT = "#E57373"   # rosso chiaro
-
-# =========================
-# COLORI FISSI GRAFICI
-# =========================
-SEX_COLOR_MAP = {
-    "Maschi": UILA_AZURE,
-    "Femmine": UILA_BLUE,
-}
+# Risultati progressivi: le query esatte partono subito in parallelo; se non
+# rispondono entro ESTIMATE_AFTER_S si mostra una stima dal cubo (già in cache
+# dopo il warm), poi i numeri esatti la sostituiscono nello stesso rerun.
+pending = {}
+estimate = None
+if cube_df is None:
+    pool = get_fetch_pool()
+    for fn in (cached_count, get_stats_sex, get_stats_nat, get_gg_fasce, get_eta_fasce):
+        pending[fn] = pool.submit(bind_rerun_deadline(fn), token, lkg_scope, count_params)
+
+    if progressive:
+        from cube import (
+            birth_fraction,
+            build_cube_frame,
+            cube_count,
+            cube_stats_sex,
+            cube_stats_nat,
+            cube_gg_fasce,
+            cube_eta_fasce,
+            estimate_params,
+            scale_estimate,
+            slice_cube,
+        )
 
-NAT_COLOR_MAP = {
-    "Italiani": UILA_GREEN,
-    "Esteri": UILA_BLUE,
-}
+        done, _ = wait(pending.values(), timeout=ESTIMATE_AFTER_S)
+        # il cubo si chiede solo se serve davvero una stima (e se il backend ce l'ha):
+        # con i valori esatti già in cache nessuna richiesta in più
+        if len(done) < len(pending) and endpoint_supported("/auth/cube"):
+            cube_fut = pool.submit(bind_rerun_deadline(get_cube), token, lkg_scope, geo_params)
+            try:
+                cube_items = cube_fut.result(timeout=ESTIMATE_CUBE_WAIT_S)
+            except Exception:
+                # cubo non pronto o non disponibile: si aspettano solo i valori esatti
+                cube_items = None
+            if cube_items is not None:
+                est_df = slice_cube(build_cube_frame(cube_items), estimate_params(params))
+                factor = birth_fraction(params, prov_n_items, com_n_items)
+                estimate = {
+                    name: scale_estimate(calc(est_df), factor)
+                    for name, calc in (
+                        ("count", cube_count),
+                        ("sex", cube_stats_sex),
+                        ("nat", cube_stats_nat),
+                        ("gg", cube_gg_fasce),
+                        ("eta", cube_eta_fasce),
+                    )
+                }
+
+def write_totals(info: dict, approx: bool = False):
+    if approx:
+        st.write(
+            f"Totale braccianti (stima): ≈ {info['total']:,} "
+            f"— Totale giornate lavorate (stima): ≈ {info['total_gg']:,} — calcolo esatto in corso…"
+        )
+    else:
+        st.write(
+            f"Totale braccianti (con questi filtri attivi): {info['total']:,} "
+            f"— Totale giornate lavorate: {info['total_gg']:,}"
+        )
 
-GG_COLOR_MAP = {
-    "10 o meno": UILA_AZURE,
-    "11–50": "#5FA6DD",
-    "51–100": UILA_BLUE,
-    "101–150": "#4F8F3A",
-    "151–180": UILA_GREEN,
-    "Più di 180": UILA_RED,
-}
+count_box = st.empty()
+if estimate is not None:
+    with count_box.container():
+        write_totals(estimate["count"], approx=True)
 
-ETA_COLOR_MAP = {
-    "≤ 20": UILA_AZURE,
-    "21–40": UILA_GREEN_LIGHT,
-    "41–60": UILA_GREEN,
-    "> 60": UILA_RED,
-}
-# with st.spinner("Caricamento dati..."):
-#    data = api_get("/auth/search", token, params=params)
-
-# items = data.get("items", [])
-# df = pd.DataFrame(items)
-# 
-# # Rimuovi solo dalla visualizzazione (resta nel backend per filtri/export)
-# df_view = df.drop(columns=["anno_inserimento"], errors="ignore")
-# 
-# if df_view.empty:
-#     st.warning("Nessun bracciante trovato con i filtri correnti.")
-# else:
 st.divider()
 st.subheader("Statistiche")
 
-sex_stats = run_or_logout(get_stats_sex, token, params)
-nat_stats = run_or_logout(get_stats_nat, token, params)
-gg_js = run_or_logout(get_gg_fasce, token, params)
-eta_js = run_or_logout(get_eta_fasce, token, params)
+# librerie pesanti (pandas, plotly) caricate solo quando si arriva ai grafici
+# (di solito già pronte grazie a prewarm_chart_libs)
+from charts import (
+    STATS_CHARTS,
+    fig_sex_count,
+    fig_nat_count,
+    fig_gg_fasce,
+    fig_eta_fasce,
+    fig_eta_gg,
+    fig_trend,
+    fig_map,
+    fig_map_points,
+    small_multiple,
+    trend_caption,
+)
 
-# =========================
-# RIGA 1: sesso
-# =========================
-c1, c2 = st.columns(2)
+def render_stats(sex_stats, nat_stats, gg_js, eta_js, key: str):
+    # tre righe da due grafici: sesso, italiani / esteri, distribuzioni
+    data = {"sex": sex_stats, "nat": nat_stats, "gg": gg_js, "eta": eta_js}
+    for i in range(0, len(STATS_CHARTS), 2):
+        for col, (name, source, build) in zip(st.columns(2), STATS_CHARTS[i:i + 2]):
+            with col:
+                if data[source] is None:
+                    st.caption(NO_DATA_CAPTION)
+                    continue
+                fig = build(data[source])
+                if fig is None:
+                    st.caption("Nessun dato disponibile con i filtri correnti.")
+                else:
+                    st.plotly_chart(fig, width="stretch", key=f"{key}_{name}")
+
+stats_box = st.empty()
+if estimate is not None:
+    with stats_box.container():
+        st.caption("Stime dal cubo pre-aggregato: i valori esatti arrivano tra poco.")
+        render_stats(estimate["sex"], estimate["nat"], estimate["gg"], estimate["eta"], key="est")
+
+if cube_df is not None:
+    from cube import cube_count
+
+    count_info = cube_count(cube_df)
+else:
+    count_info = run_or_degrade(cached_count, token, lkg_scope, count_params, pending=pending[cached_count])
 
-with c1:
-    df1 = pd.DataFrame({
-        "CategoriaBase": ["Maschi", "Femmine"],
-        "Valore": [sex_stats["count"]["M"], sex_stats["count"]["F"]],
-    })
+if count_info is not None:
+    total_rows = count_info["total"]
+    total_gg = count_info["total_gg"]
 
-    df1["CategoriaLabel"] = df1.apply(
-        lambda r: f"{r['CategoriaBase']} ({int(r['Valore']):,})", axis=1
-    )
+    with count_box.container():
+        write_totals(count_info)
 
-    sex_color_map_labels = {
-        row["CategoriaLabel"]: SEX_COLOR_MAP[row["CategoriaBase"]]
-        for _, row in df1.iterrows()
-    }
-
-    fig1 = px.pie(
-        df1,
-        names="CategoriaLabel",
-        values="Valore",
-        color="CategoriaLabel",
-        color_discrete_map=sex_color_map_labels,
-        hole=0.4,
-        title="Lavoratori per sesso",
-        custom_data=["CategoriaBase"],
-    )
+    if total_rows == 0:
+        stats_box.empty()
+        st.warning("Nessun bracciante trovato con i filtri correnti.")
+        st.stop()
+else:
+    count_box.empty()
 
-    fig1.update_traces(
-        texttemplate="%{customdata[0]}<br>%{percent}",
-        textinfo="none"
-    )
+if cube_df is not None:
+    from cube import cube_stats_sex, cube_stats_nat, cube_gg_fasce, cube_eta_fasce
 
-    st.plotly_chart(fig1, width="stretch")
+    sex_stats = cube_stats_sex(cube_df)
+    nat_stats = cube_stats_nat(cube_df)
+    gg_js = cube_gg_fasce(cube_df)
+    eta_js = cube_eta_fasce(cube_df)
+    stats_caption = "Statistiche calcolate dal cubo locale."
+else:
+    sex_stats = run_or_degrade(get_stats_sex, token, lkg_scope, params, pending=pending[get_stats_sex])
+    nat_stats = run_or_degrade(get_stats_nat, token, lkg_scope, params, pending=pending[get_stats_nat])
+    gg_js = run_or_degrade(get_gg_fasce, token, lkg_scope, params, pending=pending[get_gg_fasce])
+    eta_js = run_or_degrade(get_eta_fasce, token, lkg_scope, params, pending=pending[get_eta_fasce])
+    stats_caption = None
+
+with stats_box.container():
+    if stats_caption:
+        st.caption(stats_caption)
+    render_stats(sex_stats, nat_stats, gg_js, eta_js, key="exact")
+
+# incrocio età x giornate: una sola query raggruppata (o il cubo), pivot in pandas;
+# chiesta al backend solo se la sezione è aperta
+eta_gg_items = None
+if st.toggle("Età × giornate lavorate", key="show_eta_gg"):
+    eta_gg_measure = st.radio(
+        "Misura", options=list(ETA_GG_MEASURES), key="eta_gg_measure", horizontal=True
+    )
+    if cube_df is not None:
+        from cube import cube_eta_gg_fasce
 
-with c2:
-    df2 = pd.DataFrame({
-        "CategoriaBase": ["Maschi", "Femmine"],
-        "Valore": [sex_stats["gg_tot"]["M"], sex_stats["gg_tot"]["F"]],
-    })
+        eta_gg_items = cube_eta_gg_fasce(cube_df)
+    else:
+        try:
+            eta_gg_items = run_or_degrade(get_eta_gg_fasce, token, lkg_scope, params)
+            if eta_gg_items is None:
+                st.caption(NO_DATA_CAPTION)
+        except ApiNotSupportedError:
+            st.info("Incrocio età × giornate non disponibile su questo backend.")
+    if eta_gg_items is not None:
+        eta_gg_fig = fig_eta_gg(eta_gg_items, ETA_GG_MEASURES[eta_gg_measure], eta_gg_measure)
+        if eta_gg_fig is None:
+            st.caption("Nessun dato disponibile con i filtri correnti.")
+        else:
+            st.plotly_chart(eta_gg_fig, width="stretch", key="eta_gg")
 
-    df2["CategoriaLabel"] = df2.apply(
-        lambda r: f"{r['CategoriaBase']} ({int(r['Valore']):,})", axis=1
-    )
+st.divider()
+st.subheader("Confronto annuale")
 
-    sex_color_map_labels_2 = {
-        row["CategoriaLabel"]: SEX_COLOR_MAP[row["CategoriaBase"]]
-        for _, row in df2.iterrows()
-    }
-
-    fig2 = px.pie(
-        df2,
-        names="CategoriaLabel",
-        values="Valore",
-        color="CategoriaLabel",
-        color_discrete_map=sex_color_map_labels_2,
-        hole=0.4,
-        title="Giornate lavorate per sesso (GG TOT)",
-        custom_data=["CategoriaBase"],
-    )
+open_view_state("trend_sel", next(
+    (label for label, c in TREND_OPTIONS.items()
+     if c["metrica"] == (opened_view or {}).get("metrica") and c["apply_geo"] == (opened_view or {}).get("apply_geo")),
+    next(iter(TREND_OPTIONS)),
+))
+trend_choice = st.selectbox("Seleziona il confronto", options=list(TREND_OPTIONS.keys()), key="trend_sel")
+
+cfg = TREND_OPTIONS[trend_choice]
+if rerun_profile is not None:
+    rerun_profile.tag(trend=cfg["metrica"])
+# trend nazionale: i filtri geografici non contano, niente voci di cache duplicate
+trend_geo = geo_params if cfg["apply_geo"] else {}
+trend_js = run_or_degrade(
+    get_trend_annuale,
+    token,
+    lkg_scope,
+    cfg["metrica"],
+    cfg["apply_geo"],
+    trend_geo,
+)
 
-    fig2.update_traces(
-        texttemplate="%{customdata[0]}<br>%{percent}",
-        textinfo="none"
-    )
+trend_fig = fig_trend(trend_js, cfg) if trend_js is not None else None
 
-    st.plotly_chart(fig2, width="stretch")
+if trend_js is None:
+    st.caption(NO_DATA_CAPTION)
+elif trend_fig is None:
+    st.caption("Nessun dato disponibile per il confronto selezionato.")
+else:
+    st.plotly_chart(trend_fig, width="stretch")
+    st.caption(trend_caption(cfg))
 
 # =========================
-# RIGA 2: italiani / esteri
+# CONFRONTO TRA REGIONI (small multiples)
 # =========================
-c3, c4 = st.columns(2)
-
-with c3:
-    df3 = pd.DataFrame({
-        "CategoriaBase": ["Italiani", "Esteri"],
-        "Valore": [nat_stats["count"]["ITALIANI"], nat_stats["count"]["ESTERI"]],
-    })
-
-    df3["CategoriaLabel"] = df3.apply(
-        lambda r: f"{r['CategoriaBase']} ({int(r['Valore']):,})", axis=1
-    )
-
-    nat_color_map_labels = {
-        row["CategoriaLabel"]: NAT_COLOR_MAP[row["CategoriaBase"]]
-        for _, row in df3.iterrows()
-    }
-
-    fig3 = px.pie(
-        df3,
-        names="CategoriaLabel",
-        values="Valore",
-        color="CategoriaLabel",
-        color_discrete_map=nat_color_map_labels,
-        hole=0.4,
-        title="Lavoratori italiani vs esteri",
-        custom_data=["CategoriaBase"],
-    )
-
-    fig3.update_traces(
-        texttemplate="%{customdata[0]}<br>%{percent}",
-        textinfo="none"
-    )
-
-    st.plotly_chart(fig3, width="stretch")
-
-with c4:
-    df4 = pd.DataFrame({
-        "CategoriaBase": ["Italiani", "Esteri"],
-        "Valore": [nat_stats["gg_tot"]["ITALIANI"], nat_stats["gg_tot"]["ESTERI"]],
-    })
-
-    df4["CategoriaLabel"] = df4.apply(
-        lambda r: f"{r['CategoriaBase']} ({int(r['Valore']):,})", axis=1
-    )
-
-    nat_color_map_labels_2 = {
-        row["CategoriaLabel"]: NAT_COLOR_MAP[row["CategoriaBase"]]
-        for _, row in df4.iterrows()
-    }
-
-    fig4 = px.pie(
-        df4,
-        names="CategoriaLabel",
-        values="Valore",
-        color="CategoriaLabel",
-        color_discrete_map=nat_color_map_labels_2,
-        hole=0.4,
-        title="Giornate lavorate italiani vs esteri (GG TOT)",
-        custom_data=["CategoriaBase"],
-    )
+# stessi filtri della pagina, ma una regione per riquadro: conteggio e statistiche
+# di tutte le regioni scelte partono insieme (al massimo COMPARE_CONCURRENCY in
+# volo, sui fetcher in cache) e ogni riquadro si riempie appena la sua regione è pronta
+COMPARE_FETCHERS = (cached_count, get_stats_sex, get_stats_nat, get_gg_fasce, get_eta_fasce)
+COMPARE_CHARTS = {
+    "Lavoratori per sesso": (get_stats_sex, fig_sex_count),
+    "Lavoratori italiani vs esteri": (get_stats_nat, fig_nat_count),
+    "Giornate lavorate (fasce)": (get_gg_fasce, fig_gg_fasce),
+    "Fasce d'età": (get_eta_fasce, fig_eta_fasce),
+}
 
-    fig4.update_traces(
-        texttemplate="%{customdata[0]}<br>%{percent}",
-        textinfo="none"
+def fill_region_cell(cell, reg: str, futures: dict, reg_params: dict, chart):
+    fn_chart, build = chart
+    data = {}
+    errors = []
+    for fn in COMPARE_FETCHERS:
+        try:
+            data[fn] = _fetch_with_lkg(fn, token, (lkg_scope, reg_params), futures[fn])
+        except AuthExpiredError:
+            force_logout("Token non valido o scaduto. Accedi nuovamente dal portale.")
+        except (ApiUnavailableError, ApiRequestError) as e:
+            data[fn] = None
+            errors.append(str(e))
+
+    with cell.container(border=True):
+        info = data[cached_count]
+        fig = build(data[fn_chart]) if data[fn_chart] is not None and info and info["total"] else None
+        if fig is not None:
+            st.plotly_chart(small_multiple(fig, reg), width="stretch", key=f"cmp_{reg}")
+        else:
+            st.markdown(f"**{reg}**")
+        if info is not None:
+            st.caption(f"{info['total']:,} braccianti — {info['total_gg']:,} giornate")
+        if errors:
+            st.caption(f"Dati parziali: {errors[0]}")
+        elif fig is None:
+            st.caption("Nessun dato disponibile con i filtri correnti.")
+
+if len(reg_items) > 1:
+    st.divider()
+    st.subheader("Confronto tra regioni")
+
+    compare_regions = st.multiselect(
+        "Regioni da confrontare",
+        options=[r for r, _ in reg_items],
+        key="compare_regions",
+        max_selections=COMPARE_MAX_REGIONS,
+        placeholder=f"Fino a {COMPARE_MAX_REGIONS} regioni",
     )
-
-    st.plotly_chart(fig4, width="stretch")
+    compare_chart = st.selectbox("Grafico per regione", options=list(COMPARE_CHARTS), key="compare_chart")
+    st.caption("Stessi filtri della pagina, tranne Regione / Provincia / Comune.")
+
+    if compare_regions:
+        base_params = {k: v for k, v in params.items() if k not in GEO_KEYS}
+        reg_params = {r: canonical_params({**base_params, "regione": [r]}) for r in compare_regions}
+
+        cells = {}
+        for i in range(0, len(compare_regions), COMPARE_COLUMNS):
+            for col, reg in zip(st.columns(COMPARE_COLUMNS), compare_regions[i:i + COMPARE_COLUMNS]):
+                cells[reg] = col.empty()
+                cells[reg].caption(f"{reg}: in caricamento…")
+
+        # in ordine di regione: le prime si completano (e si disegnano) per prime
+        queue = [(reg, fn) for reg in compare_regions for fn in COMPARE_FETCHERS]
+        queue.reverse()
+        inflight = {}
+        arrived = {reg: {} for reg in compare_regions}
+        pool = get_fetch_pool()
+        while queue or inflight:
+            while queue and len(inflight) < COMPARE_CONCURRENCY:
+                reg, fn = queue.pop()
+                inflight[pool.submit(bind_rerun_deadline(fn), token, lkg_scope, reg_params[reg])] = (reg, fn)
+            done, _ = wait(inflight, return_when=FIRST_COMPLETED)
+            for fut in done:
+                reg, fn = inflight.pop(fut)
+                arrived[reg][fn] = fut
+                if len(arrived[reg]) == len(COMPARE_FETCHERS):
+                    fill_region_cell(cells[reg], reg, arrived[reg], reg_params[reg], COMPARE_CHARTS[compare_chart])
 
 # =========================
-# RIGA 3: distribuzioni
+# MAPPA (province / comuni)
 # =========================
-c5, c6 = st.columns(2)
-
-with c5:
-    gg_total = gg_js.get("total", 0)
-    gg_counts = gg_js.get("counts", {}) or {}
-
-    gg_order = ["10 o meno", "11–50", "51–100", "101–150", "151–180", "Più di 180"]
-
-    gg_labels = {
-        "LE10": "10 o meno",
-        "11_50": "11–50",
-        "51_100": "51–100",
-        "101_150": "101–150",
-        "151_180": "151–180",
-        "GT180": "Più di 180",
-    }
-
-    gg_data_map = {gg_labels[k]: int(v) for k, v in gg_counts.items() if int(v or 0) > 0}
-
-    ordered_gg_labels = [label for label in gg_order if label in gg_data_map]
-    ordered_gg_values = [gg_data_map[label] for label in ordered_gg_labels]
-
-    if gg_total == 0 or not ordered_gg_labels:
-        st.caption("Nessun dato disponibile con i filtri correnti.")
-    else:
-        df_gg = pd.DataFrame({
-            "CategoriaBase": ordered_gg_labels,
-            "Valore": ordered_gg_values
-        })
-
-        df_gg["CategoriaLabel"] = df_gg.apply(
-            lambda r: f"{r['CategoriaBase']} ({int(r['Valore']):,})", axis=1
-        )
-
-        gg_color_map_labels = {
-            row["CategoriaLabel"]: GG_COLOR_MAP[row["CategoriaBase"]]
-            for _, row in df_gg.iterrows()
-        }
-
-        ordered_gg_labels_full = df_gg["CategoriaLabel"].tolist()
-
-        fig_gg = px.pie(
-            df_gg,
-            names="CategoriaLabel",
-            values="Valore",
-            color="CategoriaLabel",
-            color_discrete_map=gg_color_map_labels,
-            category_orders={"CategoriaLabel": ordered_gg_labels_full},
-            hole=0.4,
-            title="Distribuzione giornate lavorate (GG TOT)",
-            custom_data=["CategoriaBase"],
-        )
-
-        fig_gg.update_traces(
-            texttemplate="%{customdata[0]}<br>%{percent}",
-            textinfo="none"
-        )
-
-        st.plotly_chart(fig_gg, width="stretch")
-
-with c6:
-    eta_total = eta_js.get("total", 0)
-    eta_counts = eta_js.get("counts", {}) or {}
-
-    eta_order = ["≤ 20", "21–40", "41–60", "> 60"]
-
-    eta_labels = {
-        "LE20": "≤ 20",
-        "21_40": "21–40",
-        "41_60": "41–60",
-        "GT60": "> 60",
-    }
-
-    eta_data_map = {eta_labels[k]: int(v) for k, v in eta_counts.items() if int(v or 0) > 0}
-
-    ordered_eta_labels = [label for label in eta_order if label in eta_data_map]
-    ordered_eta_values = [eta_data_map[label] for label in ordered_eta_labels]
-
-    if eta_total == 0 or not ordered_eta_labels:
-        st.caption("Nessun dato disponibile con i filtri correnti.")
-    else:
-        df_eta = pd.DataFrame({
-            "CategoriaBase": ordered_eta_labels,
-            "Valore": ordered_eta_values
-        })
-
-        df_eta["CategoriaLabel"] = df_eta.apply(
-            lambda r: f"{r['CategoriaBase']} ({int(r['Valore']):,})", axis=1
-        )
+# un solo fetch raggruppato per area con tutti i filtri della pagina; le geometrie
+# sono locali (geo_shapes.py). Dettaglio legato ai filtri geografici:
+#   provincia/comune scelti -> confini comunali dettagliati
+#   solo regione            -> confini comunali semplificati
+#   nazionale, comuni       -> un punto per comune (migliaia di poligoni sarebbero troppi per il browser)
+def map_layer(livello: str):
+    if livello == "provincia":
+        return "provincia"
+    if selected_province or selected_comuni:
+        return "comune"
+    if selected_region:
+        return "comune_coarse"
+    return None
+
+geo_shapes = get_geo_shapes()
+st.divider()
+st.subheader("Mappa")
+if geo_shapes is None:
+    st.caption("Mappa non disponibile: file delle geometrie non trovato.")
+    if is_admin:
+        st.caption("Generarlo dai confini ISTAT con `python -m tools.build_geo` (vedi GEO_SHAPES in geo_shapes.py).")
+else:
+    map_col1, map_col2 = st.columns(2)
+    map_level = map_col1.selectbox("Dettaglio", options=["Province", "Comuni"], key="map_level")
+    map_metric = map_col2.selectbox("Colore per", options=list(MAP_METRICS), key="map_metric")
+    livello = "comune" if map_level == "Comuni" else "provincia"
 
-        eta_color_map_labels = {
-            row["CategoriaLabel"]: ETA_COLOR_MAP[row["CategoriaBase"]]
-            for _, row in df_eta.iterrows()
-        }
-
-        ordered_eta_labels_full = df_eta["CategoriaLabel"].tolist()
-
-        fig_eta = px.pie(
-            df_eta,
-            names="CategoriaLabel",
-            values="Valore",
-            color="CategoriaLabel",
-            color_discrete_map=eta_color_map_labels,
-            category_orders={"CategoriaLabel": ordered_eta_labels_full},
-            hole=0.4,
-            title="Distribuzione fasce d'età",
-            custom_data=["CategoriaBase"],
-        )
+    geo_counts = None
+    try:
+        geo_counts = run_or_degrade(get_geo_counts, token, lkg_scope, livello, params)
+        if geo_counts is None:
+            st.caption(NO_DATA_CAPTION)
+    except ApiNotSupportedError:
+        st.info("Mappa non disponibile: il backend non fornisce i conteggi per area.")
+    if geo_counts is not None:
+        pos = MAP_METRICS[map_metric]
+        values = {row[0]: row[pos] for row in geo_counts if row[pos]}
+        layer = map_layer(livello)
+        title = f"{map_metric} per {'comune' if livello == 'comune' else 'provincia'}"
+        if layer is None:
+            centroids = geo_shapes.centroids.get("comune", {})
+            ids = [c for c in values if c in centroids]
+            map_fig = fig_map_points(
+                geo_shapes.feature_collection("provincia", geo_shapes.ids("provincia"), decimals=2),
+                ids,
+                [centroids[c][0] for c in ids],
+                [centroids[c][1] for c in ids],
+                [values[c] for c in ids],
+                map_metric,
+                title,
+            )
+        else:
+            ids = [c for c in values if geo_shapes.parent(layer, c) is not None]
+            map_fig = fig_map(
+                geo_shapes.feature_collection(layer, ids), ids, [values[c] for c in ids], map_metric, title
+            )
 
-        fig_eta.update_traces(
-            texttemplate="%{customdata[0]}<br>%{percent}",
-            textinfo="none"
-        )
+        if map_fig is None:
+            st.caption("Nessun dato disponibile con i filtri correnti.")
+        else:
+            st.plotly_chart(map_fig, width="stretch", key="map")
+        missing = len(values) - len(ids)
+        if missing:
+            st.caption(f"{missing:,} aree con dati non presenti nel file delle geometrie (non disegnate).")
 
-        st.plotly_chart(fig_eta, width="stretch")
+# =========================
+# EXPORT DATI GRAFICI
+# =========================
+# i risultati già mostrati (più quello che è in cache); il file viene generato
+# solo al click, in un thread separato, senza chiamate al backend
+from export_xlsx import XLSX_MIME, chart_data_xlsx
 
 st.divider()
-st.subheader("Confronto annuale")
-
-trend_options = {
-    "Totale braccianti negli anni (nazionale)": {
-        "metrica": "tot_braccianti",
-        "apply_geo": False,
-        "title": "Totale braccianti negli anni",
-    },
-    "Totale giornate lavorate negli anni (nazionale)": {
-        "metrica": "tot_gg",
-        "apply_geo": False,
-        "title": "Totale giornate lavorate negli anni",
-    },
-    "Totale braccianti negli anni (con filtri geografici)": {
-        "metrica": "tot_braccianti",
-        "apply_geo": True,
-        "title": "Totale braccianti negli anni — filtri geografici",
-    },
-    "Totale giornate lavorate negli anni (con filtri geografici)": {
-        "metrica": "tot_gg",
-        "apply_geo": True,
-        "title": "Totale giornate lavorate negli anni — filtri geografici",
-    },
-    "Maschi e femmine negli anni": {
-        "metrica": "sex_count",
-        "apply_geo": True,
-        "title": "Lavoratori per sesso negli anni",
-    },
-    "Giornate lavorate per sesso negli anni": {
-        "metrica": "sex_gg",
-        "apply_geo": True,
-        "title": "Giornate lavorate per sesso negli anni",
-    },
-    "Italiani ed esteri negli anni": {
-        "metrica": "nat_count",
-        "apply_geo": True,
-        "title": "Lavoratori italiani vs esteri negli anni",
-    },
-    "Giornate lavorate italiani vs esteri negli anni": {
-        "metrica": "nat_gg",
-        "apply_geo": True,
-        "title": "Giornate lavorate italiani vs esteri negli anni",
-    },
-    "Fasce d'età negli anni": {
-        "metrica": "eta_count",
-        "apply_geo": True,
-        "title": "Distribuzione fasce d'età negli anni",
-    },
-    "Fasce giornate lavorate negli anni": {
-        "metrica": "ggfasce_count",
-        "apply_geo": True,
-        "title": "Distribuzione giornate lavorate negli anni",
-    },
-}
-
-trend_choice = st.selectbox(
-    "Seleziona il confronto",
-    options=list(trend_options.keys()),
-    index=0,
+st.download_button(
+    "Scarica dati grafici (.xlsx)",
+    data=functools.partial(chart_data_xlsx, token, lkg_scope, {
+        "params": params,
+        "geo_params": geo_params,
+        "count": count_info,
+        "sex": sex_stats,
+        "nat": nat_stats,
+        "gg": gg_js,
+        "eta": eta_js,
+        "eta_gg": eta_gg_items,
+        "trend_cfg": cfg,
+        "trend": trend_js,
+    }),
+    file_name=f"dati_grafici_{datetime.now():%Y%m%d_%H%M}.xlsx",
+    mime=XLSX_MIME,
+    on_click="ignore",
+    key="dl_chart_data",
+    help="Totali, statistiche e confronti annuali con i filtri correnti; cubo per anno e "
+         "conteggi della mappa se già caricati.",
 )
 
-cfg = trend_options[trend_choice]
-trend_js = run_or_logout(
-    get_trend_annuale,
-    token,
+# vista corrente registrata per il cache warmer (una volta per cambio di filtri)
+current_view = make_view(
+    params,
     cfg["metrica"],
     cfg["apply_geo"],
-    geo_params,
+    latest_anno=latest_year_item[0][0] if latest_year_item else None,
+    cube=cube_df is not None,
 )
+if st.session_state.get("_last_view") != current_view:
+    st.session_state["_last_view"] = current_view
+    get_usage_log().record(lkg_scope, current_view)
+    
 
-trend_items = trend_js.get("items", [])
-df_trend = pd.DataFrame(trend_items)
+st.divider()
+st.subheader("Tabella")
 
-if df_trend.empty:
-    st.caption("Nessun dato disponibile per il confronto selezionato.")
+# =========================
+# DOWNLOAD: regole
+# - admin: sempre (anche nazionale)
+# - non-admin: solo se filtro Regione attivo ed è la sua
+# =========================
+if is_admin:
+    can_download = True
 else:
-    color_map = {
-        "Maschi": UILA_AZURE,
-        "Femmine": UILA_BLUE,
-        "Italiani": UILA_GREEN,
-        "Esteri": UILA_BLUE,
-        "≤ 20": UILA_AZURE,
-        "21–40": UILA_GREEN_LIGHT,
-        "41–60": UILA_GREEN,
-        "> 60": UILA_RED,
-        "10 o meno": UILA_AZURE,
-        "11–50": "#5FA6DD",
-        "51–100": UILA_BLUE,
-        "101–150": "#4F8F3A",
-        "151–180": UILA_GREEN,
-        "Più di 180": UILA_RED,
-        "Totale braccianti": UILA_BLUE,
-        "Totale giornate": UILA_GREEN,
-    }
-
-    fig_trend = px.line(
-        df_trend,
-        x="anno",
-        y="valore",
-        color="serie",
-        markers=True,
-        title=cfg["title"],
-        color_discrete_map=color_map,
-    )
-
-    fig_trend.update_layout(
-        xaxis_title="Anno",
-        yaxis_title="Valore",
-        legend_title="Serie",
-        hovermode="x unified",
-    )
+    can_download = (len(selected_region) == 1 and selected_region[0] == (regione or "").upper())
+
+# Se non può scaricare → nascondo toolbar con CSS
+if not can_download:
+    st.markdown(HIDE_DF_TOOLBAR_CSS, unsafe_allow_html=True)
+    st.caption("Download disabilitato: per abilitarlo devi filtrare per Regione (la tua).")
+
+pager = get_pager("_search_pager", params, int(page_size))
+try:
+    page_items = pager.current(token)
+except AuthExpiredError:
+    force_logout("Token non valido o scaduto. Accedi nuovamente dal portale.")
+except ApiUnavailableError as e:
+    page_items = None
+    st.warning(f"Tabella non disponibile: {e}")
+
+if page_items is not None:
+    # mentre si guarda questa pagina, la successiva arriva in background
+    pager.prefetch_next(token)
+
+    if page_items:
+        first_row = pager.page * pager.page_size + 1
+        last_row = first_row + len(page_items) - 1
+        of_total = f" di {count_info['total']:,}" if count_info is not None else ""
+        st.write(f"Righe {first_row:,}–{last_row:,}{of_total} (righe per pagina = {pager.page_size})")
+
+        # Rimuovi solo dalla visualizzazione (resta nel backend per filtri/export)
+        st.dataframe(
+            to_arrow(page_items, drop=["anno_inserimento"]),
+            width="stretch",
+            height=600,
+            hide_index=True,
+        )
+    else:
+        st.write("Nessuna riga")
 
-    st.plotly_chart(fig_trend, width="stretch")
+    b1, b2, b3 = st.columns(3)
+    b1.button("⏮ Prima pagina", on_click=pager.go_first, disabled=pager.page == 0)
+    b2.button("◀ Precedente", on_click=pager.go_prev, disabled=pager.page == 0)
+    b3.button("Successiva ▶", on_click=pager.go_next, disabled=not pager.has_next())
 
-    if cfg["apply_geo"]:
-        st.caption("Questo grafico considera solo i filtri Regione / Provincia / Comune.")
-    else:
-        st.caption("Questo grafico ignora tutti i filtri e mostra il dato nazionale.")
-    
-# st.divider()        
-# st.subheader("Tabella")
-
-# st.write(f"Righe in pagina: {len(df_view):,} (righe per pagina = {page_size}, pagina numero = {page_number})")
-
-    # =========================
-    # DOWNLOAD: regole
-    # - admin: sempre (anche nazionale)
-    # - non-admin: solo se filtro Regione attivo ed è la sua
-    # =========================
-    # is_admin = (role == "administrator")
-    # 
-    # if is_admin:
-    #     can_download = True
-    # else:
-    #     can_download = (len(selected_region) == 1 and selected_region[0] == (regione or "").upper())
-    # 
-    # # 1) TABella: SEMPRE dataframe (scroll interno)
-    # # Se non può scaricare → nascondo toolbar con CSS
-    # if not (is_admin or can_download):
-    #     st.markdown(HIDE_DF_TOOLBAR_CSS, unsafe_allow_html=True)
-    #     st.caption("Download disabilitato: per abilitarlo devi filtrare per Regione (la tua).")
-    # 
-    # st.dataframe(
-    #     df_view,
-    #     width="stretch",
-    #     height=600
-    # )
-    # 
     # # 3) Download CSV completo (solo se consentito)
     # if can_download:
     #     export_params = dict(params)
-    #     export_params.pop("limit", None)
-    #     export_params.pop("offset", None)
-    # 
+    #
     #     csv_bytes = api_get_raw("/auth/export", token, params=export_params)
-    # 
+    #
     #     st.download_button(
     #         "Scarica CSV (tutti i risultati filtrati)",
     #         data=csv_bytes,
     #         file_name="elenchi_export.csv",
     #         mime="text/csv",
-    #     )
\ No newline at end of file
+    #     )
@@ -0,0 +1,161 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from datetime import datetime, UTC
+
+# =========================
+# BENCHMARK AVVIO (import + time to first paint)
+# =========================
+# Ogni misura gira in un interprete nuovo, come un worker Streamlit appena avviato.
+#
+#   python -m tools.bench_startup --runs 3 --out bench_startup.jsonl
+#
+# - import_ms: import "a freddo" di ogni modulo, isolato
+# - first_paint_ms: dall'avvio dello script al primo elemento inviato al browser
+# - first_run_ms / warm_run_ms: primo rerun completo e rerun successivo
+# Con --out i risultati vengono aggiunti in JSONL, per confrontarli tra release.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+IMPORT_MODULES = [
+    "streamlit",
+    "requests",
+    "pandas",
+    "plotly.express",
+    "app_config",
+    "api_client",
+    "facets",
+    "lkg_store",
+    "cube",
+    "session_store",
+    "saved_views",
+    "charts",
+    "geo_shapes",
+    "import_queue",
+    "export_xlsx",
+]
+
+_IMPORT_SNIPPET = """
+import time, sys
+t = time.perf_counter()
+import {mod}
+print((time.perf_counter() - t) * 1000)
+"""
+
+# girato in un processo separato: stub backend + AppTest, con un hook sulla coda
+# dei ForwardMsg per registrare quando parte il primo delta verso il browser
+_PAINT_SNIPPET = """
+import json, os, sys, time
+sys.path.insert(0, {root!r})
+from tools.stub_backend import serve
+server, _ = serve(port={port})
+os.environ["API_BASE"] = "http://127.0.0.1:{port}"
+
+t_start = time.perf_counter()
+from streamlit.runtime.forward_msg_queue import ForwardMsgQueue
+from streamlit.testing.v1 import AppTest
+
+marks = {{}}
+_orig = ForwardMsgQueue.enqueue
+def _enqueue(self, msg):
+    if "first_delta" not in marks and msg.HasField("delta"):
+        marks["first_delta"] = time.perf_counter()
+    return _orig(self, msg)
+ForwardMsgQueue.enqueue = _enqueue
+
+at = AppTest.from_file(os.path.join({root!r}, "streamlit_app.py"), default_timeout=120)
+at.session_state["auth_token"] = "bench"
+t_run = time.perf_counter()
+at.run()
+t_done = time.perf_counter()
+first_delta = marks.pop("first_delta", None)
+t_warm = time.perf_counter()
+at.run()
+t_warm_done = time.perf_counter()
+
+print(json.dumps({{
+    "process_to_script_ms": (t_run - t_start) * 1000,
+    "first_paint_ms": (first_delta - t_run) * 1000 if first_delta else None,
+    "first_run_ms": (t_done - t_run) * 1000,
+    "warm_run_ms": (t_warm_done - t_warm) * 1000,
+    "exceptions": [e.value for e in at.exception],
+}}))
+"""
+
+
+def _python(code: str, env=None) -> str:
+    res = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=ROOT,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return res.stdout.strip().splitlines()[-1]
+
+def measure_imports(runs: int):
+    out = {}
+    for mod in IMPORT_MODULES:
+        samples = [float(_python(_IMPORT_SNIPPET.format(mod=mod))) for _ in range(runs)]
+        out[mod] = round(min(samples), 1)
+    return out
+
+def measure_first_paint(runs: int, port: int):
+    env = dict(os.environ)
+    env["LKG_DIR"] = tempfile.mkdtemp(prefix="bench_lkg_")
+    samples = [json.loads(_python(_PAINT_SNIPPET.format(root=ROOT, port=port + i), env=env)) for i in range(runs)]
+    best = {}
+    for key in ("process_to_script_ms", "first_paint_ms", "first_run_ms", "warm_run_ms"):
+        values = [s[key] for s in samples if s.get(key) is not None]
+        best[key] = round(min(values), 1) if values else None
+    best["exceptions"] = sorted({e for s in samples for e in s["exceptions"]})
+    return best
+
+def _git_rev():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=ROOT, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Benchmark avvio streamlit_app.py")
+    ap.add_argument("--runs", type=int, default=3, help="ripetizioni (si tiene il minimo)")
+    ap.add_argument("--port", type=int, default=8790, help="porta base dello stub backend")
+    ap.add_argument("--out", help="file JSONL a cui aggiungere il risultato")
+    args = ap.parse_args()
+
+    result = {
+        "ts": datetime.now(UTC).isoformat(),
+        "rev": _git_rev(),
+        "python": sys.version.split()[0],
+        "import_ms": measure_imports(args.runs),
+        "app": measure_first_paint(args.runs, args.port),
+    }
+
+    print(f"rev {result['rev']}")
+    print("import a freddo (ms):")
+    for mod, ms in result["import_ms"].items():
+        print(f"  {mod:<28} {ms:>8.1f}")
+    print("app (ms):")
+    for key, ms in result["app"].items():
+        if key != "exceptions":
+            print(f"  {key:<28} {ms if ms is not None else 'n/a':>8}")
+    if result["app"]["exceptions"]:
+        print(f"  eccezioni: {result['app']['exceptions']}")
+
+    if args.out:
+        with open(args.out, "a", encoding="utf-8") as f:
+            f.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+import argparse
+import json
+import os
+import struct
+import sys
+
+import numpy as np
+
+# =========================
+# BUILD GEOMETRIE (GeoJSON -> file compatto per la mappa)
+# =========================
+# Converte i confini di province e comuni (es. ISTAT "generalizzati", convertiti in
+# GeoJSON WGS84 con ogr2ogr/mapshaper) nel file letto da geo_shapes.py: poligoni
+# semplificati (Douglas-Peucker) con una tolleranza per layer e coordinate
+# quantizzate a uint16 sul riquadro dell'Italia (~20 m, 4 byte per punto).
+#
+#   python -m tools.build_geo --province province.geojson --comuni comuni.geojson \
+#       --out geo/italia.geob
+#
+# Gli id devono coincidere con i valori del backend: sigla della provincia
+# (regione come padre) e nome del comune in maiuscolo (sigla provincia come padre).
+# Le proprietà da leggere si scelgono con --prov-id/--prov-parent/--com-id/--com-parent.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# tolleranze in gradi (0.001 ~ 100 m)
+DEFAULT_TOL = {"provincia": 0.004, "comune": 0.001, "comune_coarse": 0.004}
+
+
+def _dp(points: np.ndarray, tol: float) -> np.ndarray:
+    # Douglas-Peucker iterativo su una polilinea aperta (estremi sempre tenuti)
+    n = len(points)
+    if n < 3:
+        return points
+    keep = np.zeros(n, dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        i, j = stack.pop()
+        if j <= i + 1:
+            continue
+        a, b = points[i], points[j]
+        seg = points[i + 1:j]
+        d = b - a
+        norm = np.hypot(d[0], d[1])
+        if norm == 0:
+            dist = np.hypot(seg[:, 0] - a[0], seg[:, 1] - a[1])
+        else:
+            dist = np.abs(d[0] * (seg[:, 1] - a[1]) - d[1] * (seg[:, 0] - a[0])) / norm
+        k = int(np.argmax(dist))
+        if dist[k] > tol:
+            k += i + 1
+            keep[k] = True
+            stack.append((i, k))
+            stack.append((k, j))
+    return points[keep]
+
+def simplify_ring(ring, tol: float) -> np.ndarray:
+    pts = np.asarray(ring, dtype=float)[:, :2]
+    if not np.array_equal(pts[0], pts[-1]):
+        pts = np.vstack([pts, pts[:1]])
+    # anello chiuso: due polilinee dal primo punto a quello più lontano e ritorno
+    far = int(np.argmax(np.hypot(pts[:, 0] - pts[0, 0], pts[:, 1] - pts[0, 1])))
+    if far == 0:
+        return pts[:1]
+    return np.vstack([_dp(pts[:far + 1], tol)[:-1], _dp(pts[far:], tol)])
+
+def _polygons(geometry):
+    if geometry is None:
+        return []
+    if geometry["type"] == "Polygon":
+        return [geometry["coordinates"]]
+    if geometry["type"] == "MultiPolygon":
+        return geometry["coordinates"]
+    return []
+
+def _ring_area_centroid(ring: np.ndarray):
+    x, y = ring[:, 0], ring[:, 1]
+    cross = x[:-1] * y[1:] - x[1:] * y[:-1]
+    area = cross.sum() / 2
+    if area == 0:
+        return 0.0, ring.mean(axis=0)
+    cx = ((x[:-1] + x[1:]) * cross).sum() / (6 * area)
+    cy = ((y[:-1] + y[1:]) * cross).sum() / (6 * area)
+    return abs(area), np.array([cx, cy])
+
+
+class Writer:
+    def __init__(self, bbox):
+        self.bbox = bbox
+        self.chunks = []
+        self.n_points = 0
+
+    def quantize(self, pts: np.ndarray) -> np.ndarray:
+        minx, miny, maxx, maxy = self.bbox
+        q = np.empty((len(pts), 2), dtype="<u2")
+        q[:, 0] = np.clip(np.round((pts[:, 0] - minx) / (maxx - minx) * 65535), 0, 65535)
+        q[:, 1] = np.clip(np.round((pts[:, 1] - miny) / (maxy - miny) * 65535), 0, 65535)
+        # punti consecutivi uguali dopo la quantizzazione: inutili
+        same = np.zeros(len(q), dtype=bool)
+        same[1:] = (q[1:] == q[:-1]).all(axis=1)
+        return q[~same]
+
+    def add_ring(self, pts: np.ndarray):
+        q = self.quantize(pts)
+        if len(q) < 4:
+            return None
+        offset = self.n_points
+        self.chunks.append(q.tobytes())
+        self.n_points += len(q)
+        return [offset, len(q)]
+
+
+def load_features(path: str, id_prop: str, parent_prop: str):
+    with open(path, encoding="utf-8") as f:
+        fc = json.load(f)
+    out = {}
+    for feat in fc.get("features", []):
+        props = feat.get("properties") or {}
+        fid = str(props.get(id_prop) or "").strip().upper()
+        if not fid:
+            continue
+        polys = _polygons(feat.get("geometry"))
+        if fid in out:
+            # stesso id in più feature (es. exclave): si uniscono
+            out[fid][1].extend(polys)
+        else:
+            out[fid] = [str(props.get(parent_prop) or "").strip().upper(), list(polys)]
+    return out
+
+def build_layer(writer: Writer, features: dict, tol: float):
+    layer = {}
+    for fid, (parent, polys) in features.items():
+        parts = []
+        for poly in polys:
+            rings = [writer.add_ring(simplify_ring(r, tol)) for r in poly if len(r) >= 4]
+            # bordo esterno sparito: poligono troppo piccolo per questa tolleranza
+            if rings and rings[0] is not None:
+                parts.append([r for r in rings if r is not None])
+        if not parts and polys:
+            # mai perdere un'area intera: si tiene il poligono più grande senza semplificarlo
+            biggest = max(polys, key=lambda p: _ring_area_centroid(np.asarray(p[0], dtype=float)[:, :2])[0])
+            ring = writer.add_ring(np.asarray(biggest[0], dtype=float)[:, :2])
+            if ring is not None:
+                parts.append([ring])
+        if parts:
+            layer[fid] = [parent, parts]
+    return {"tolerance": tol, "features": layer}
+
+def centroids(features: dict):
+    out = {}
+    for fid, (_, polys) in features.items():
+        best = None
+        for poly in polys:
+            area, c = _ring_area_centroid(np.asarray(poly[0], dtype=float)[:, :2])
+            if best is None or area > best[0]:
+                best = (area, c)
+        if best is not None:
+            out[fid] = [round(float(best[1][0]), 4), round(float(best[1][1]), 4)]
+    return out
+
+def write_file(path: str, header: dict, writer: Writer):
+    from geo_shapes import MAGIC
+
+    raw = json.dumps(header, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+    # punti allineati a 4 byte
+    raw += b" " * (-(len(MAGIC) + 4 + len(raw)) % 4)
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(MAGIC)
+        f.write(struct.pack("<I", len(raw)))
+        f.write(raw)
+        for chunk in writer.chunks:
+            f.write(chunk)
+    os.replace(tmp, path)
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Costruisce il file di geometrie della mappa")
+    ap.add_argument("--province", required=True, help="GeoJSON delle province (WGS84)")
+    ap.add_argument("--comuni", required=True, help="GeoJSON dei comuni (WGS84)")
+    ap.add_argument("--out", default=os.path.join(ROOT, "geo", "italia.geob"))
+    ap.add_argument("--prov-id", default="SIGLA", help="proprietà con la sigla della provincia")
+    ap.add_argument("--prov-parent", default="DEN_REG", help="proprietà con il nome della regione")
+    ap.add_argument("--com-id", default="COMUNE", help="proprietà con il nome del comune")
+    ap.add_argument("--com-parent", default="SIGLA", help="proprietà con la sigla della provincia")
+    for layer, tol in DEFAULT_TOL.items():
+        ap.add_argument(f"--tol-{layer.replace('_', '-')}", type=float, default=tol,
+                        help=f"tolleranza layer {layer} in gradi (default {tol})")
+    args = ap.parse_args()
+
+    sys.path.insert(0, ROOT)
+    province = load_features(args.province, args.prov_id, args.prov_parent)
+    comuni = load_features(args.comuni, args.com_id, args.com_parent)
+    if not province or not comuni:
+        ap.error("nessuna feature letta: controlla --prov-id / --com-id")
+
+    coords = np.vstack([
+        np.asarray(ring, dtype=float)[:, :2]
+        for feats in (province, comuni)
+        for _, polys in feats.values()
+        for poly in polys
+        for ring in poly
+    ])
+    minx, miny = coords.min(axis=0)
+    maxx, maxy = coords.max(axis=0)
+    writer = Writer([float(minx), float(miny), float(maxx), float(maxy)])
+
+    layers = {
+        "provincia": build_layer(writer, province, args.tol_provincia),
+        "comune": build_layer(writer, comuni, args.tol_comune),
+        "comune_coarse": build_layer(writer, comuni, args.tol_comune_coarse),
+    }
+    header = {"version": 1, "bbox": writer.bbox, "layers": layers, "centroids": {"comune": centroids(comuni)}}
+    write_file(args.out, header, writer)
+
+    print(json.dumps({
+        "out": args.out,
+        "bytes": os.path.getsize(args.out),
+        "punti_originali": int(len(coords)),
+        "punti": writer.n_points,
+        "feature": {name: len(layer["features"]) for name, layer in layers.items()},
+    }, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,321 @@
+import argparse
+import json
+import logging
+import os
+import random
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from datetime import datetime, UTC
+
+# =========================
+# LOAD TEST (più sessioni sullo stesso worker)
+# =========================
+# Avvia lo stub backend e N sessioni dell'app in parallelo nello stesso processo,
+# come un worker Streamlit con N browser collegati; ogni sessione cambia filtri
+# come farebbe un utente (regione, provincia, sesso, trend, pagina successiva...).
+#
+#   python -m tools.load_test --sessions 1,5,10,20 --steps 8 --delay 0.05 --out load.jsonl
+#
+# Per ogni livello di concorrenza:
+# - rerun_ms: percentili della durata di un rerun completo (p50/p95/p99/max)
+# - backend_qps: richieste al backend al secondo (contate dallo stub)
+# - pool_wait_ms: attesa per una connessione del pool HTTP + "pool is full" scartate
+# - rss_mb: memoria del processo a fine livello e picco durante il livello
+# Le sessioni sono AppTest (script thread veri, cache e pool condivisi come in
+# produzione) ma senza websocket né browser: il costo di rete/serializzazione verso
+# il client non è misurato. Tra un livello e l'altro L1 e facet vengono svuotati.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+_OPTION_RE = re.compile(r"^(.*) \(([\d,]+)\)$")
+
+
+def option_value(label: str):
+    # "LAZIO (1,234)" -> ("LAZIO", 1234): stesso formato delle format_func dell'app
+    m = _OPTION_RE.match(label)
+    if not m:
+        return (label, 0)
+    return (m.group(1), int(m.group(2).replace(",", "")))
+
+def percentile(values, p: float):
+    if not values:
+        return None
+    s = sorted(values)
+    i = min(len(s) - 1, max(0, round(p / 100 * (len(s) - 1))))
+    return s[i]
+
+def rss_mb() -> float:
+    with open("/proc/self/statm") as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf("SC_PAGE_SIZE") / 1024 / 1024
+
+# =========================
+# STRUMENTAZIONE (pool urllib3)
+# =========================
+class PoolStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.waits = []
+        self.discarded = 0
+
+    def reset(self):
+        with self.lock:
+            self.waits = []
+            self.discarded = 0
+
+
+class _DiscardCounter(logging.Handler):
+    def __init__(self, stats: PoolStats):
+        super().__init__(level=logging.WARNING)
+        self.stats = stats
+
+    def emit(self, record):
+        if "Connection pool is full" in record.getMessage():
+            with self.stats.lock:
+                self.stats.discarded += 1
+
+def instrument_pool(stats: PoolStats):
+    from urllib3.connectionpool import HTTPConnectionPool
+
+    orig = HTTPConnectionPool._get_conn
+
+    def _get_conn(self, timeout=None):
+        t0 = time.perf_counter()
+        try:
+            return orig(self, timeout)
+        finally:
+            with stats.lock:
+                stats.waits.append(time.perf_counter() - t0)
+
+    HTTPConnectionPool._get_conn = _get_conn
+    logging.getLogger("urllib3.connectionpool").addHandler(_DiscardCounter(stats))
+
+def serialize_script_compile():
+    # ogni AppTest compila lo script per conto suo e ast.parse di Python 3.11 non
+    # regge compilazioni in parallelo: un worker vero compila una volta sola
+    from streamlit.runtime.scriptrunner import magic
+
+    lock = threading.Lock()
+    orig = magic.add_magic
+
+    def add_magic(code, script_path):
+        with lock:
+            return orig(code, script_path)
+
+    magic.add_magic = add_magic
+
+# =========================
+# SESSIONE (percorso utente)
+# =========================
+def _pick(rnd, options):
+    return rnd.choice(options) if options else None
+
+def user_step(at, rnd, step: int):
+    # una modifica per rerun, a rotazione; ritorna il nome dell'azione
+    action = ("regione", "provincia", "sesso", "trend", "pagina", "nazionale")[step % 6]
+    if action == "regione":
+        ms = at.multiselect(key="regione_sel_items")
+        label = _pick(rnd, list(ms.options))
+        if label is None:
+            return None
+        ms.set_value([option_value(label)])
+    elif action == "provincia":
+        ms = at.multiselect(key="provincia_sel")
+        label = _pick(rnd, list(ms.options))
+        if label is None:
+            return None
+        ms.set_value([option_value(label)])
+    elif action == "sesso":
+        sb = next(s for s in at.selectbox if s.label == "Sesso")
+        sb.set_value(rnd.choice(["Tutti", "Maschi", "Femmine"]))
+    elif action == "trend":
+        sb = next(s for s in at.selectbox if s.label == "Seleziona il confronto")
+        sb.set_value(rnd.choice(list(sb.options)))
+    elif action == "pagina":
+        btn = next((b for b in at.button if b.label == "Successiva ▶"), None)
+        if btn is None or btn.disabled:
+            return None
+        btn.click()
+    else:
+        at.multiselect(key="regione_sel_items").set_value([])
+    return action
+
+def run_session(idx: int, steps: int, think_s: float, seed: int, out: list, lock):
+    from streamlit.testing.v1 import AppTest
+
+    rnd = random.Random(seed + idx)
+    at = AppTest.from_file(os.path.join(ROOT, "streamlit_app.py"), default_timeout=300)
+    at.session_state["auth_token"] = f"load-{idx}"
+    samples = []
+    errors = []
+    for step in range(steps + 1):
+        action = "avvio"
+        if step:
+            if think_s:
+                time.sleep(rnd.uniform(0, think_s))
+            try:
+                action = user_step(at, rnd, step - 1)
+            except Exception as e:
+                errors.append(f"step {step}: {e!r}")
+                continue
+            if action is None:
+                continue
+        t0 = time.perf_counter()
+        try:
+            at.run()
+        except Exception as e:
+            errors.append(f"{action}: {e!r}")
+            continue
+        samples.append((action, time.perf_counter() - t0))
+        errors += [f"{action}: {e.message}" for e in at.exception]
+    with lock:
+        out.append({"samples": samples, "errors": errors})
+
+# =========================
+# LIVELLI DI CONCORRENZA
+# =========================
+def run_level(n: int, steps: int, think_s: float, seed: int, state, pool: PoolStats):
+    from cache_policy import clear_all
+    from facets import get_facet_store
+
+    clear_all()
+    get_facet_store().clear()
+    pool.reset()
+
+    peak = [rss_mb()]
+    done = threading.Event()
+
+    def _sample_memory():
+        while not done.wait(0.2):
+            peak[0] = max(peak[0], rss_mb())
+
+    sampler = threading.Thread(target=_sample_memory, name="load-mem", daemon=True)
+    sampler.start()
+
+    results = []
+    lock = threading.Lock()
+    requests_before = state.requests
+    t0 = time.perf_counter()
+    threads = [
+        threading.Thread(target=run_session, args=(i, steps, think_s, seed, results, lock), name=f"load-{i}")
+        for i in range(n)
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - t0
+    done.set()
+    sampler.join()
+
+    reruns = [s for r in results for _, s in r["samples"]]
+    by_action = {}
+    for r in results:
+        for action, s in r["samples"]:
+            by_action.setdefault(action, []).append(s)
+    errors = [e for r in results for e in r["errors"]]
+    n_requests = state.requests - requests_before
+    with pool.lock:
+        waits = list(pool.waits)
+        discarded = pool.discarded
+
+    def _ms(v):
+        return round(v * 1000, 1) if v is not None else None
+
+    return {
+        "sessions": n,
+        "wall_s": round(wall, 2),
+        "reruns": len(reruns),
+        "reruns_per_s": round(len(reruns) / wall, 2),
+        "rerun_ms": {f"p{p}": _ms(percentile(reruns, p)) for p in (50, 95, 99)} | {"max": _ms(max(reruns, default=None))},
+        "rerun_p95_ms_by_action": {a: _ms(percentile(v, 95)) for a, v in sorted(by_action.items())},
+        "backend_requests": n_requests,
+        "backend_qps": round(n_requests / wall, 1),
+        "pool_wait_ms": {
+            "p50": _ms(percentile(waits, 50)),
+            "p99": _ms(percentile(waits, 99)),
+            "max": _ms(max(waits, default=None)),
+            "checkouts": len(waits),
+        },
+        "pool_discarded": discarded,
+        "rss_mb": round(rss_mb(), 1),
+        "rss_peak_mb": round(peak[0], 1),
+        "errors": errors[:10],
+        "n_errors": len(errors),
+    }
+
+def _git_rev():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            cwd=ROOT, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Load test multi-sessione di streamlit_app.py")
+    ap.add_argument("--sessions", default="1,5,10,20", help="livelli di concorrenza, separati da virgola")
+    ap.add_argument("--steps", type=int, default=8, help="cambi di filtro per sessione (oltre al primo run)")
+    ap.add_argument("--think", type=float, default=0.0, help="pausa casuale max tra due azioni (s)")
+    ap.add_argument("--rows", type=int, default=20000, help="righe dello stub backend")
+    ap.add_argument("--delay", type=float, default=0.05, help="latenza artificiale del backend (s)")
+    ap.add_argument("--port", type=int, default=8797, help="porta dello stub backend")
+    ap.add_argument("--seed", type=int, default=1)
+    ap.add_argument("--out", help="file JSONL a cui aggiungere il risultato")
+    args = ap.parse_args()
+
+    levels = [int(x) for x in args.sessions.split(",") if x.strip()]
+
+    # prima di qualsiasi import dell'app: backend stub, niente L2 né LKG condivisi
+    sys.path.insert(0, ROOT)
+    tmp = tempfile.mkdtemp(prefix="load_test_")
+    os.environ["API_BASE"] = f"http://127.0.0.1:{args.port}"
+    os.environ["L2_CACHE_URL"] = "off"
+    os.environ["LKG_DIR"] = os.path.join(tmp, "lkg")
+    os.environ["USAGE_DB"] = os.path.join(tmp, "usage.sqlite")
+
+    from tools.stub_backend import serve
+
+    server, state = serve(port=args.port, rows=args.rows, delay=args.delay)
+    pool = PoolStats()
+    instrument_pool(pool)
+    serialize_script_compile()
+
+    result = {
+        "ts": datetime.now(UTC).isoformat(),
+        "rev": _git_rev(),
+        "python": sys.version.split()[0],
+        "config": {k: getattr(args, k) for k in ("steps", "think", "rows", "delay", "seed")},
+        "levels": [],
+    }
+    try:
+        for n in levels:
+            level = run_level(n, args.steps, args.think, args.seed, state, pool)
+            result["levels"].append(level)
+            print(
+                f"{n:>3} sessioni  rerun p50 {level['rerun_ms']['p50']:>7} ms  p95 {level['rerun_ms']['p95']:>7} ms"
+                f"  p99 {level['rerun_ms']['p99']:>7} ms  | backend {level['backend_qps']:>6} req/s"
+                f"  | pool wait p99 {level['pool_wait_ms']['p99']} ms, scartate {level['pool_discarded']}"
+                f"  | RSS {level['rss_mb']} MB (picco {level['rss_peak_mb']})"
+                + (f"  | {level['n_errors']} errori" if level["n_errors"] else ""),
+                flush=True,
+            )
+            for e in level["errors"]:
+                print(f"      {e}")
+    finally:
+        server.shutdown()
+
+    if args.out:
+        with open(args.out, "a", encoding="utf-8") as f:
+            f.write(json.dumps(result, ensure_ascii=False) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+import argparse
+import html
+import importlib.util
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, UTC
+
+# =========================
+# REPORT OFFLINE (tutte le regioni, per anno)
+# =========================
+# Le sezioni "Statistiche" e "Confronto annuale" della pagina, per ogni regione e
+# anno di inserimento, come file HTML statici (ed eventualmente PNG): stessi
+# fetcher (fetchers.py) e stesse figure (charts.py) della dashboard.
+#
+#   python -m tools.render_reports --token <token> --out reports/ --anni latest --workers 8
+#   python -m tools.render_reports --stub --out /tmp/reports      (stub backend locale)
+#
+# Ogni coppia (regione, anno) è un task del pool di processi: fetch, figure e
+# scrittura del file. Output:
+#
+#   <out>/<anno>/<REGIONE>.html        report completo (plotly.js condiviso, niente CDN)
+#   <out>/<anno>/<REGIONE>/<grafico>.png   con --png (richiede il pacchetto kaleido)
+#   <out>/index.html                   elenco dei report presenti
+#
+# Ripresa: l'HTML di un report viene scritto per ultimo e in modo atomico; se c'è
+# già il task è saltato. --force rifà tutto.
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_WORKERS = min(8, os.cpu_count() or 2)
+
+_PAGE = """<!DOCTYPE html>
+<html lang="it">
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<script src="../plotly.min.js"></script>
+<style>
+body {{ font-family: sans-serif; margin: 24px; }}
+.grid {{ display: grid; grid-template-columns: 1fr 1fr; gap: 8px; }}
+.caption {{ color: #666; font-size: 0.9em; }}
+</style>
+</head>
+<body>
+<h1>{title}</h1>
+<p>{totals}</p>
+<h2>Statistiche</h2>
+<div class="grid">
+{stats}
+</div>
+<h2>Confronto annuale</h2>
+{trend}
+<p class="caption">Generato il {generated} da tools/render_reports.py</p>
+</body>
+</html>
+"""
+
+
+def _slug(text: str) -> str:
+    return "".join(c if c.isalnum() else "_" for c in str(text)).strip("_") or "NA"
+
+def report_path(out: str, regione: str, anno) -> str:
+    return os.path.join(out, str(anno), f"{_slug(regione)}.html")
+
+def _write_atomic(path: str, text: str):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp, path)
+
+# =========================
+# WORKER (un processo del pool)
+# =========================
+_worker = {}
+# HTML dei trend già disegnati da questo processo: quelli nazionali sono uguali
+# per tutte le regioni, quelli regionali per tutti gli anni
+_trend_html = {}
+
+def _init_worker(tok: str, scope: str):
+    sys.path.insert(0, ROOT)
+    _worker["tok"] = tok
+    _worker["scope"] = scope
+
+def render_one(regione: str, anno, out: str, png: bool) -> dict:
+    from app_config import NO_DATA_CAPTION, TREND_OPTIONS
+    from charts import STATS_CHARTS, fig_trend, trend_caption
+    from fetchers import (
+        canonical_params,
+        cached_count,
+        get_stats_sex,
+        get_stats_nat,
+        get_gg_fasce,
+        get_eta_fasce,
+        get_trend_annuale,
+    )
+
+    t0 = time.monotonic()
+    tok, scope = _worker["tok"], _worker["scope"]
+    params = canonical_params({"regione": [regione], "anno_ins": [anno]})
+    geo = canonical_params({"regione": [regione]})
+
+    # stesse chiamate (e stessi argomenti) della pagina con questi filtri
+    info = cached_count(tok, scope, params)
+    data = {
+        "sex": get_stats_sex(tok, scope, params),
+        "nat": get_stats_nat(tok, scope, params),
+        "gg": get_gg_fasce(tok, scope, params),
+        "eta": get_eta_fasce(tok, scope, params),
+    }
+    figures = []
+    stats_html = []
+    for name, source, build in STATS_CHARTS:
+        fig = build(data[source]) if info["total"] else None
+        if fig is None:
+            stats_html.append(f"<div class=\"caption\">{html.escape(NO_DATA_CAPTION)}</div>")
+            continue
+        figures.append((name, fig))
+        stats_html.append(f"<div>{fig.to_html(full_html=False, include_plotlyjs=False)}</div>")
+
+    trend_html = []
+    for i, cfg in enumerate(TREND_OPTIONS.values()):
+        trend_geo = geo if cfg["apply_geo"] else {}
+        key = (cfg["metrica"], cfg["apply_geo"], json.dumps(trend_geo, sort_keys=True))
+        if key not in _trend_html or png:
+            fig = fig_trend(get_trend_annuale(tok, scope, cfg["metrica"], cfg["apply_geo"], trend_geo), cfg)
+            if fig is not None:
+                figures.append((f"trend_{i + 1}", fig))
+            _trend_html[key] = None if fig is None else fig.to_html(full_html=False, include_plotlyjs=False)
+        if _trend_html[key] is None:
+            continue
+        trend_html.append(_trend_html[key])
+        trend_html.append(f"<p class=\"caption\">{html.escape(trend_caption(cfg))}</p>")
+
+    path = report_path(out, regione, anno)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    if png:
+        png_dir = os.path.join(os.path.dirname(path), _slug(regione))
+        os.makedirs(png_dir, exist_ok=True)
+        for name, fig in figures:
+            fig.write_image(os.path.join(png_dir, f"{name}.png"), width=900, height=600)
+
+    title = f"{regione} — anno di inserimento {anno}"
+    _write_atomic(path, _PAGE.format(
+        title=html.escape(title),
+        totals=html.escape(
+            f"Totale braccianti: {info['total']:,} — Totale giornate lavorate: {info['total_gg']:,}"
+        ),
+        stats="\n".join(stats_html),
+        trend="\n".join(trend_html),
+        generated=datetime.now(UTC).strftime("%Y-%m-%d %H:%M UTC"),
+    ))
+    return {"regione": regione, "anno": anno, "path": path, "elapsed_s": round(time.monotonic() - t0, 2)}
+
+# =========================
+# PIANO E INDICE
+# =========================
+def select_years(anni_items, spec: str) -> list:
+    years = [a for a, _ in anni_items]
+    if spec == "all":
+        return years
+    if spec == "latest":
+        return years[:1]
+    wanted = {s.strip() for s in spec.split(",") if s.strip()}
+    return [a for a in years if str(a) in wanted]
+
+def write_index(out: str, regioni: list, years: list):
+    rows = []
+    for anno in years:
+        links = [
+            f"<a href=\"{anno}/{_slug(r)}.html\">{html.escape(r)}</a>"
+            for r in regioni if os.path.exists(report_path(out, r, anno))
+        ]
+        rows.append(f"<h2>{anno}</h2><p>{' · '.join(links) or 'nessun report'}</p>")
+    _write_atomic(os.path.join(out, "index.html"), (
+        "<!DOCTYPE html><html lang=\"it\"><head><meta charset=\"utf-8\"><title>Report regionali</title></head>"
+        "<body style=\"font-family: sans-serif\"><h1>Report regionali</h1>" + "".join(rows) + "</body></html>\n"
+    ))
+
+def write_plotlyjs(out: str):
+    from plotly.offline import get_plotlyjs
+
+    path = os.path.join(out, "plotly.min.js")
+    if not os.path.exists(path):
+        _write_atomic(path, get_plotlyjs())
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Report HTML/PNG di Statistiche e Confronto annuale per regione")
+    ap.add_argument("--token", default=os.getenv("REPORT_TOKEN", ""), help="token (default: $REPORT_TOKEN)")
+    ap.add_argument("--out", default="reports", help="cartella di output")
+    ap.add_argument("--anni", default="latest", help="'latest', 'all' o anni separati da virgola")
+    ap.add_argument("--regioni", default="", help="solo queste regioni, separate da virgola (default: tutte)")
+    ap.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="processi in parallelo")
+    ap.add_argument("--png", action="store_true", help="anche un PNG per grafico (richiede kaleido)")
+    ap.add_argument("--force", action="store_true", help="rifà anche i report già presenti")
+    ap.add_argument("--stub", action="store_true", help="avvia lo stub backend locale e usa quello")
+    ap.add_argument("--stub-port", type=int, default=8798)
+    args = ap.parse_args()
+
+    if args.png and importlib.util.find_spec("kaleido") is None:
+        ap.error("--png richiede il pacchetto 'kaleido'")
+
+    # prima di qualsiasi import dell'app (i processi del pool ereditano l'ambiente)
+    sys.path.insert(0, ROOT)
+    os.environ.setdefault("STREAMLIT_LOGGER_LEVEL", "error")
+    server = None
+    if args.stub:
+        tmp = tempfile.mkdtemp(prefix="render_reports_")
+        os.environ["API_BASE"] = f"http://127.0.0.1:{args.stub_port}"
+        os.environ["L2_CACHE_URL"] = "off"
+        os.environ["LKG_DIR"] = os.path.join(tmp, "lkg")
+        from tools.stub_backend import serve
+
+        server, _ = serve(port=args.stub_port)
+        args.token = args.token or "stub"
+    if not args.token:
+        ap.error("serve un token (--token o REPORT_TOKEN)")
+
+    from api_client import api_get
+    from fetchers import get_anni_inserimento, get_regioni, profile_scope
+
+    t0 = time.monotonic()
+    try:
+        scope = profile_scope(api_get("/auth/whoami", args.token))
+        regioni = [r for r, _ in get_regioni(args.token, scope)]
+        if args.regioni:
+            wanted = {r.strip().upper() for r in args.regioni.split(",") if r.strip()}
+            regioni = [r for r in regioni if r.upper() in wanted]
+        years = select_years(get_anni_inserimento(args.token, scope), args.anni)
+
+        os.makedirs(args.out, exist_ok=True)
+        write_plotlyjs(args.out)
+        # per regione: i trend regionali disegnati per un anno servono anche agli altri
+        tasks = [(r, a) for r in regioni for a in years]
+        todo = [t for t in tasks if args.force or not os.path.exists(report_path(args.out, *t))]
+        print(f"{len(tasks)} report ({len(regioni)} regioni x {len(years)} anni), da fare {len(todo)}", flush=True)
+
+        done, failed = [], []
+        if todo:
+            # spawn: niente fork di un processo con i thread dei pool HTTP già avviati
+            with ProcessPoolExecutor(
+                max_workers=max(1, args.workers),
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_init_worker,
+                initargs=(args.token, scope),
+            ) as pool:
+                futures = {pool.submit(render_one, r, a, args.out, args.png): (r, a) for r, a in todo}
+                for fut in as_completed(futures):
+                    regione, anno = futures[fut]
+                    try:
+                        res = fut.result()
+                        done.append(res)
+                        print(f"  ok  {anno} {regione} ({res['elapsed_s']}s)", flush=True)
+                    except Exception as e:
+                        failed.append(f"{anno} {regione}: {e}")
+                        print(f"  ERR {anno} {regione}: {e}", flush=True)
+
+        write_index(args.out, regioni, years)
+    finally:
+        if server is not None:
+            server.shutdown()
+
+    print(json.dumps({
+        "report": len(tasks),
+        "generati": len(done),
+        "saltati": len(tasks) - len(todo),
+        "falliti": len(failed),
+        "errori": failed[:10],
+        "elapsed_s": round(time.monotonic() - t0, 2),
+        "index": os.path.join(args.out, "index.html"),
+    }, ensure_ascii=False, indent=2))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
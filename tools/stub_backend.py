@@ -0,0 +1,391 @@
+import argparse
+import json
+import random
+import threading
+import time
+
+from collections import Counter
+from email.parser import BytesParser
+from email.policy import HTTP
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+# =========================
+# STUB BACKEND (solo per benchmark / test locali)
+# =========================
+# Implementa gli endpoint /auth/* e /admin/import* usati da streamlit_app.py
+# su un dataset sintetico deterministico in memoria. Niente auth reale:
+# qualsiasi token è valido e vede tutto (profilo administrator).
+#
+#   python -m tools.stub_backend --port 8765 --rows 50000 --delay 0.02
+
+GEO = {
+    "LAZIO": {"RM": ["ROMA", "TIVOLI", "GUIDONIA"], "LT": ["LATINA", "FONDI", "SABAUDIA", "TERRACINA"]},
+    "CAMPANIA": {"NA": ["NAPOLI", "NOLA", "ACERRA"], "SA": ["SALERNO", "EBOLI", "BATTIPAGLIA", "CAPACCIO"]},
+    "PUGLIA": {"FG": ["FOGGIA", "CERIGNOLA", "SAN SEVERO"], "BA": ["BARI", "ANDRIA", "ALTAMURA"]},
+    "SICILIA": {"RG": ["RAGUSA", "VITTORIA", "COMISO"], "CT": ["CATANIA", "PATERNO'", "ADRANO"]},
+    "CALABRIA": {"CS": ["COSENZA", "CORIGLIANO", "CASSANO ALL'IONIO"], "RC": ["REGGIO CALABRIA", "ROSARNO"]},
+}
+NASCITA = {
+    "EE": ["ROMANIA", "INDIA", "MAROCCO", "ALBANIA", "TUNISIA", "SENEGAL", "BANGLADESH", "PAKISTAN"],
+    "RM": ["ROMA"], "NA": ["NAPOLI"], "FG": ["FOGGIA"], "RG": ["RAGUSA"], "CS": ["COSENZA"],
+}
+ANNI = [2021, 2022, 2023, 2024]
+
+GG_KEYS = {"≤10": "LE10", "11-50": "11_50", "51-100": "51_100", "101-150": "101_150", "151-180": "151_180", ">180": "GT180"}
+ETA_KEYS = {"≤20": "LE20", "21-40": "21_40", "41-60": "41_60", ">60": "GT60"}
+CUBE_DIMS = ("anno", "sesso", "nato_estero", "eta_fascia", "gg_fascia")
+
+
+def eta_fascia(eta: int) -> str:
+    if eta <= 20:
+        return "≤20"
+    if eta <= 40:
+        return "21-40"
+    if eta <= 60:
+        return "41-60"
+    return ">60"
+
+def gg_fascia(gg: int) -> str:
+    if gg <= 10:
+        return "≤10"
+    if gg <= 50:
+        return "11-50"
+    if gg <= 100:
+        return "51-100"
+    if gg <= 150:
+        return "101-150"
+    if gg <= 180:
+        return "151-180"
+    return ">180"
+
+def build_rows(n: int, seed: int = 1):
+    rnd = random.Random(seed)
+    rows = []
+    for i in range(n):
+        reg = rnd.choice(list(GEO))
+        prov = rnd.choice(list(GEO[reg]))
+        pn = rnd.choice(list(NASCITA))
+        eta = rnd.randint(17, 72)
+        gg = rnd.randint(1, 260)
+        rows.append({
+            "id": i + 1,
+            "regione": reg,
+            "provincia": prov,
+            "comune": rnd.choice(GEO[reg][prov]),
+            "prov_nascita": pn,
+            "comune_nascita": rnd.choice(NASCITA[pn]),
+            "sesso": rnd.choice("MF"),
+            "nato_estero": pn == "EE",
+            "eta_fascia": eta_fascia(eta),
+            "gg_fascia": gg_fascia(gg),
+            "gg_tot": gg,
+            "anno": rnd.choice(ANNI),
+        })
+    return rows
+
+
+class StubState:
+    def __init__(self, rows: int = 20000, delay: float = 0.0):
+        self.rows = build_rows(rows)
+        self.delay = delay
+        self.down = False
+        # endpoint che rispondono 404, come un backend più vecchio
+        self.missing = set()
+        # False: /auth/search con limit + offset e senza next_cursor (backend più vecchio)
+        self.keyset = True
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.jobs = {}
+        # anno -> hash delle righe importate (multiinsieme), per l'import incrementale
+        self.hashes = {}
+
+    def filter(self, q: dict, geo_only: bool = False):
+        out = self.rows
+        for key in ("regione", "provincia", "comune"):
+            if key in q:
+                allowed = set(q[key])
+                out = [r for r in out if r[key] in allowed]
+        if geo_only:
+            return out
+        for key, col in (("prov_nascita", "prov_nascita"), ("com_nascita", "comune_nascita"),
+                         ("eta_fascia", "eta_fascia"), ("gg_fascia", "gg_fascia")):
+            if key in q:
+                allowed = set(q[key])
+                out = [r for r in out if r[col] in allowed]
+        if "anno_ins" in q:
+            anni = {int(a) for a in q["anno_ins"]}
+            out = [r for r in out if r["anno"] in anni]
+        if "sesso" in q:
+            out = [r for r in out if r["sesso"] == q["sesso"][0]]
+        if "nato_estero" in q:
+            estero = q["nato_estero"][0].lower() == "true"
+            out = [r for r in out if r["nato_estero"] == estero]
+        return out
+
+
+def _multipart(content_type: str, body: bytes) -> dict:
+    msg = BytesParser(policy=HTTP).parsebytes(b"Content-Type: " + content_type.encode() + b"\r\n\r\n" + body)
+    if not msg.is_multipart():
+        return {}
+    return {
+        part.get_param("name", header="content-disposition"): part.get_payload(decode=True)
+        for part in msg.iter_parts()
+    }
+
+def _apply_import(state: StubState, mode: str, anno: int, form: dict) -> int:
+    # aggiorna gli hash memorizzati come farebbe il backend; ritorna le righe inserite
+    from import_diff import workbook_hashes
+
+    added = Counter(workbook_hashes(form["file"])) if form.get("file") else Counter()
+    if mode == "replace":
+        state.hashes = {}
+    if mode in ("replace", "replace_year"):
+        state.hashes[anno] = Counter()
+    stored = state.hashes.setdefault(anno, Counter())
+    if mode == "incremental":
+        stored.subtract(Counter(json.loads((form.get("delete_hashes") or b"[]").decode())))
+        stored += Counter()  # via i conteggi a zero o negativi
+    stored.update(added)
+    return sum(added.values())
+
+def _facet(rows, col, name):
+    counts = {}
+    for r in rows:
+        counts[r[col]] = counts.get(r[col], 0) + 1
+    return {"items": [{name: k, "count": v} for k, v in sorted(counts.items())]}
+
+def _sum_by(rows, col, keys, measure=None):
+    out = {k: 0 for k in keys}
+    for r in rows:
+        if r[col] in out:
+            out[r[col]] += r[measure] if measure else 1
+    return out
+
+def _trend(rows, metrica):
+    items = []
+    for anno in ANNI:
+        ra = [r for r in rows if r["anno"] == anno]
+        if metrica == "tot_braccianti":
+            items.append({"anno": anno, "serie": "Totale braccianti", "valore": len(ra)})
+        elif metrica == "tot_gg":
+            items.append({"anno": anno, "serie": "Totale giornate", "valore": sum(r["gg_tot"] for r in ra)})
+        elif metrica in ("sex_count", "sex_gg"):
+            for s, label in (("M", "Maschi"), ("F", "Femmine")):
+                sel = [r for r in ra if r["sesso"] == s]
+                v = len(sel) if metrica == "sex_count" else sum(r["gg_tot"] for r in sel)
+                items.append({"anno": anno, "serie": label, "valore": v})
+        elif metrica in ("nat_count", "nat_gg"):
+            for estero, label in ((False, "Italiani"), (True, "Esteri")):
+                sel = [r for r in ra if r["nato_estero"] == estero]
+                v = len(sel) if metrica == "nat_count" else sum(r["gg_tot"] for r in sel)
+                items.append({"anno": anno, "serie": label, "valore": v})
+        elif metrica == "eta_count":
+            labels = {"≤20": "≤ 20", "21-40": "21–40", "41-60": "41–60", ">60": "> 60"}
+            for code, v in _sum_by(ra, "eta_fascia", ETA_KEYS).items():
+                items.append({"anno": anno, "serie": labels[code], "valore": v})
+        elif metrica == "ggfasce_count":
+            labels = {"≤10": "10 o meno", "11-50": "11–50", "51-100": "51–100",
+                      "101-150": "101–150", "151-180": "151–180", ">180": "Più di 180"}
+            for code, v in _sum_by(ra, "gg_fascia", GG_KEYS).items():
+                items.append({"anno": anno, "serie": labels[code], "valore": v})
+    return {"items": items}
+
+
+def make_handler(state: StubState):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _send(self, code: int, obj):
+            body = json.dumps(obj).encode("utf-8")
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _begin(self):
+            with state.lock:
+                state.requests += 1
+            if state.down:
+                self._send(503, {"detail": "stub down"})
+                return False
+            if state.delay:
+                time.sleep(state.delay)
+            return True
+
+        def do_GET(self):
+            if not self._begin():
+                return
+            u = urlparse(self.path)
+            q = parse_qs(u.query)
+            path = u.path
+            if path in state.missing:
+                return self._send(404, {"detail": "Not Found"})
+
+            if path == "/health":
+                return self._send(200, {"status": "ok"})
+            if path == "/auth/whoami":
+                return self._send(200, {
+                    "username": "stub", "role": "administrator", "regione": None,
+                    "scope_level": "all", "scope_values": "",
+                })
+            if path == "/auth/regioni":
+                return self._send(200, _facet(state.rows, "regione", "regione"))
+            if path == "/auth/province":
+                return self._send(200, _facet(state.filter(q, geo_only=True), "provincia", "provincia"))
+            if path == "/auth/comuni":
+                provs = set(q.get("provincia", []))
+                return self._send(200, _facet([r for r in state.rows if r["provincia"] in provs], "comune", "comune"))
+            if path == "/auth/province-nascita":
+                return self._send(200, _facet(state.rows, "prov_nascita", "prov_nascita"))
+            if path == "/auth/comuni-nascita":
+                provs = set(q.get("prov_nascita", []))
+                rows = [r for r in state.rows if r["prov_nascita"] in provs]
+                return self._send(200, _facet(rows, "comune_nascita", "comune_nascita"))
+            if path == "/auth/anni-inserimento":
+                js = _facet(state.rows, "anno", "anno")
+                js["items"].sort(key=lambda x: -x["anno"])
+                return self._send(200, js)
+            if path == "/auth/trend-annuale":
+                apply_geo = q.get("apply_geo", ["false"])[0].lower() == "true"
+                rows = state.filter(q, geo_only=True) if apply_geo else state.rows
+                return self._send(200, _trend(rows, q.get("metrica", ["tot_braccianti"])[0]))
+            if path == "/auth/cube":
+                cube = {}
+                for r in state.filter(q, geo_only=True):
+                    k = tuple(r[d] for d in CUBE_DIMS)
+                    acc = cube.setdefault(k, [0, 0])
+                    acc[0] += 1
+                    acc[1] += r["gg_tot"]
+                items = [dict(zip(CUBE_DIMS, k), count=v[0], gg_tot=v[1]) for k, v in cube.items()]
+                return self._send(200, {"items": items})
+            if path == "/admin/import/hashes":
+                from import_diff import HASH_ALGO
+
+                stored = state.hashes.get(int(q.get("anno_inserimento", ["0"])[0]), Counter())
+                return self._send(200, {"algo": HASH_ALGO, "hashes": list(stored.elements())})
+            if path == "/admin/import/status":
+                job = state.jobs.get(q.get("job_id", [""])[0])
+                if job is None:
+                    return self._send(404, {"detail": "job non trovato"})
+                # il job "finisce" dopo un paio di secondi
+                done = time.monotonic() - job["started"] > 2
+                return self._send(200, {
+                    "status": "done" if done else "running",
+                    "inserted_rows": job["rows"] if done else None,
+                    "error": None,
+                })
+
+            rows = state.filter(q)
+            if path == "/auth/count":
+                return self._send(200, {"total": len(rows), "total_gg": sum(r["gg_tot"] for r in rows)})
+            if path == "/auth/stats-sex":
+                return self._send(200, {
+                    "count": _sum_by(rows, "sesso", "MF"),
+                    "gg_tot": _sum_by(rows, "sesso", "MF", "gg_tot"),
+                })
+            if path == "/auth/stats-nat":
+                count = _sum_by(rows, "nato_estero", (False, True))
+                gg = _sum_by(rows, "nato_estero", (False, True), "gg_tot")
+                return self._send(200, {
+                    "count": {"ITALIANI": count[False], "ESTERI": count[True]},
+                    "gg_tot": {"ITALIANI": gg[False], "ESTERI": gg[True]},
+                })
+            if path == "/auth/gg-fasce":
+                counts = _sum_by(rows, "gg_fascia", GG_KEYS)
+                return self._send(200, {"total": len(rows), "counts": {GG_KEYS[k]: v for k, v in counts.items()}})
+            if path == "/auth/eta-fasce":
+                counts = _sum_by(rows, "eta_fascia", ETA_KEYS)
+                return self._send(200, {"total": len(rows), "counts": {ETA_KEYS[k]: v for k, v in counts.items()}})
+            if path == "/auth/eta-gg-fasce":
+                acc = {}
+                for r in rows:
+                    a = acc.setdefault((ETA_KEYS[r["eta_fascia"]], GG_KEYS[r["gg_fascia"]]), [0, 0])
+                    a[0] += 1
+                    a[1] += r["gg_tot"]
+                items = [{"eta_fascia": e, "gg_fascia": g, "count": v[0], "gg_tot": v[1]} for (e, g), v in acc.items()]
+                return self._send(200, {"items": items})
+            if path == "/auth/geo-counts":
+                col = "comune" if q.get("livello", ["provincia"])[0] == "comune" else "provincia"
+                acc = {}
+                for r in rows:
+                    a = acc.setdefault(r[col], [0, 0])
+                    a[0] += 1
+                    a[1] += r["gg_tot"]
+                items = [{"codice": k, "count": v[0], "gg_tot": v[1]} for k, v in sorted(acc.items())]
+                return self._send(200, {"items": items})
+            if path == "/auth/search":
+                # keyset: cursor = ultimo id della pagina precedente (righe già in ordine di id)
+                limit = int(q.get("limit", ["100"])[0])
+                if not state.keyset:
+                    offset = int(q.get("offset", ["0"])[0])
+                    page = rows[offset:offset + limit]
+                    items = [{**{k: v for k, v in r.items() if k != "anno"}, "anno_inserimento": r["anno"]} for r in page]
+                    return self._send(200, {"items": items})
+                after = int(q.get("cursor", ["0"])[0])
+                page = [r for r in rows if r["id"] > after][:limit + 1]
+                more = len(page) > limit
+                page = page[:limit]
+                items = [{**{k: v for k, v in r.items() if k != "anno"}, "anno_inserimento": r["anno"]} for r in page]
+                return self._send(200, {
+                    "items": items,
+                    "next_cursor": str(page[-1]["id"]) if more and page else None,
+                })
+
+            return self._send(404, {"detail": f"endpoint stub non implementato: {path}"})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            body = self.rfile.read(length) if length else b""
+            if not self._begin():
+                return
+            u = urlparse(self.path)
+            if u.path == "/admin/import":
+                q = parse_qs(u.query)
+                try:
+                    form = _multipart(self.headers.get("Content-Type", ""), body)
+                    inserted = _apply_import(
+                        state, q.get("mode", ["append"])[0], int(q.get("anno_inserimento", ["0"])[0]), form
+                    )
+                except Exception as e:
+                    return self._send(400, {"detail": f"file non valido: {e}"})
+                job_id = f"stub-{len(state.jobs) + 1}"
+                state.jobs[job_id] = {"started": time.monotonic(), "rows": inserted, "bytes": len(body)}
+                return self._send(200, {"job_id": job_id})
+            return self._send(404, {"detail": f"endpoint stub non implementato: {u.path}"})
+
+        def log_message(self, *args):
+            pass
+
+    return Handler
+
+
+def serve(port: int = 8765, rows: int = 20000, delay: float = 0.0, host: str = "127.0.0.1"):
+    # avvia il server in un thread daemon; ritorna (server, state)
+    state = StubState(rows=rows, delay=delay)
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="stub-backend", daemon=True).start()
+    return server, state
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Stub backend per test/benchmark della UI")
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=8765)
+    ap.add_argument("--rows", type=int, default=20000)
+    ap.add_argument("--delay", type=float, default=0.0, help="latenza artificiale per richiesta (s)")
+    args = ap.parse_args()
+
+    server, _ = serve(args.port, args.rows, args.delay, args.host)
+    print(f"Stub backend su http://{args.host}:{args.port} ({args.rows:,} righe). Ctrl+C per uscire.")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()